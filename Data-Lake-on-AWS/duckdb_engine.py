@@ -0,0 +1,735 @@
+"""
+In-process DuckDB engine of the data lake ETL, for inputs too small to be worth
+starting a Spark session for, e.g. an hourly or daily increment.
+
+It builds the same five tables as process_song_data and process_log_data in
+etl.py, without pyspark: from the same declared schemas (lake_tables.py),
+with the same bad record handling, write modes and run manifest, into the
+same partition directories with the same sort order and codec. The file columns are cast to the types Spark writes
+(FILE_SCHEMAS) and every file carries Spark's row metadata, so readers, Spark
+included, get the same tables whichever engine wrote them. Files are listed and
+deleted with pyarrow's filesystems, on S3 or locally, and reported with the
+s3a:// and file: paths Hadoop uses, so both engines share the run manifest.
+
+etl.py runs it with --engine duckdb, or in auto mode when the input to load is
+under --duckdb-max-input-mb.
+"""
+import os
+import json
+import uuid
+import fnmatch
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import duckdb
+import pyarrow
+from pyarrow import fs as pafs
+
+import lake_tables
+from lake_tables import config, METRICS, SONG_FIELDS, LOG_FIELDS, CORRUPT_RECORD, BAD_RECORD_MODES, TABLES, \
+    PARTITION_COLUMNS, TABLE_KEYS, APPEND_TABLES, TARGET_FILE_MB, table_layout
+from songplay_key import DUCKDB_SQL as SONGPLAY_ID_SQL
+
+# columns of the parquet files Spark writes for each table, partition columns aside, as (column, Spark type name)
+FILE_SCHEMAS = {
+    "songs_table": [
+        ("song_id", "string"),
+        ("title", "string"),
+        ("duration", "double"),
+    ],
+    "artists_table": [
+        ("artist_id", "string"),
+        ("artist_name", "string"),
+        ("artist_location", "string"),
+        ("artist_latitude", "double"),
+        ("artist_longitude", "double"),
+    ],
+    "users_table": [
+        ("userId", "string"),
+        ("firstName", "string"),
+        ("lastName", "string"),
+        ("gender", "string"),
+        ("level", "string"),
+    ],
+    "time_table": [
+        ("start_time", "timestamp"),
+        ("hour", "integer"),
+        ("day", "integer"),
+        ("week", "integer"),
+        ("weekday", "integer"),
+    ],
+    "songplays_table": [
+        ("songplay_id", "long"),
+        ("start_time", "timestamp"),
+        ("user_id", "string"),
+        ("level", "string"),
+        ("song_id", "string"),
+        ("artist_id", "string"),
+        ("session_id", "long"),
+        ("location", "string"),
+        ("user_agent", "string"),
+    ],
+}
+
+# DuckDB type of each Spark type, and the JSON values a non-string field is parsed from; Spark fails a record
+# with any other value for the field, e.g. a float, a quoted number or a number out of range for a long
+DUCKDB_TYPES = {"string": "VARCHAR", "long": "BIGINT", "integer": "INTEGER", "double": "DOUBLE",
+                "timestamp": "TIMESTAMPTZ"}
+JSON_TYPES = {"long": ["BIGINT", "UBIGINT"], "double": ["BIGINT", "UBIGINT", "DOUBLE"]}
+
+# parquet key-value metadata Spark reads its schema from, and Spark's codec names DuckDB spells differently
+SPARK_ROW_METADATA = "org.apache.spark.sql.parquet.row.metadata"
+CODECS = {"none": "uncompressed"}
+
+S3_SCHEMES = ("s3a://", "s3n://", "s3://")
+
+# Spark casts ts / 1000 seconds to a timestamp by truncating it to microseconds, with the same double arithmetic
+START_TIME_SQL = "CAST(make_timestamp(CAST(trunc(({ts} / 1000) * 1000000) AS BIGINT)) AS TIMESTAMPTZ)"
+
+
+@lru_cache(maxsize=None)
+def s3_filesystem(bucket):
+    """
+    pyarrow S3 filesystem of a bucket, in the bucket's region, with the
+        credentials lake_tables exports from dl.cfg.
+    """
+    return pafs.FileSystem.from_uri("s3://" + bucket)[0]
+
+
+def filesystem(path):
+    """
+    Resolve a path as Spark takes it to a pyarrow filesystem.
+    Keyword arguments:
+    * path   -- s3a://bucket/key, file:/dir or a local path
+    Output:
+    * fs     -- pyarrow FileSystem of the path
+    * fspath -- the path on fs
+    * scheme -- prefix of the paths of fs as Hadoop lists them
+    """
+    if path.startswith(S3_SCHEMES):
+        location = path.split("://", 1)[1]
+        return s3_filesystem(location.split("/", 1)[0]), location, "s3a://"
+    if path.startswith("file:"):
+        path = "/" + path[len("file:"):].lstrip("/")
+    return pafs.LocalFileSystem(), os.path.abspath(path), "file:"
+
+
+def duckdb_path(path):
+    """
+    The path DuckDB reads or writes a file or directory at: s3:// for S3,
+        a plain absolute path locally.
+    """
+    if path.startswith(S3_SCHEMES):
+        return "s3://" + path.split("://", 1)[1]
+    return filesystem(path)[1]
+
+
+def sql_string(value):
+    """
+    Quote a value as a SQL string literal.
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def list_files(pattern):
+    """
+    List the files matching a glob pattern, as etl.list_files does through
+        Hadoop: '*' and '?' do not match '/'.
+    Keyword arguments:
+    * pattern -- glob of the files, e.g. s3a://bucket/log_data/2018/11/*.json
+    Output:
+    * files   -- sorted list of (path, size, modification time in ms) of
+                 the matching files, with Hadoop's form of the paths
+    """
+    fs, fspath, scheme = filesystem(pattern)
+    parts = fspath.split("/")
+    fixed = next((i for i, part in enumerate(parts) if any(char in part for char in "*?[")), len(parts))
+    base = "/".join(parts[:fixed])
+
+    if fixed == len(parts):
+        infos = [fs.get_file_info(base)]
+    else:
+        infos = fs.get_file_info(pafs.FileSelector(base, allow_not_found=True, recursive=True))
+
+    files = []
+    for info in infos:
+        path_parts = info.path.split("/")
+        if info.type == pafs.FileType.File and len(path_parts) == len(parts) and \
+                all(fnmatch.fnmatchcase(name, glob) for name, glob in zip(path_parts[fixed:], parts[fixed:])):
+            files.append((scheme + info.path, info.size, info.mtime_ns // 10 ** 6))
+    return sorted(files)
+
+
+def path_exists(path):
+    """
+    Check whether a file or directory exists, on S3 or locally.
+    """
+    fs, fspath, scheme = filesystem(path)
+    return fs.get_file_info(fspath).type != pafs.FileType.NotFound
+
+
+def delete_dir(path):
+    """
+    Delete a directory and everything in it, when it exists.
+    """
+    fs, fspath, scheme = filesystem(path)
+    if fs.get_file_info(fspath).type != pafs.FileType.NotFound:
+        fs.delete_dir(fspath)
+
+
+def make_dirs(path):
+    """
+    Create a directory and its parents, which DuckDB does not create
+        before it writes into them.
+    """
+    fs, fspath, scheme = filesystem(path)
+    fs.create_dir(fspath, recursive=True)
+
+
+def mark_success(path):
+    """
+    Write the empty _SUCCESS file Spark leaves in a table it wrote.
+    """
+    fs, fspath, scheme = filesystem(path + "/_SUCCESS")
+    fs.open_output_stream(fspath).close()
+
+
+def connect(*paths):
+    """
+    Open an in-memory DuckDB connection in UTC, the session time zone of the
+        Spark profiles, with S3 credentials when one of the paths is on S3.
+    Keyword arguments:
+    * paths -- input and output paths the connection reads and writes
+    Output:
+    * con   -- DuckDB connection
+    """
+    con = duckdb.connect()
+    con.execute("SET TimeZone = 'UTC'")
+    if any(path.startswith(S3_SCHEMES) for path in paths):
+        con.execute("INSTALL httpfs")
+        con.execute("LOAD httpfs")
+        con.execute("CREATE SECRET sparkify_s3 (TYPE s3, KEY_ID {}, SECRET {}, REGION {})".format(
+            sql_string(os.environ['AWS_ACCESS_KEY_ID']), sql_string(os.environ['AWS_SECRET_ACCESS_KEY']),
+            sql_string(config.get('AWS', 'REGION', fallback=os.environ.get('AWS_DEFAULT_REGION', 'us-west-2')))))
+    return con
+
+
+class RunManifest(lake_tables.RunManifest):
+    """
+    The run manifest of lake_tables.RunManifest, read and appended to
+        with DuckDB. The records are the same JSON lines Spark writes, so
+        each engine goes on from the runs of the other.
+    """
+
+    def __init__(self, con, output_data):
+        """
+        Keyword arguments:
+        * con         -- DuckDB connection
+        * output_data -- path of the tables the manifest belongs to
+        """
+        super().__init__(output_data)
+        self.con = con
+        files = list_files(self.path + "/*.json")
+        if files:
+            for path, size, mtime in con.execute("""
+                    SELECT path, size, modification_time
+                    FROM read_json(?, format = 'newline_delimited',
+                                   columns = {'path': 'VARCHAR', 'size': 'BIGINT',
+                                              'modification_time': 'BIGINT', 'loaded_at': 'VARCHAR'})
+                    ORDER BY loaded_at
+                    """, [[duckdb_path(path) for path, size, mtime in files]]).fetchall():
+                self.loaded[path] = (size, mtime)
+
+    def record(self, files):
+        """
+        Record files as loaded, once the tables built from them are written.
+        Keyword arguments:
+        * files -- list of (path, size, modification time)
+        """
+        if not files:
+            return
+        loaded_at = datetime.now(timezone.utc).isoformat()
+        manifest_rows = pyarrow.table({
+            "path": [path for path, size, mtime in files],
+            "size": [size for path, size, mtime in files],
+            "modification_time": [mtime for path, size, mtime in files],
+            "loaded_at": [loaded_at] * len(files),
+        })
+        make_dirs(self.path)
+        self.con.register("manifest_rows", manifest_rows)
+        self.con.execute("COPY manifest_rows TO {} (FORMAT json)".format(
+            sql_string(duckdb_path("{}/part-{}.json".format(self.path, uuid.uuid4())))))
+        self.con.unregister("manifest_rows")
+        self.loaded.update((path, (size, mtime)) for path, size, mtime in files)
+
+
+def read_json(con, files, schema, bad_records="quarantine", quarantine_path=None, name="records"):
+    """
+    Read JSON lines against a declared schema into a view, the way Spark
+        does: a line that is not a JSON object, or has a value of the wrong
+        type for a field, is malformed; missing fields are null.
+    Keyword arguments:
+    * con             -- DuckDB connection
+    * files           -- list of (path, size, modification time) to read
+    * schema          -- list of (field, Spark type name) of the records,
+                         see lake_tables.SONG_FIELDS
+    * bad_records     -- 'quarantine' to write malformed records to
+                         quarantine_path and go on with the others, 'drop'
+                         to silently skip them, 'fail' to fail the job.
+    * quarantine_path -- where malformed records are appended as JSON.
+    * name            -- name of the view of the well-formed records
+    Output:
+    * rows            -- number of well-formed records
+    """
+    if bad_records not in BAD_RECORD_MODES:
+        raise ValueError("bad_records must be one of {}".format(", ".join(BAD_RECORD_MODES)))
+
+    # the parsed records are materialized once, as persist does in the Spark engine
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE {name}_lines AS
+        SELECT line, CASE WHEN json_valid(line) THEN json_type(line) = 'OBJECT' ELSE false END AS is_object
+        FROM (
+            SELECT rtrim(unnest(string_split(content, chr(10))), chr(13)) AS line
+            FROM read_text(?)
+        )
+        WHERE trim(line) <> ''
+        """.format(name=name), [[duckdb_path(path) for path, size, mtime in files]])
+
+    values, checks = [], []
+    for field, kind in schema:
+        json_path = sql_string("$." + field)
+        if kind in JSON_TYPES:
+            value = "CASE WHEN json_type(line, {path}) IN ({allowed}) THEN TRY_CAST(line ->> {path} AS {type}) END" \
+                .format(path=json_path, allowed=", ".join(sql_string(json_type) for json_type in JSON_TYPES[kind]),
+                        type=DUCKDB_TYPES[kind])
+            values.append('{} AS "{}"'.format(value, field))
+            checks.append("(coalesce(json_type(line, {}), 'NULL') = 'NULL' OR {} IS NOT NULL)".format(json_path, value))
+        else:
+            values.append("line ->> {} AS \"{}\"".format(json_path, field))
+
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE {name}_parsed AS
+        SELECT {values}, NOT ({checks}) AS malformed, line
+        FROM {name}_lines
+        WHERE is_object
+        """.format(name=name, values=", ".join(values), checks=" AND ".join(checks) or "true"))
+
+    malformed = """
+        SELECT line FROM {name}_lines WHERE NOT is_object
+        UNION ALL
+        SELECT line FROM {name}_parsed WHERE malformed
+        """.format(name=name)
+    bad, first = con.execute("SELECT count(*), min(line) FROM ({})".format(malformed)).fetchone()
+    if bad:
+        print("====={} malformed {}=====".format(bad, name))
+        if bad_records == "fail":
+            raise ValueError("Malformed record in {}: {}".format(name, first[:200]))
+        if bad_records == "quarantine":
+            make_dirs(quarantine_path)
+            con.execute("COPY (SELECT line AS {} FROM ({})) TO {} (FORMAT json)".format(
+                CORRUPT_RECORD, malformed,
+                sql_string(duckdb_path("{}/part-{}.json".format(quarantine_path, uuid.uuid4())))))
+
+    con.execute("CREATE OR REPLACE TEMP VIEW {name} AS SELECT {columns} FROM {name}_parsed WHERE NOT malformed".format(
+        name=name, columns=", ".join('"{}"'.format(field) for field, kind in schema)))
+    return con.execute("SELECT count(*) FROM {}".format(name)).fetchone()[0]
+
+
+def process_song_data(con, input_data, output_data, song_data="song_data/*/*/*/*.json", bad_records="quarantine",
+                      target_file_mb=TARGET_FILE_MB, run_manifest=None):
+    """
+    Build songs_table and artists_table from the song files, see
+        etl.process_song_data.
+    Keyword arguments:
+    * con           -- DuckDB connection
+    * input_data    -- path to input_data to be processed (song_data)
+    * output_data   -- path to location to store the output (parquet files).
+    * song_data     -- glob of the song files, relative to input_data.
+    * bad_records   -- handling of malformed records, see read_json;
+                       quarantined ones go to output_data/quarantine.
+    * target_file_mb -- size of the files of an unpartitioned table.
+    * run_manifest  -- RunManifest of an incremental run, None to rewrite the
+                       tables from all the song files.
+    Output:
+    * songs, artists -- number of rows written to each table, None when an
+                       incremental run has no new song files
+    """
+    song_files = list_files(input_data + song_data)
+    if run_manifest is not None:
+        song_files = run_manifest.new_files(song_files)
+        print("====={} new song files=====".format(len(song_files)))
+        if not song_files:
+            return None, None
+    if not song_files:
+        raise ValueError("No song files match {}".format(input_data + song_data))
+
+    print("=====Reading Song data=====")
+    with METRICS.stage('song_data.read') as stage:
+        rows = read_json(con, song_files, SONG_FIELDS, bad_records, output_data + "quarantine/song_data",
+                         "song_data_table")
+        stage.add(rows_in=rows, bytes_read=sum(size for path, size, mtime in song_files))
+
+    print("=====Writing Song data=====")
+    with METRICS.stage('songs.write') as stage:
+        songs = save_table(con, "SELECT DISTINCT song_id, title, artist_id, year, duration FROM song_data_table",
+                           output_data, "songs_table", target_file_mb, run_manifest is not None)
+        stage.add(rows_out=songs)
+
+    print("=====Writing artists data=====")
+    with METRICS.stage('artists.write') as stage:
+        artists = save_table(con, """
+                             SELECT DISTINCT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+                             FROM song_data_table
+                             """, output_data, "artists_table", target_file_mb, run_manifest is not None)
+        stage.add(rows_out=artists)
+
+    if run_manifest is not None:
+        run_manifest.record(song_files)
+    return songs, artists
+
+
+def process_log_data(con, input_data, output_data, log_data='log_data/*/*/*-events.json',
+                     start_date=None, end_date=None, bad_records="quarantine", target_file_mb=TARGET_FILE_MB,
+                     run_manifest=None):
+    """
+    Build users_table, time_table and songplays_table from the log files,
+        see etl.process_log_data.
+    Keyword arguments:
+    * con              -- DuckDB connection
+    * input_data       -- path to input_data to be processed (log_data)
+    * output_data      -- path to location to store the output
+                          (parquet files).
+    * log_data         -- glob of the log files, relative to input_data;
+                          used when no date range is given.
+    * start_date       -- first day of logs to load (datetime.date).
+    * end_date         -- last day of logs to load, inclusive
+                          (datetime.date).
+    * bad_records      -- handling of malformed records, see read_json;
+                          quarantined ones go to output_data/quarantine.
+    * target_file_mb   -- size of the files of an unpartitioned table.
+    * run_manifest     -- RunManifest of an incremental run, None to rewrite
+                          the tables from all the log files.
+    Output:
+    * users, time, songplays -- number of rows written to each table, None
+                          when an incremental run has no new log files
+    """
+    if start_date or end_date:
+        start_date, end_date = start_date or end_date, end_date or start_date
+        log_files = lake_tables.list_log_files(list_files, input_data, start_date, end_date)
+        if not log_files:
+            raise ValueError("No log files between {} and {} in {}".format(start_date, end_date, input_data))
+        print("====={} log files between {} and {}=====".format(len(log_files), start_date, end_date))
+    else:
+        log_files = list_files(input_data + log_data)
+
+    if run_manifest is not None:
+        log_files = run_manifest.new_files(log_files)
+        print("====={} new log files=====".format(len(log_files)))
+        if not log_files:
+            return None, None, None
+    if not log_files:
+        raise ValueError("No log files match {}".format(input_data + log_data))
+
+    print("=====Reading log data=====")
+    with METRICS.stage('log_data.read') as stage:
+        rows = read_json(con, log_files, LOG_FIELDS, bad_records, output_data + "quarantine/log_data",
+                         "log_records")
+        stage.add(rows_in=rows, bytes_read=sum(size for path, size, mtime in log_files))
+
+    # the start time of every play is derived once, for the time and songplays tables
+    print("=====Filtering log data=====")
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE log_data_table AS
+        SELECT *, {start_time} AS start_time FROM log_records
+        WHERE page = 'NextSong' AND userId IS NOT NULL AND ts IS NOT NULL
+        """.format(start_time=START_TIME_SQL.format(ts='ts')))
+
+    print("=====Writing users data=====")
+    with METRICS.stage('users.write') as stage:
+        users = save_table(con, "SELECT DISTINCT userId, firstName, lastName, gender, level FROM log_data_table",
+                           output_data, "users_table", target_file_mb, run_manifest is not None)
+        stage.add(rows_out=users)
+
+    # DuckDB's dayofweek counts from 0 on Sunday, Spark's from 1
+    print("=====Writing time data=====")
+    with METRICS.stage('time.write') as stage:
+        time = save_table(con, """
+                          SELECT
+                              TT.time AS start_time,
+                              hour(TT.time) AS hour,
+                              dayofmonth(TT.time) AS day,
+                              weekofyear(TT.time) AS week,
+                              month(TT.time) AS month,
+                              year(TT.time) AS year,
+                              dayofweek(TT.time) + 1 AS weekday
+                          FROM (
+                              SELECT DISTINCT start_time AS time
+                              FROM log_data_table
+                          ) TT
+                          """,
+                          output_data, "time_table", target_file_mb, run_manifest is not None)
+        stage.add(rows_out=time)
+
+    print("=====Writing songplays data=====")
+    # an incremental run may not have read every song file, its lookup comes from the written tables
+    song_lookup(con, output_data if run_manifest is not None else None)
+    with METRICS.stage('songplays.write') as stage:
+        songplays = save_table(con, """
+                               SELECT
+                                   {songplay_id} AS songplay_id,
+                                   logT.start_time AS start_time,
+                                   month(logT.start_time) AS month,
+                                   year(logT.start_time) AS year,
+                                   logT.userId AS user_id,
+                                   logT.level AS level,
+                                   songT.song_id AS song_id,
+                                   songT.artist_id AS artist_id,
+                                   logT.sessionId AS session_id,
+                                   logT.location AS location,
+                                   logT.userAgent AS user_agent
+                               FROM log_data_table logT
+                               JOIN song_lookup_table songT
+                                   ON logT.artist = songT.artist_name
+                                   AND logT.song = songT.title
+                                   AND logT.length = songT.duration
+                               """.format(songplay_id=SONGPLAY_ID_SQL.format(user_id='logT.userId',
+                                                                             session_id='logT.sessionId',
+                                                                             item_in_session='logT.itemInSession',
+                                                                             ts='logT.ts')),
+                               output_data, "songplays_table", target_file_mb, run_manifest is not None)
+        stage.add(rows_out=songplays)
+
+    if run_manifest is not None:
+        run_manifest.record(log_files)
+    return users, time, songplays
+
+
+def song_lookup(con, output_data=None):
+    """
+    Build song_lookup_table, the song catalog lookup of the songplays join,
+        with one row per (title, artist_name, duration), see
+        etl.song_lookup.
+    Keyword arguments:
+    * con         -- DuckDB connection
+    * output_data -- path of the written tables; when given, the lookup is
+                     built from the songs and artists tables instead of the
+                     song files read by the run
+    """
+    if output_data is None:
+        songs = "song_data_table"
+    else:
+        songs = """(
+            SELECT s.title, a.artist_name, s.duration, s.song_id, s.artist_id
+            FROM {songs} s
+            JOIN {artists} a ON s.artist_id = a.artist_id
+        )""".format(songs=table_source(output_data + "songs_table"),
+                    artists=table_source(output_data + "artists_table"))
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE song_lookup_table AS
+        SELECT DISTINCT ON (title, artist_name, duration) title, artist_name, duration, song_id, artist_id
+        FROM {}
+        """.format(songs))
+
+
+def table_source(path):
+    """
+    SQL source reading a written table, its partition columns included.
+    """
+    return "read_parquet({}, hive_partitioning = true)".format(sql_string(duckdb_path(path) + "/**/*.parquet"))
+
+
+def row_metadata(schema):
+    """
+    The JSON of a file schema Spark writes in the parquet key-value metadata.
+    """
+    return json.dumps({"type": "struct",
+                       "fields": [{"name": column, "type": kind, "nullable": True, "metadata": {}}
+                                  for column, kind in schema]},
+                      separators=(",", ":"))
+
+
+def row_group_rows(con, query, row_group_mb):
+    """
+    Rows per row group of about row_group_mb, from the average width of the
+        rows as text. DuckDB cannot size row groups in bytes while keeping
+        the sort order of the rows.
+    """
+    width = con.execute("SELECT avg(strlen(CAST(t AS VARCHAR))) FROM ({}) t".format(query)).fetchone()[0]
+    return max(1, int(row_group_mb * 2 ** 20 / (width or 1)))
+
+
+def write_table(con, query, path, schema, partition_columns=(), target_file_mb=TARGET_FILE_MB, mode="overwrite",
+                layout=None):
+    """
+    Write the rows of a query to a parquet table laid out as
+        etl.write_table lays it out: one directory per partition, rows
+        sorted by the partition columns and then the layout's sort columns,
+        the layout's row group size and codec. A partition directory gets
+        one file per write; an unpartitioned table is split into files of
+        about target_file_mb.
+    Keyword arguments:
+    * con               -- DuckDB connection
+    * query             -- SQL query of the rows
+    * path              -- directory of the table
+    * schema            -- (column, Spark type name) of the file columns,
+                           see FILE_SCHEMAS
+    * partition_columns -- columns the table is partitioned by
+    * target_file_mb    -- size of a file of an unpartitioned table, in MB
+    * mode              -- 'overwrite' the table or 'append' to it
+    * layout            -- sort columns, row group size and codec, see
+                           lake_tables.TABLE_LAYOUTS
+    Output:
+    * rows              -- number of rows written
+    """
+    columns = ['CAST("{0}" AS {1}) AS "{0}"'.format(column, DUCKDB_TYPES[kind]) for column, kind in schema] + \
+               ['"{}"'.format(column) for column in partition_columns]
+    order = list(partition_columns) + (list(layout['sort']) if layout else [])
+
+    options = ["FORMAT parquet",
+               "KV_METADATA {{{}: {}}}".format(sql_string(SPARK_ROW_METADATA), sql_string(row_metadata(schema))),
+               "FILENAME_PATTERN 'part-{i}-{uuid}'"]
+    if layout:
+        options += ["COMPRESSION {}".format(CODECS.get(layout['codec'], layout['codec'])),
+                    "ROW_GROUP_SIZE {}".format(row_group_rows(con, query, layout['row_group_mb']))]
+    if partition_columns:
+        options.append("PARTITION_BY ({})".format(", ".join('"{}"'.format(column) for column in partition_columns)))
+    else:
+        options.append("FILE_SIZE_BYTES '{}MiB'".format(target_file_mb))
+
+    if mode == "append":
+        options.append("APPEND")
+    else:
+        delete_dir(path)
+        options.append("OVERWRITE_OR_IGNORE")
+    make_dirs(path)
+
+    rows = con.execute("COPY (SELECT {columns} FROM ({query}) {order}) TO {path} ({options})".format(
+        columns=", ".join(columns), query=query,
+        order="ORDER BY " + ", ".join('"{}"'.format(column) for column in order) if order else "",
+        path=sql_string(duckdb_path(path)), options=", ".join(options))).fetchone()[0]
+    mark_success(path)
+    return rows
+
+
+def save_table(con, query, output_data, table, target_file_mb=TARGET_FILE_MB, incremental=False):
+    """
+    Write one of the TABLES, replacing it, or merging into it as
+        etl.save_table does: rows with new keys are appended to a dimension
+        table, and the year/month partitions of time and songplays the
+        query has rows in are rewritten with the rows already there, except
+        those it replaces with a row of the same key.
+    Keyword arguments:
+    * con            -- DuckDB connection
+    * query          -- SQL query of the table's rows
+    * output_data    -- path of the tables
+    * table          -- name of the table, one of TABLES
+    * target_file_mb -- size of a file of an unpartitioned table, in MB
+    * incremental    -- whether the table is merged rather than replaced
+    Output:
+    * rows           -- number of rows written
+    """
+    path = output_data + table
+    partition_columns, key, layout = PARTITION_COLUMNS[table], TABLE_KEYS[table], table_layout(table)
+    schema = FILE_SCHEMAS[table]
+    con.execute("CREATE OR REPLACE TEMP TABLE new_rows AS " + query)
+
+    if not incremental or not path_exists(path):
+        return write_table(con, "SELECT * FROM new_rows", path, schema, partition_columns, target_file_mb,
+                           layout=layout)
+
+    same_key = " AND ".join('e."{0}" = n."{0}"'.format(column) for column in key)
+    if table in APPEND_TABLES:
+        return write_table(con, "SELECT * FROM new_rows n WHERE NOT EXISTS (SELECT 1 FROM {} e WHERE {})".format(
+            table_source(path), same_key), path, schema, partition_columns, target_file_mb, mode="append",
+            layout=layout)
+
+    same_partition = " AND ".join('e."{0}" = n."{0}"'.format(column) for column in partition_columns)
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE merged_rows AS
+        SELECT * FROM new_rows
+        UNION ALL BY NAME
+        SELECT e.* FROM {existing} e
+        WHERE EXISTS (SELECT 1 FROM new_rows n WHERE {same_partition})
+        AND NOT EXISTS (SELECT 1 FROM new_rows n WHERE {same_key})
+        """.format(existing=table_source(path), same_partition=same_partition, same_key=same_key))
+
+    # the merged rows are materialized, so the partitions they were read from can be replaced
+    for values in con.execute("SELECT DISTINCT {} FROM new_rows".format(
+            ", ".join('"{}"'.format(column) for column in partition_columns))).fetchall():
+        delete_dir(path + "".join("/{}={}".format(column, "__HIVE_DEFAULT_PARTITION__" if value is None else value)
+                                  for column, value in zip(partition_columns, values)))
+    return write_table(con, "SELECT * FROM merged_rows", path, schema, partition_columns, target_file_mb,
+                       mode="append", layout=layout)
+
+
+def input_size(input_data, song_data, log_data, start_date=None, end_date=None, output_data=None):
+    """
+    Size of the JSON input a run loads, listed with pyarrow so that it is
+        known before a Spark session is started.
+    Keyword arguments:
+    * input_data  -- root of song_data and log_data
+    * song_data   -- glob of the song files under input_data
+    * log_data    -- glob of the log files, when no date range is given
+    * start_date  -- first day of logs to load
+    * end_date    -- last day of logs to load, inclusive
+    * output_data -- path of the tables of an incremental run, whose run
+                     manifest the files already loaded are left out by
+    Output:
+    * size        -- size of the input files, in bytes
+    """
+    files = list_files(input_data + song_data)
+    if start_date or end_date:
+        files += lake_tables.list_log_files(list_files, input_data, start_date or end_date,
+                                            end_date or start_date)
+    else:
+        files += list_files(input_data + log_data)
+
+    if output_data is not None:
+        con = connect(output_data)
+        files = RunManifest(con, output_data).new_files(files)
+        con.close()
+    return sum(size for path, size, mtime in files)
+
+
+def check_tables(con, output_data):
+    """
+    Print the schema, row count and a sample of every written table.
+    """
+    for table in TABLES:
+        written = con.sql("SELECT * FROM " + table_source(output_data + table))
+        print(table + " information\n")
+        print(table + " Schema")
+        for column, column_type in zip(written.columns, written.types):
+            print(" |-- {}: {}".format(column, column_type))
+
+        print(table + " number of rows: " + str(written.aggregate("count(*)").fetchone()[0]))
+
+        print(table + " Sample data")
+        written.limit(5).show()
+
+
+def run(args, input_data, output_data):
+    """
+    Run the ETL on this engine, with the command line arguments of
+        etl.main.
+    """
+    con = connect(input_data, output_data)
+
+    run_manifest = None
+    if args.write_mode == 'incremental':
+        run_manifest = RunManifest(con, output_data)
+        print("====={} input files already loaded=====".format(len(run_manifest)))
+
+    print("=====Processing Song data=====\n")
+    process_song_data(con, input_data, output_data, args.song_data, args.bad_records, args.target_file_mb,
+                      run_manifest)
+
+    print("=====Processing Log data=====\n")
+    process_log_data(con, input_data, output_data, args.log_data, args.start_date, args.end_date,
+                     args.bad_records, args.target_file_mb, run_manifest)
+    print("=====data Processing Complete=====\n")
+
+    print("=====check Processed tables and data=====\n")
+    check_tables(con, output_data)
+    con.close()
+    METRICS.emit()
@@ -1,35 +1,355 @@
-import configparser
-from datetime import datetime
+from datetime import datetime, timezone
 import os
+import math
+import argparse
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
+from pyspark.sql.functions import col, broadcast, ceil, lit, pmod
+from pyspark.sql.functions import hash as row_hash
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, dayofweek
+from pyspark.sql.types import StructType, StructField, StringType, LongType, IntegerType, DoubleType, TimestampType
 
+import lake_tables
+from lake_tables import config, METRICS, CORRUPT_RECORD, SONG_FIELDS, LOG_FIELDS, BAD_RECORD_MODES, TABLES, \
+    PARTITION_COLUMNS, TARGET_FILE_MB, TABLE_KEYS, APPEND_TABLES, TABLE_LAYOUTS, table_layout
+# lake_tables puts the root of the repository, where the modules shared with the other pipelines are, on the path
+from songplay_key import SPARK_SQL as SONGPLAY_ID_SQL
 
-config = configparser.ConfigParser()
-config.read('dl.cfg')
+# Spark type of each type name of the declared schemas
+SPARK_TYPES = {"string": StringType(), "long": LongType(), "integer": IntegerType(), "double": DoubleType(),
+               "timestamp": TimestampType()}
 
-os.environ['AWS_ACCESS_KEY_ID']=config.get('AWS', 'AWS_ACCESS_KEY_ID')
-os.environ['AWS_SECRET_ACCESS_KEY']=config.get('AWS', 'AWS_SECRET_ACCESS_KEY')
 
+def spark_schema(fields):
+    """
+    Build the StructType of a list of (field, Spark type name), see
+        lake_tables.SONG_FIELDS.
+    """
+    return StructType([StructField(name, SPARK_TYPES[kind]) for name, kind in fields])
+
+
+SONG_SCHEMA = spark_schema(SONG_FIELDS)
+LOG_SCHEMA = spark_schema(LOG_FIELDS)
+
+# storage levels the parsed song and log records can be persisted with, NONE to recompute them
+STORAGE_LEVELS = ["NONE", "MEMORY_ONLY", "MEMORY_AND_DISK", "DISK_ONLY", "OFF_HEAP"]
+
+# how songplays joins the song plays to the song catalog, and the largest catalog lookup broadcast in auto mode
+JOIN_STRATEGIES = ["auto", "broadcast", "shuffle"]
+BROADCAST_THRESHOLD_MB = 64
 
-def create_spark_session():
+# Spark session profiles, see profile_config, and the input a shuffle partition is sized for
+SPARK_PROFILES = ["local-dev", "single-node", "cluster"]
+COMMITTERS = ["v2", "directory", "magic"]
+SHUFFLE_PARTITION_MB = 128
+
+# engines the tables can be built with, see duckdb_engine.py, and the largest input auto mode runs without Spark
+ENGINES = ["auto", "spark", "duckdb"]
+DUCKDB_MAX_INPUT_MB = 256
+
+WRITE_MODES = ["full", "incremental"]
+
+
+def profile_config(profile="cluster", cores=None, committer="v2"):
     """
-    Create a Apache Spark session to process the data.
+    Static configuration of a Spark session profile.
+    * local-dev   -- small local runs: local master on every core, no UI,
+                     one shuffle partition per core, a small S3A pool.
+    * single-node -- a whole machine: local master on every core, shuffle
+                     partitions sized from the input, a large S3A pool.
+    * cluster     -- spark-submit decides the master and the resources,
+                     shuffle partitions are sized from the input and the
+                     executors' cores.
+    All of them turn on adaptive query execution (which also coalesces
+        small shuffle partitions and splits skewed joins), the Arrow
+        transfer between the JVM and Python, and vectorized parquet reads,
+        and compute in UTC, as the DuckDB engine does, so the hour, day and
+        month of an event do not depend on the machine's time zone.
     Keyword arguments:
-    * N/A
+    * profile   -- one of SPARK_PROFILES
+    * cores     -- cores of the machine, for the local profiles
+    * committer -- 'v2' for the FileOutputCommitter's algorithm 2, which
+                   renames each task's files once instead of twice;
+                   'directory' or 'magic' for the S3A committers, which
+                   need hadoop-aws 3.1+ and spark-hadoop-cloud
+    Output:
+    * conf      -- dict of the Spark configuration
+    """
+    if profile not in SPARK_PROFILES:
+        raise ValueError("profile must be one of {}".format(", ".join(SPARK_PROFILES)))
+    cores = cores or os.cpu_count() or 1
+
+    conf = {
+        "spark.jars.packages": "org.apache.hadoop:hadoop-aws:{}".format(
+            config.get('SPARK', 'HADOOP_AWS_VERSION', fallback='2.7.0')),
+        "spark.sql.parquet.outputTimestampType": "TIMESTAMP_MICROS",
+        "spark.sql.session.timeZone": "UTC",
+        "spark.sql.adaptive.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.enabled": "true",
+        "spark.sql.adaptive.skewJoin.enabled": "true",
+        "spark.sql.execution.arrow.pyspark.enabled": "true",
+        "spark.sql.parquet.enableVectorizedReader": "true",
+        "spark.sql.parquet.filterPushdown": "true",
+    }
+
+    if profile == "local-dev":
+        conf.update({
+            "spark.master": "local[{}]".format(cores),
+            "spark.ui.enabled": "false",
+            "spark.sql.shuffle.partitions": str(cores),
+            "spark.hadoop.fs.s3a.connection.maximum": "16",
+            "spark.hadoop.fs.s3a.threads.max": "8",
+        })
+    elif profile == "single-node":
+        conf.update({
+            "spark.master": "local[{}]".format(cores),
+            "spark.sql.shuffle.partitions": str(cores * 2),
+            "spark.hadoop.fs.s3a.connection.maximum": str(max(32, cores * 8)),
+            "spark.hadoop.fs.s3a.threads.max": str(max(16, cores * 4)),
+        })
+    else:
+        conf.update({
+            "spark.hadoop.fs.s3a.connection.maximum": "200",
+            "spark.hadoop.fs.s3a.threads.max": "64",
+        })
+
+    if committer == "v2":
+        conf["spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version"] = "2"
+    else:
+        conf.update({
+            "spark.hadoop.fs.s3a.committer.name": committer,
+            "spark.sql.sources.commitProtocolClass":
+                "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol",
+            "spark.sql.parquet.output.committer.class":
+                "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter",
+        })
+    return conf
+
+
+def create_spark_session(profile="cluster", committer="v2"):
+    """
+    Create a Apache Spark session to process the data, configured by
+        profile_config, and print its effective configuration.
+    Keyword arguments:
+    * profile   -- one of SPARK_PROFILES
+    * committer -- output committer, see profile_config
     Output:
     * spark -- An Apache Spark session.
     """
     
-    spark = SparkSession \
-        .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+    builder = SparkSession.builder.appName("sparkify-datalake-{}".format(profile))
+    for key, value in profile_config(profile, committer=committer).items():
+        builder = builder.config(key, value)
+    spark = builder.getOrCreate()
+    log_spark_config(spark, profile)
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def shuffle_partitions_set(spark, profile):
+    """
+    Whether spark.sql.shuffle.partitions was set outside of the profile,
+        with spark-submit --conf or spark-defaults.conf, in which case it is
+        not sized from the input.
+    """
+    key = "spark.sql.shuffle.partitions"
+    return spark.sparkContext.getConf().contains(key) and key not in profile_config(profile)
+
+
+def tune_shuffle_partitions(spark, input_bytes):
+    """
+    Size the shuffle partitions from the input: one per
+        SHUFFLE_PARTITION_MB of input, and at least two per core so that
+        every core has work. Adaptive execution coalesces the ones that
+        turn out small.
+    Keyword arguments:
+    * spark       -- spark session
+    * input_bytes -- size of the JSON input of the run
+    Output:
+    * partitions  -- the number of shuffle partitions set
+    """
+    partitions = max(2 * spark.sparkContext.defaultParallelism,
+                     int(math.ceil(input_bytes / (SHUFFLE_PARTITION_MB * 2 ** 20))))
+    spark.conf.set("spark.sql.shuffle.partitions", str(partitions))
+    print("=====Input of {:.1f} MB, {} shuffle partitions=====".format(input_bytes / 2 ** 20, partitions))
+    return partitions
+
+
+def log_spark_config(spark, profile):
+    """
+    Print the effective configuration of the session, secrets masked,
+        so that a run can be reproduced.
+    """
+    print("=====Spark {} on {}, profile {}=====".format(spark.version, spark.sparkContext.master, profile))
+    for key, value in sorted(spark.sparkContext.getConf().getAll()):
+        if any(secret in key.lower() for secret in ("secret", "password", "access.key", "token")):
+            value = "*****"
+        print("{}={}".format(key, value))
+
+
+def list_files(spark, pattern):
+    """
+    List the files matching a glob pattern through Hadoop's FileSystem API,
+        which works the same on s3a:// and on a local filesystem stand-in.
+    Keyword arguments:
+    * spark   -- reference to Spark session.
+    * pattern -- glob of the files, e.g. s3a://bucket/log_data/2018/11/*.json
+    Output:
+    * files   -- sorted list of (path, size, modification time) of the
+                 matching files.
+    """
+    path = spark._jvm.org.apache.hadoop.fs.Path(pattern)
+    fs = path.getFileSystem(spark._jsc.hadoopConfiguration())
+    statuses = fs.globStatus(path)
+    if statuses is None:
+        return []
+    return sorted((status.getPath().toString(), status.getLen(), status.getModificationTime())
+                  for status in statuses if status.isFile())
+
+
+def list_paths(spark, pattern):
+    """
+    List the paths of the files matching a glob pattern, see list_files.
+    """
+    return [path for path, size, mtime in list_files(spark, pattern)]
+
+
+def path_exists(spark, path):
+    """
+    Check whether a file or directory exists, on s3a:// or locally.
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).exists(hadoop_path)
+
+
+def table_files(spark, path):
+    """
+    List the parquet files of a table directory, recursively, on s3a://
+        or locally.
+    Keyword arguments:
+    * spark -- reference to Spark session.
+    * path  -- directory of the table
+    Output:
+    * files -- dict of path -> (size, modification time) of the files,
+               empty when the directory does not exist
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    fs = hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    files = {}
+    if not fs.exists(hadoop_path):
+        return files
+    listing = fs.listFiles(hadoop_path, True)
+    while listing.hasNext():
+        status = listing.next()
+        if status.getPath().getName().endswith('.parquet'):
+            files[status.getPath().toString()] = (status.getLen(), status.getModificationTime())
+    return files
+
+
+def list_input_logs(spark, input_data, log_data, start_date=None, end_date=None):
+    """
+    List the log files of a run: the daily files of the date range when
+        one is given, see lake_tables.list_log_files, the files of the
+        log_data glob otherwise.
+    Output:
+    * files -- sorted list of (path, size, modification time)
+    """
+    if start_date or end_date:
+        return lake_tables.list_log_files(lambda pattern: list_files(spark, pattern), input_data,
+                                          start_date or end_date, end_date or start_date)
+    return list_files(spark, input_data + log_data)
+
+
+class RunManifest(lake_tables.RunManifest):
+    """
+    The run manifest of lake_tables.RunManifest, read and appended to
+        with Spark.
+    """
+
+    def __init__(self, spark, output_data):
+        """
+        Keyword arguments:
+        * spark       -- spark session
+        * output_data -- path of the tables the manifest belongs to
+        """
+        super().__init__(output_data)
+        self.spark = spark
+        if path_exists(spark, self.path):
+            for row in sorted(spark.read.json(self.path).collect(), key=lambda row: row.loaded_at):
+                self.loaded[row.path] = (row.size, row.modification_time)
+
+    def record(self, files):
+        """
+        Record files as loaded, once the tables built from them are written.
+        Keyword arguments:
+        * files -- list of (path, size, modification time)
+        """
+        if not files:
+            return
+        loaded_at = datetime.now(timezone.utc).isoformat()
+        self.spark.createDataFrame([(path, size, mtime, loaded_at) for path, size, mtime in files],
+                                   "path string, size long, modification_time long, loaded_at string") \
+            .coalesce(1).write.mode('append').json(self.path)
+        self.loaded.update((path, (size, mtime)) for path, size, mtime in files)
+
+
+def storage_level(name):
+    """
+    Look up a storage level by name.
+    Keyword arguments:
+    * name  -- one of STORAGE_LEVELS.
+    Output:
+    * level -- pyspark StorageLevel, None for NONE.
+    """
+    if name not in STORAGE_LEVELS:
+        raise ValueError("storage level must be one of {}".format(", ".join(STORAGE_LEVELS)))
+    return None if name == "NONE" else getattr(StorageLevel, name)
+
+
+def read_json(spark, paths, schema, bad_records="quarantine", quarantine_path=None, level=None):
+    """
+    Read JSON records with a declared schema, so that Spark does not scan
+        the input once more to infer it.
+    Keyword arguments:
+    * spark           -- reference to Spark session.
+    * paths           -- path, glob or list of paths of the JSON files.
+    * schema          -- StructType of the records.
+    * bad_records     -- 'quarantine' to write malformed records to
+                         quarantine_path and go on with the others, 'drop'
+                         to silently skip them, 'fail' to fail the job.
+    * quarantine_path -- where malformed records are appended as JSON.
+    * level           -- StorageLevel the parsed records are persisted
+                         with, so that every table built from them (and
+                         the quarantine write) reads the JSON once; None
+                         to not persist them.
+    Output:
+    * df              -- DataFrame of the well-formed records.
+    """
+    if bad_records not in BAD_RECORD_MODES:
+        raise ValueError("bad_records must be one of {}".format(", ".join(BAD_RECORD_MODES)))
+
+    reader = spark.read.schema(schema).option("mode", BAD_RECORD_MODES[bad_records])
+    if bad_records != "quarantine":
+        df = reader.json(paths)
+        return df.persist(level) if level else df
+
+    df = reader \
+        .schema(StructType(schema.fields + [StructField(CORRUPT_RECORD, StringType())])) \
+        .option("columnNameOfCorruptRecord", CORRUPT_RECORD) \
+        .json(paths)
+    if level:
+        df = df.persist(level)
+
+    # every column is selected, Spark refuses queries on the corrupt record column alone; the quarantine is only
+    # written to when there is a malformed record, rather than with empty part files every run
+    bad = df.filter(col(CORRUPT_RECORD).isNotNull())
+    if bad.take(1):
+        bad.write.mode('append').json(quarantine_path)
+    return df.filter(col(CORRUPT_RECORD).isNull()).drop(CORRUPT_RECORD)
+
+
+def process_song_data(spark, input_data, output_data, song_data="song_data/*/*/*/*.json", bad_records="quarantine",
+                      level=StorageLevel.MEMORY_AND_DISK, target_file_mb=TARGET_FILE_MB, run_manifest=None,
+                      song_files=None):
     """
     Load JSON input data (song_data) from input_data path,
         process the data to extract song_table and artists_table, and
@@ -38,6 +358,22 @@ def process_song_data(spark, input_data, output_data):
     * spark         -- reference to Spark session.
     * input_data    -- path to input_data to be processed (song_data)
     * output_data   -- path to location to store the output (parquet files).
+    * song_data     -- path (or glob) of the song files, relative to input_data.
+    * bad_records   -- handling of malformed records, see read_json;
+                       quarantined ones go to output_data/quarantine.
+    * level         -- StorageLevel of the parsed song records, which the
+                       songs, artists and songplays tables are all built
+                       from; None to recompute them for each table.
+    * target_file_mb -- size the parquet files are planned for, see
+                       write_table.
+    * run_manifest  -- RunManifest of an incremental run: only the song
+                       files it does not have are read, and their songs and
+                       artists are appended to the tables; None to rewrite
+                       the tables from all the song files.
+    * song_files    -- (path, size, modification time) of the song files,
+                       as main listed them; song_data is listed when None.
+                       The listed paths are read rather than the glob, so
+                       the input is listed once.
     Output:
     * songs_table   -- directory with parquet files
                        stored in output_data path.
@@ -46,11 +382,21 @@ def process_song_data(spark, input_data, output_data):
     """
     
     # get filepath to song data file
-    song_data = input_data + "song_data/A/A/A/TRAAAOF128F429C156.json"
+    if song_files is None:
+        song_files = list_files(spark, input_data + song_data)
+    if run_manifest is not None:
+        song_files = run_manifest.new_files(song_files)
+        print("====={} new song files=====".format(len(song_files)))
+        if not song_files:
+            return None, None
+    elif not song_files:
+        raise ValueError("No song files match {}{}".format(input_data, song_data))
+    song_data = [path for path, size, mtime in song_files]
     
     # read song data file
     print("=====Reading Song data=====")
-    df = spark.read.json(song_data)
+    with METRICS.stage('song_data.read', bytes_read=sum(size for path, size, mtime in song_files)):
+        df = read_json(spark, song_data, SONG_SCHEMA, bad_records, output_data + "quarantine/song_data", level)
     df.createOrReplaceTempView("song_data_table")
     
     
@@ -60,8 +406,10 @@ def process_song_data(spark, input_data, output_data):
        
     # write songs table to parquet files partitioned by year and artist
     print("=====Writing Song data=====")
-    songs_table_path = output_data + "songs_table"
-    songs_table.write.partitionBy("year", "artist_id").mode('overwrite').parquet(songs_table_path)
+    with METRICS.stage('songs.write') as stage:
+        bytes_written = save_table(spark, songs_table, output_data, "songs_table", target_file_mb,
+                                   run_manifest is not None)
+        stage.add(rows_out=METRICS.count(songs_table), bytes_written=bytes_written)
 
 
     # extract columns to create artists table
@@ -70,12 +418,21 @@ def process_song_data(spark, input_data, output_data):
     
     # write artists table to parquet files
     print("=====Writing artists data=====")
-    artists_table_path = output_data + "artists_table"     
-    artists_table.write.mode('overwrite').parquet(artists_table_path)
+    with METRICS.stage('artists.write') as stage:
+        bytes_written = save_table(spark, artists_table, output_data, "artists_table", target_file_mb,
+                                   run_manifest is not None)
+        stage.add(rows_out=METRICS.count(artists_table), bytes_written=bytes_written)
+
+    if run_manifest is not None:
+        run_manifest.record(song_files)
     return songs_table, artists_table
 
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, input_data, output_data, log_data='log_data/*/*/*-events.json',
+                     start_date=None, end_date=None, bad_records="quarantine",
+                     level=StorageLevel.MEMORY_AND_DISK, join_strategy="auto",
+                     broadcast_threshold_mb=BROADCAST_THRESHOLD_MB, target_file_mb=TARGET_FILE_MB,
+                     run_manifest=None, log_files=None):
     """
     Load JSON input data (log_data) from input_data path,
         process the data to extract users_table, time_table,
@@ -85,6 +442,31 @@ def process_log_data(spark, input_data, output_data):
     * input_data       -- path to input_data to be processed (log_data)
     * output_data      -- path to location to store the output
                           (parquet files).
+    * log_data         -- path (or glob) of the log files, relative to
+                          input_data; used when no date range is given.
+    * start_date       -- first day of logs to load (datetime.date).
+    * end_date         -- last day of logs to load, inclusive
+                          (datetime.date); with start_date, only the
+                          daily files of the range are listed and read.
+    * bad_records      -- handling of malformed records, see read_json;
+                          quarantined ones go to output_data/quarantine.
+    * level            -- StorageLevel of the parsed log records, which the
+                          users, time and songplays tables are all built
+                          from; None to recompute them for each table.
+    * join_strategy    -- 'auto', 'broadcast' or 'shuffle' join of the song
+                          plays to the song catalog, see songplays_join_hint.
+    * broadcast_threshold_mb -- largest catalog lookup broadcast in auto mode.
+    * target_file_mb   -- size the parquet files are planned for, see
+                          write_table.
+    * run_manifest     -- RunManifest of an incremental run: only the log
+                          files it does not have are read, the users are
+                          appended and the time and songplays partitions
+                          of the new events are rewritten, see save_table;
+                          None to rewrite the tables from all the log files.
+    * log_files        -- (path, size, modification time) of the log files
+                          of the run, as main listed them; listed from the
+                          date range or log_data when None. The listed
+                          paths are read rather than the glob.
     Output:
     * users_table      -- directory with users_table parquet files
                           stored in output_data path.
@@ -95,17 +477,35 @@ def process_log_data(spark, input_data, output_data):
     """
 
     # get filepath to log data file
-    log_data = input_data + 'log_data/2018/11/2018-11-15-events.json'
+    if log_files is None:
+        log_files = list_input_logs(spark, input_data, log_data, start_date, end_date)
+    if start_date or end_date:
+        if not log_files:
+            raise ValueError("No log files between {} and {} in {}".format(start_date or end_date,
+                                                                           end_date or start_date, input_data))
+        print("====={} log files between {} and {}=====".format(len(log_files), start_date or end_date,
+                                                                 end_date or start_date))
+
+    if run_manifest is not None:
+        log_files = run_manifest.new_files(log_files)
+        print("====={} new log files=====".format(len(log_files)))
+        if not log_files:
+            return None, None, None
+    elif not log_files:
+        raise ValueError("No log files match {}{}".format(input_data, log_data))
+    log_data = [path for path, size, mtime in log_files]
 
     
     # read log data file
     print("=====Reading log data=====")
-    df = spark.read.json(log_data)
+    with METRICS.stage('log_data.read', bytes_read=sum(size for path, size, mtime in log_files)):
+        df = read_json(spark, log_data, LOG_SCHEMA, bad_records, output_data + "quarantine/log_data", level)
     
 
-    # filter by actions for song plays
+    # filter by actions for song plays, and derive the start time of every play once for the time and songplays tables
     print("=====Filtering log data=====")
-    df = df.filter(df.page == 'NextSong').filter(df.userId.isNotNull()).filter(df.ts.isNotNull())
+    df = df.filter(df.page == 'NextSong').filter(df.userId.isNotNull()).filter(df.ts.isNotNull()) \
+        .withColumn('start_time', (col('ts') / 1000).cast('timestamp'))
     df.createOrReplaceTempView("log_data_table")
 
     
@@ -115,44 +515,44 @@ def process_log_data(spark, input_data, output_data):
     
     # write users table to parquet files
     print("=====Writing users data=====")
-    users_table_path = output_data + "users_table"
-    users_table.write.mode('overwrite').parquet(users_table_path)
+    with METRICS.stage('users.write') as stage:
+        bytes_written = save_table(spark, users_table, output_data, "users_table", target_file_mb,
+                                   run_manifest is not None)
+        stage.add(rows_out=METRICS.count(users_table), bytes_written=bytes_written)
     
     
-    # extract columns for time table
+    # extract columns for time table, from each distinct start time once
     print("=====Extracting time table columns=====")
-    time_table = spark.sql("""
-                                SELECT 
-                                    TT.time as start_time,
-                                    hour(TT.time) as hour,
-                                    dayofmonth(TT.time) as day,
-                                    weekofyear(TT.time) as week,
-                                    month(TT.time) as month,
-                                    year(TT.time) as year,
-                                    dayofweek(TT.time) as weekday
-                                FROM (
-                                    SELECT 
-                                        to_timestamp(ldt.ts/1000) as time
-                                    FROM log_data_table ldt
-                                    WHERE ldt.ts IS NOT NULL
-                                ) TT
-                            """)
+    time_table = df.select('start_time').distinct().select(
+        'start_time',
+        hour('start_time').alias('hour'),
+        dayofmonth('start_time').alias('day'),
+        weekofyear('start_time').alias('week'),
+        month('start_time').alias('month'),
+        year('start_time').alias('year'),
+        dayofweek('start_time').alias('weekday'))
     
     # write time table to parquet files partitioned by year and month
     print("=====Writing time data=====")
-    time_table_path = output_data + "time_table"
-    time_table.write.partitionBy('year', 'month').mode('overwrite').parquet(time_table_path)
+    with METRICS.stage('time.write') as stage:
+        bytes_written = save_table(spark, time_table, output_data, "time_table", target_file_mb,
+                                   run_manifest is not None)
+        stage.add(rows_out=METRICS.count(time_table), bytes_written=bytes_written)
 
 
 
     # extract columns from joined song and log datasets to create songplays table
     print("=====Extracting songplays table columns=====")
+    # an incremental run may not have read every song file, its lookup comes from the written tables
+    lookup = song_lookup(spark, output_data if run_manifest is not None else None)
+    lookup.createOrReplaceTempView("song_lookup_table")
+    hint = songplays_join_hint(lookup, join_strategy, broadcast_threshold_mb)
     songplays_table = spark.sql("""
-                                    SELECT 
-                                        monotonically_increasing_id() AS songplay_id,
-                                        to_timestamp(logT.ts/1000) AS start_time,
-                                        month(to_timestamp(logT.ts/1000)) AS month,
-                                        year(to_timestamp(logT.ts/1000)) AS year,
+                                    SELECT /*+ {hint}(songT) */
+                                        {songplay_id} AS songplay_id,
+                                        logT.start_time AS start_time,
+                                        month(logT.start_time) AS month,
+                                        year(logT.start_time) AS year,
                                         logT.userId AS user_id,
                                         logT.level AS level,
                                         songT.song_id AS song_id,
@@ -161,22 +561,313 @@ def process_log_data(spark, input_data, output_data):
                                         logT.location AS location,
                                         logT.userAgent AS user_agent
                                     FROM log_data_table logT
-                                    JOIN song_data_table songT 
+                                    JOIN song_lookup_table songT 
                                         ON logT.artist = songT.artist_name 
                                         AND logT.song = songT.title
-                                """)
+                                        AND logT.length = songT.duration
+                                """.format(hint=hint,
+                                           songplay_id=SONGPLAY_ID_SQL.format(user_id='logT.userId',
+                                                                              session_id='logT.sessionId',
+                                                                              item_in_session='logT.itemInSession',
+                                                                              ts='logT.ts')))
         
     
     
     # write songplays table to parquet files partitioned by year and month
     print("=====Writing songplays data=====")
-    songplays_table_path = output_data + "songplays_table"
-    songplays_table.write.partitionBy('year', 'month').mode('overwrite').parquet(songplays_table_path)
-    
+    with METRICS.stage('songplays.write') as stage:
+        bytes_written = save_table(spark, songplays_table, output_data, "songplays_table", target_file_mb,
+                                   run_manifest is not None)
+        stage.add(rows_out=METRICS.count(songplays_table), bytes_written=bytes_written)
+
+    if run_manifest is not None:
+        run_manifest.record(log_files)
     return users_table, time_table, songplays_table
 
 
 
+def planned_files(df, target_file_mb=TARGET_FILE_MB):
+    """
+    Plan how many files a table is written to, from the optimizer's size
+        estimate. The estimate is of the uncompressed rows, so the parquet
+        files come out under the target rather than over it.
+    Keyword arguments:
+    * df             -- DataFrame of the table
+    * target_file_mb -- size of a file, in MB
+    Output:
+    * files          -- number of files, None when the size is not known
+    """
+    size = estimated_size(df)
+    if size is None:
+        return None
+    return max(1, int(math.ceil(size / (target_file_mb * 2 ** 20))))
+
+
+def with_file_number(df, partition_columns, files):
+    """
+    Number the file of its partition directory each row goes to, in a
+        _file column. The rows of a directory are spread over
+        ceil(rows / rows per file) files, rows per file being the rows of
+        the table over the files planned for it, so a large directory
+        gets several files and a small one a single file. The number is a
+        hash of the row rather than a random one, so a retried task puts
+        the rows in the same files.
+    Keyword arguments:
+    * df                -- DataFrame of the table
+    * partition_columns -- columns the table is partitioned by
+    * files             -- number of files planned for the table
+    Output:
+    * df                -- df with the _file column
+    * files             -- number of files over all the directories, at
+                           least the files planned
+    * counts            -- cached rows per partition directory, to
+                           unpersist once df is written
+    """
+    counts = df.groupBy(*partition_columns).count().cache()
+    rows = counts.groupBy().sum('count').first()[0] or 0
+    rows_per_file = max(1, int(math.ceil(rows / files)))
+
+    # null partition values are a directory of their own, hence the null-safe join
+    directories = counts.select(*([col(c).alias('_' + c) for c in partition_columns]
+                                  + [ceil(col('count') / lit(rows_per_file)).alias('_files')]))
+    files = directories.groupBy().sum('_files').first()[0] or 1
+    condition = [df[c].eqNullSafe(directories['_' + c]) for c in partition_columns]
+    numbered = df.join(broadcast(directories), condition) \
+        .withColumn('_file', pmod(row_hash(*df.columns), col('_files'))) \
+        .drop('_files', *['_' + c for c in partition_columns])
+    return numbered, int(files), counts
+
+
+def write_table(df, path, partition_columns=(), target_file_mb=TARGET_FILE_MB, mode="overwrite", files=None,
+                layout=None):
+    """
+    Write a table to parquet files of about target_file_mb each. The rows
+        of a partition directory are spread over as many files as its
+        share of the rows needs, see with_file_number, and repartitioned
+        by the partition columns and that file number, so each file is
+        written by its own task, instead of one file per shuffle partition
+        in every directory or one task for a whole directory; they are
+        sorted by the partition columns, so each task keeps one file open
+        at a time. Within a partition the rows are sorted by the layout's
+        sort columns; an unpartitioned table is range partitioned on them,
+        so the files and row groups cover disjoint ranges. Without a size
+        estimate, every partition directory is written by a single task.
+    Keyword arguments:
+    * df                -- DataFrame of the table
+    * path              -- directory of the table
+    * partition_columns -- columns the table is partitioned by
+    * target_file_mb    -- size of a file, in MB
+    * mode              -- 'overwrite' the table, 'append' to it, or
+                           'dynamic' to only overwrite the partitions df
+                           has rows in
+    * files             -- number of files, planned from the size of df
+                           when None
+    * layout            -- sort columns, row group size and codec, see
+                           TABLE_LAYOUTS
+    """
+    if files is None:
+        files = planned_files(df, target_file_mb)
+    sort_columns = list(layout['sort']) if layout else []
+
+    counts = None
+    if partition_columns and files:
+        df, files, counts = with_file_number(df, partition_columns, files)
+        df = df.repartition(files, *(list(partition_columns) + ['_file'])).drop('_file')
+        df = df.sortWithinPartitions(*(list(partition_columns) + sort_columns))
+    elif partition_columns:
+        df = df.repartition(*partition_columns)
+        df = df.sortWithinPartitions(*(list(partition_columns) + sort_columns))
+    elif sort_columns:
+        df = df.repartitionByRange(files, *sort_columns) if files else df.repartitionByRange(*sort_columns)
+        df = df.sortWithinPartitions(*sort_columns)
+    elif files:
+        df = df.repartition(files)
+
+    writer = df.write.partitionBy(*partition_columns) if partition_columns else df.write
+    if layout:
+        writer = writer.option("compression", layout['codec']) \
+            .option("parquet.block.size", layout['row_group_mb'] * 2 ** 20)
+    if mode == "dynamic":
+        writer = writer.option("partitionOverwriteMode", "dynamic")
+    writer.mode('append' if mode == "append" else 'overwrite').parquet(path)
+    if counts is not None:
+        counts.unpersist()
+
+
+def save_table(spark, df, output_data, table, target_file_mb=TARGET_FILE_MB, incremental=False):
+    """
+    Write one of the TABLES. A full write replaces the table. An
+        incremental write appends the rows with new keys to a dimension
+        table, and rewrites only the year/month partitions of time and
+        songplays that the run has rows in: the rows already there are
+        kept, except those the run replaces with a row of the same key, so
+        loading the same day twice writes the same partitions.
+    Keyword arguments:
+    * spark          -- spark session
+    * df             -- DataFrame of the table
+    * output_data    -- path of the tables
+    * table          -- name of the table, one of TABLES
+    * target_file_mb -- size of a file, in MB
+    * incremental    -- whether the table is merged rather than replaced
+    Output:
+    * bytes_written  -- size of the parquet files the write added or
+                        replaced, from a listing of the table before and
+                        after it
+    """
+    path = output_data + table
+    before = table_files(spark, path)
+    partition_columns, key, layout = PARTITION_COLUMNS[table], TABLE_KEYS[table], table_layout(table)
+
+    if not incremental or not path_exists(spark, path):
+        write_table(df, path, partition_columns, target_file_mb, layout=layout)
+    elif table in APPEND_TABLES:
+        existing = spark.read.parquet(path).select(*key)
+        write_table(df.join(existing, key, 'left_anti'), path, partition_columns, target_file_mb, mode="append",
+                    layout=layout)
+    else:
+        touched = df.select(*partition_columns).distinct()
+        kept = spark.read.parquet(path) \
+            .join(touched, partition_columns, 'left_semi') \
+            .join(df.select(*key), key, 'left_anti')
+        merged = kept.unionByName(df)
+        files = planned_files(merged, target_file_mb)
+        # the partitions are read before they are overwritten, so the merged rows are materialized first
+        write_table(merged.localCheckpoint(), path, partition_columns, target_file_mb, mode="dynamic", files=files,
+                    layout=layout)
+
+    return sum(size for file, (size, mtime) in table_files(spark, path).items() if before.get(file) != (size, mtime))
+
+
+def compact_table(spark, path, target_file_mb=TARGET_FILE_MB, layout=None):
+    """
+    Rewrite the small parquet files of an existing table, one partition
+        directory at a time, into files of about target_file_mb. Directories
+        already at the fewest files their size allows are left alone. The
+        new files are written to a _compaction directory, which readers
+        ignore, and then replace the old ones, so the job should not run
+        while the table is being written.
+    Keyword arguments:
+    * spark          -- spark session
+    * path           -- directory of the table
+    * target_file_mb -- size of a file, in MB
+    * layout         -- sort columns, row group size and codec the files
+                        are rewritten with, see TABLE_LAYOUTS
+    Output:
+    * compacted      -- list of (directory, files before, files after)
+    """
+    Path = spark._jvm.org.apache.hadoop.fs.Path
+    fs = Path(path).getFileSystem(spark._jsc.hadoopConfiguration())
+
+    # parquet files of every partition directory, leftovers of an interrupted compaction aside
+    sizes = {}
+    files = fs.listFiles(Path(path), True)
+    while files.hasNext():
+        status = files.next()
+        name = status.getPath().getName()
+        directory = status.getPath().getParent().toString()
+        if name.endswith('.parquet') and '/_compaction' not in directory:
+            sizes.setdefault(directory, []).append(status.getLen())
+
+    compacted = []
+    for directory, file_sizes in sorted(sizes.items()):
+        target_files = max(1, int(math.ceil(sum(file_sizes) / (target_file_mb * 2 ** 20))))
+        if len(file_sizes) <= target_files:
+            continue
+
+        staging = directory + '/_compaction'
+        write_table(spark.read.parquet(directory), staging, files=target_files, layout=layout)
+
+        for status in fs.listStatus(Path(directory)):
+            if status.isFile() and status.getPath().getName().endswith('.parquet'):
+                fs.delete(status.getPath(), False)
+        for status in fs.listStatus(Path(staging)):
+            if status.getPath().getName().endswith('.parquet'):
+                fs.rename(status.getPath(), Path(directory, status.getPath().getName()))
+        fs.delete(Path(staging), True)
+
+        compacted.append((directory, len(file_sizes), target_files))
+    return compacted
+
+
+def read_tables(spark, output_data):
+    """
+    Read the written tables back from their parquet files, so that
+        validating them does not recompute them from the JSON input.
+    Keyword arguments:
+    * spark       -- spark session
+    * output_data -- path the tables were written to
+    Output:
+    * tables      -- list of (table name, DataFrame) pairs
+    """
+    return [(table, spark.read.parquet(output_data + table)) for table in TABLES]
+
+
+def song_lookup(spark, output_data=None):
+    """
+    Build the song catalog lookup of the songplays join: song_data_table
+        projected to the join key and the ids it resolves, with one row per
+        (title, artist_name, duration), the key the Redshift and Postgres
+        pipelines match song plays on.
+    Keyword arguments:
+    * spark       -- spark session
+    * output_data -- path of the written tables; when given, the lookup is
+                     built from the songs and artists tables instead of the
+                     song files read by the run
+    Output:
+    * lookup      -- DataFrame of title, artist_name, duration, song_id,
+                     artist_id
+    """
+    if output_data is None:
+        songs = spark.table("song_data_table")
+    else:
+        artists = spark.read.parquet(output_data + "artists_table").select('artist_id', 'artist_name')
+        songs = spark.read.parquet(output_data + "songs_table").join(artists, 'artist_id')
+    return songs \
+        .select('title', 'artist_name', 'duration', 'song_id', 'artist_id') \
+        .dropDuplicates(['title', 'artist_name', 'duration'])
+
+
+def estimated_size(df):
+    """
+    Size in bytes the optimizer estimates for a DataFrame. Over persisted
+        data it is the size of the cached blocks; over files it is the size
+        of the input files, which overestimates a projection.
+    Keyword arguments:
+    * df   -- DataFrame
+    Output:
+    * size -- estimated size in bytes, None when it is not available
+    """
+    try:
+        return int(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString())
+    except Exception:
+        return None
+
+
+def songplays_join_hint(lookup, strategy="auto", threshold_mb=BROADCAST_THRESHOLD_MB):
+    """
+    Pick the join hint of the songplays query. The catalog lookup is small
+        next to the events, so broadcasting it avoids shuffling the events;
+        in auto mode it is broadcast only when its estimated size is under
+        the threshold, and shuffled otherwise so executors are not
+        overwhelmed by a large catalog.
+    Keyword arguments:
+    * lookup       -- DataFrame returned by song_lookup
+    * strategy     -- 'auto', 'broadcast' or 'shuffle'
+    * threshold_mb -- largest lookup broadcast in auto mode, in MB
+    Output:
+    * hint         -- 'BROADCAST' or 'MERGE' (sort-merge shuffle join)
+    """
+    if strategy not in JOIN_STRATEGIES:
+        raise ValueError("join strategy must be one of {}".format(", ".join(JOIN_STRATEGIES)))
+    if strategy != "auto":
+        return "BROADCAST" if strategy == "broadcast" else "MERGE"
+
+    size = estimated_size(lookup)
+    hint = "BROADCAST" if size is not None and size <= threshold_mb * 2 ** 20 else "MERGE"
+    print("=====Song lookup estimated at {} bytes, {} join=====".format(size, hint.lower()))
+    return hint
+
+
 def table_schema(spark,table_name):
     """
     Provides schema of table provided.
@@ -221,33 +912,169 @@ def sample_data( spark, table_name):
 
     
     
+def pick_engine(args, input_data, input_bytes=None):
+    """
+    Pick the engine of an auto run: DuckDB when the input the run loads
+        (only the files not in the run manifest yet, in incremental mode) is
+        under --duckdb-max-input-mb, Spark otherwise, or when duckdb or
+        pyarrow are not installed.
+    Keyword arguments:
+    * args        -- parsed command line arguments
+    * input_data  -- root of song_data and log_data
+    * input_bytes -- size of the input when known, listed otherwise
+    Output:
+    * engine      -- 'spark' or 'duckdb'
+    * input_bytes -- size of the input, None when it was not listed
+    """
+    try:
+        import duckdb_engine
+    except ImportError as e:
+        print("====={}, running on Spark=====".format(e))
+        return "spark", input_bytes
+
+    if input_bytes is None:
+        input_bytes = duckdb_engine.input_size(input_data, args.song_data, args.log_data, args.start_date,
+                                               args.end_date,
+                                               args.output_data if args.write_mode == 'incremental' else None)
+    engine = "duckdb" if input_bytes <= args.duckdb_max_input_mb * 2 ** 20 else "spark"
+    print("=====Input of {:.1f} MB, running on {}=====".format(input_bytes / 2 ** 20, engine))
+    return engine, input_bytes
+
+
+def parse_date(value):
+    """
+    Parse a YYYY-MM-DD command line or config value.
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Build the Sparkify data lake tables from song_data and log_data.')
+    parser.add_argument('--input-data', default=config.get('INPUT', 'INPUT_DATA', fallback='s3a://udacity-dend/'),
+                        help='root of song_data and log_data, s3a:// or a local directory')
+    parser.add_argument('--output-data', default=config.get('AWS', 'OUTPUT_DATA'),
+                        help='root of the parquet tables')
+    parser.add_argument('--song-data', default=config.get('INPUT', 'SONG_DATA', fallback='song_data/*/*/*/*.json'),
+                        help='glob of the song files under the input data')
+    parser.add_argument('--log-data', default=config.get('INPUT', 'LOG_DATA', fallback='log_data/*/*/*-events.json'),
+                        help='glob of the log files under the input data, when no date range is given')
+    parser.add_argument('--start-date', type=parse_date, default=parse_date(config.get('INPUT', 'START_DATE', fallback='')),
+                        help='first day of logs to load, YYYY-MM-DD')
+    parser.add_argument('--end-date', type=parse_date, default=parse_date(config.get('INPUT', 'END_DATE', fallback='')),
+                        help='last day of logs to load, YYYY-MM-DD, inclusive')
+    parser.add_argument('--bad-records', choices=sorted(BAD_RECORD_MODES),
+                        default=config.get('INPUT', 'BAD_RECORDS', fallback='quarantine'),
+                        help='quarantine (default): write malformed records to <output-data>/quarantine and go on; '
+                             'drop: skip them; fail: fail the job')
+    parser.add_argument('--storage-level', choices=STORAGE_LEVELS,
+                        default=config.get('SPARK', 'STORAGE_LEVEL', fallback='MEMORY_AND_DISK'),
+                        help='storage level of the parsed song and log records shared by the tables, '
+                             'NONE to not persist them (default: MEMORY_AND_DISK)')
+    parser.add_argument('--songplays-join', choices=JOIN_STRATEGIES,
+                        default=config.get('SPARK', 'SONGPLAYS_JOIN', fallback='auto'),
+                        help='join of the song plays to the song catalog; auto broadcasts the catalog lookup '
+                             'when it is under --broadcast-threshold-mb (default: auto)')
+    parser.add_argument('--broadcast-threshold-mb', type=int,
+                        default=config.getint('SPARK', 'BROADCAST_THRESHOLD_MB', fallback=BROADCAST_THRESHOLD_MB),
+                        help='largest song catalog lookup broadcast in auto mode, in MB (default: {})'
+                             .format(BROADCAST_THRESHOLD_MB))
+    parser.add_argument('--target-file-mb', type=int,
+                        default=config.getint('SPARK', 'TARGET_FILE_MB', fallback=TARGET_FILE_MB),
+                        help='size the parquet files are written and compacted to, in MB (default: {})'
+                             .format(TARGET_FILE_MB))
+    parser.add_argument('--write-mode', choices=WRITE_MODES,
+                        default=config.get('SPARK', 'WRITE_MODE', fallback='full'),
+                        help='full: rewrite the tables from all the input (default); incremental: only load the '
+                             'input files not loaded yet, append new dimension rows and rewrite the year/month '
+                             'partitions of time and songplays they touch')
+    parser.add_argument('--profile', choices=SPARK_PROFILES,
+                        default=config.get('SPARK', 'PROFILE', fallback='cluster'),
+                        help='Spark session profile: local-dev, single-node or cluster (default: cluster)')
+    parser.add_argument('--committer', choices=COMMITTERS,
+                        default=config.get('SPARK', 'COMMITTER', fallback='v2'),
+                        help='output committer: v2 FileOutputCommitter (default), or the directory or magic '
+                             'S3A committer (hadoop-aws 3.1+ and spark-hadoop-cloud)')
+    parser.add_argument('--input-size-mb', type=int, default=None,
+                        help='size of the input the shuffle partitions are sized for, listed when not given')
+    parser.add_argument('--compact', action='store_true',
+                        help='only rewrite the small files of the tables already in --output-data')
+    parser.add_argument('--engine', choices=ENGINES, default=config.get('SPARK', 'ENGINE', fallback='auto'),
+                        help='spark, duckdb (in process, for small inputs), or auto: duckdb when the input is under '
+                             '--duckdb-max-input-mb (default: auto); --compact always runs on Spark')
+    parser.add_argument('--duckdb-max-input-mb', type=int,
+                        default=config.getint('SPARK', 'DUCKDB_MAX_INPUT_MB', fallback=DUCKDB_MAX_INPUT_MB),
+                        help='largest input auto mode runs on duckdb, in MB (default: {})'
+                             .format(DUCKDB_MAX_INPUT_MB))
+    args = parser.parse_args()
+    level = storage_level(args.storage_level)
+
+    input_data = args.input_data.rstrip('/') + '/'
+    output_data = args.output_data
+
+    input_bytes = args.input_size_mb * 2 ** 20 if args.input_size_mb is not None else None
+    engine = "spark" if args.compact else args.engine
+    if engine == "auto":
+        engine, input_bytes = pick_engine(args, input_data, input_bytes)
+    if engine == "duckdb":
+        import duckdb_engine
+        duckdb_engine.run(args, input_data, output_data)
+        return
+
     print("=====Creating Spark Session=====\n")
-    spark = create_spark_session()
-    
-    input_data = "s3a://udacity-dend/"
-    output_data = config['AWS']['OUTPUT_DATA']
+    spark = create_spark_session(args.profile, args.committer)
+
+    # the local-dev profile keeps one shuffle partition per core, and shuffle partitions given to spark-submit are
+    # kept; otherwise they are sized from the input, whose listing is then handed to the jobs for their reads and
+    # metrics rather than listed again (without it, each job lists its own input once)
+    song_files = log_files = None
+    if args.profile != 'local-dev' and not args.compact and not shuffle_partitions_set(spark, args.profile):
+        if input_bytes is None:
+            song_files = list_files(spark, input_data + args.song_data)
+            log_files = list_input_logs(spark, input_data, args.log_data, args.start_date, args.end_date)
+            input_bytes = sum(size for path, size, mtime in song_files + log_files)
+        tune_shuffle_partitions(spark, input_bytes)
+
+    if args.compact:
+        for table in TABLES:
+            print("=====Compacting {}=====".format(table))
+            with METRICS.stage('compact.' + table):
+                for directory, before, after in compact_table(spark, output_data + table, args.target_file_mb,
+                                                              table_layout(table)):
+                    print("{}: {} files -> {}".format(directory, before, after))
+        METRICS.emit()
+        return
     
+    run_manifest = None
+    if args.write_mode == 'incremental':
+        run_manifest = RunManifest(spark, output_data)
+        print("====={} input files already loaded=====".format(len(run_manifest)))
+
     print("=====Processing Song data=====\n")
-    songs_table, artists_table = process_song_data(spark, input_data, output_data)
+    songs_table, artists_table = process_song_data(spark, input_data, output_data, args.song_data,
+                                                   args.bad_records, level, args.target_file_mb, run_manifest,
+                                                   song_files)
     
     print("=====Processing Log data=====\n")
-    users_table, time_table, songplays_table = process_log_data(spark, input_data, output_data)
+    users_table, time_table, songplays_table = process_log_data(spark, input_data, output_data, args.log_data,
+                                                                args.start_date, args.end_date,
+                                                                args.bad_records, level, args.songplays_join,
+                                                                args.broadcast_threshold_mb, args.target_file_mb,
+                                                                run_manifest, log_files)
+    spark.catalog.clearCache()
     print("=====data Processing Complete=====\n")
     
     print("=====check Processed tables and data=====\n")
-    tables = ["songs_table", "artists_table", "users_table", "time_table", "songplays_table"]
-    FinalTables = [songs_table, artists_table, users_table, time_table, songplays_table]
-
-    for index,table in enumerate(tables):
+    for table, written in read_tables(spark, output_data):
         print(table+ " information\n")        
         print(table+ " Schema")
-        table_schema(spark,FinalTables[index])
+        table_schema(spark,written)
         
-        print(table+ " number of rows: "+ str(count_rows(spark, FinalTables[index])))
+        print(table+ " number of rows: "+ str(count_rows(spark, written)))
         
         print(table+" Sample data")
-        sample_data(spark,FinalTables[index])
+        sample_data(spark,written)
+
+    METRICS.emit()
 
 
 if __name__ == "__main__":
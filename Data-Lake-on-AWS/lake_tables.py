@@ -0,0 +1,196 @@
+"""
+Tables of the data lake and the JSON records they are built from, shared by
+the Spark engine (etl.py) and the DuckDB engine (duckdb_engine.py): dl.cfg,
+the stage metrics, the declared input schemas, the tables with their
+partitions, keys and layouts, the log file listing and the run manifest
+bookkeeping. It depends on neither engine, so the DuckDB engine runs without
+pyspark, and both engines read the same config and report to the same
+metrics when etl.py hands a run to duckdb_engine.py.
+"""
+import configparser
+from datetime import datetime, date, timedelta
+import os
+import sys
+
+config = configparser.ConfigParser()
+config.read('dl.cfg')
+
+os.environ['AWS_ACCESS_KEY_ID']=config.get('AWS', 'AWS_ACCESS_KEY_ID')
+os.environ['AWS_SECRET_ACCESS_KEY']=config.get('AWS', 'AWS_SECRET_ACCESS_KEY')
+
+# the stage instrumentation is shared with the other pipelines and lives at the root of the repository
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from etl_metrics import Metrics
+
+METRICS = Metrics.from_env('datalake_etl')
+
+# Declared schemas of the raw JSON records, with the columns of staging_songs and
+# staging_events in Data-Warehouse-on-AWS/sql_queries.py, as (field, Spark type
+# name). Integral fields are longs and NUMERIC ones doubles, the types Spark used
+# to infer, so the parquet tables keep their schema; userId is a string in the
+# logs ("39", "" when logged out).
+CORRUPT_RECORD = "_corrupt_record"
+
+SONG_FIELDS = [
+    ("artist_id", "string"),
+    ("artist_latitude", "double"),
+    ("artist_location", "string"),
+    ("artist_longitude", "double"),
+    ("artist_name", "string"),
+    ("duration", "double"),
+    ("num_songs", "long"),
+    ("song_id", "string"),
+    ("title", "string"),
+    ("year", "long"),
+]
+
+LOG_FIELDS = [
+    ("artist", "string"),
+    ("auth", "string"),
+    ("firstName", "string"),
+    ("gender", "string"),
+    ("itemInSession", "long"),
+    ("lastName", "string"),
+    ("length", "double"),
+    ("level", "string"),
+    ("location", "string"),
+    ("method", "string"),
+    ("page", "string"),
+    ("registration", "double"),
+    ("sessionId", "long"),
+    ("song", "string"),
+    ("status", "long"),
+    ("ts", "long"),
+    ("userAgent", "string"),
+    ("userId", "string"),
+]
+
+# what to do with records that do not parse against the schema
+BAD_RECORD_MODES = {"quarantine": "PERMISSIVE", "drop": "DROPMALFORMED", "fail": "FAILFAST"}
+
+# the tables written under output_data, with their partition columns
+TABLES = ["songs_table", "artists_table", "users_table", "time_table", "songplays_table"]
+PARTITION_COLUMNS = {
+    "songs_table": ["year", "artist_id"],
+    "artists_table": [],
+    "users_table": [],
+    "time_table": ["year", "month"],
+    "songplays_table": ["year", "month"],
+}
+
+# size the parquet files of the tables are planned and compacted to
+TARGET_FILE_MB = 128
+
+# key of each table's rows; in the incremental write mode the dimension tables only get rows with new keys,
+# and the partitions of time and songplays touched by a run are rewritten with the new rows replacing old ones
+TABLE_KEYS = {
+    "songs_table": ["song_id"],
+    "artists_table": ["artist_id"],
+    "users_table": ["userId"],
+    "time_table": ["start_time"],
+    "songplays_table": ["songplay_id"],
+}
+APPEND_TABLES = ["songs_table", "artists_table", "users_table"]
+
+# parquet layout of each table: the columns rows are sorted by within a partition, so that row group min/max
+# statistics let readers skip row groups on them, the row group size and the compression codec; overridable in
+# the [LAYOUT] section of dl.cfg, e.g. songplays_table.sort = user_id, start_time
+TABLE_LAYOUTS = {
+    "songs_table": {"sort": ["song_id"], "row_group_mb": 128, "codec": "snappy"},
+    "artists_table": {"sort": ["artist_id"], "row_group_mb": 128, "codec": "snappy"},
+    "users_table": {"sort": ["userId"], "row_group_mb": 128, "codec": "snappy"},
+    "time_table": {"sort": ["start_time"], "row_group_mb": 64, "codec": "snappy"},
+    "songplays_table": {"sort": ["user_id", "start_time"], "row_group_mb": 64, "codec": "snappy"},
+}
+
+
+def table_layout(table):
+    """
+    Look up the parquet layout of a table, with the overrides of the
+        [LAYOUT] section of dl.cfg.
+    Keyword arguments:
+    * table  -- name of the table, one of TABLES
+    Output:
+    * layout -- dict of sort (list of columns), row_group_mb and codec
+    """
+    layout = dict(TABLE_LAYOUTS[table])
+    if config.has_option('LAYOUT', table + '.sort'):
+        layout['sort'] = [column.strip() for column in config.get('LAYOUT', table + '.sort').split(',')
+                          if column.strip()]
+    if config.has_option('LAYOUT', table + '.row_group_mb'):
+        layout['row_group_mb'] = config.getint('LAYOUT', table + '.row_group_mb')
+    if config.has_option('LAYOUT', table + '.codec'):
+        layout['codec'] = config.get('LAYOUT', table + '.codec')
+    return layout
+
+
+def list_log_files(lister, input_data, start_date, end_date, log_prefix="log_data"):
+    """
+    List the daily log files of a date range. Log files are laid out as
+        log_data/<year>/<month>/<year>-<month>-<day>-events.json, so only
+        the month prefixes of the range are listed, one listing per month,
+        instead of the whole log_data tree.
+    Keyword arguments:
+    * lister      -- function listing the files of a glob as
+                     (path, size, modification time), the engine's
+                     list_files.
+    * input_data  -- path to input_data to be processed.
+    * start_date  -- first day to load (datetime.date).
+    * end_date    -- last day to load, inclusive (datetime.date).
+    * log_prefix  -- directory of the log files under input_data.
+    Output:
+    * files       -- sorted list of (path, size, modification time) of the
+                     log files of the range.
+    """
+    files = []
+    month = date(start_date.year, start_date.month, 1)
+    while month <= end_date:
+        pattern = "{}{}/{:%Y}/{:%m}/*-events.json".format(input_data, log_prefix, month, month)
+        for path, size, mtime in lister(pattern):
+            try:
+                day = datetime.strptime(path.rsplit('/', 1)[-1][:10], '%Y-%m-%d').date()
+            except ValueError:
+                continue
+            if start_date <= day <= end_date:
+                files.append((path, size, mtime))
+        month = (month + timedelta(days=32)).replace(day=1)
+    return files
+
+
+class RunManifest:
+    """
+    Input files already loaded into the tables by incremental runs, with
+        their size and modification time, kept as JSON records under
+        output_data/_run_manifest. A rerun over the same files finds no new
+        ones and does nothing; a file that changed is loaded again. Each
+        engine reads the records into loaded and appends to them in record.
+    """
+
+    def __init__(self, output_data):
+        """
+        Keyword arguments:
+        * output_data -- path of the tables the manifest belongs to
+        """
+        self.path = output_data + "_run_manifest"
+        self.loaded = {}
+
+    def __len__(self):
+        return len(self.loaded)
+
+    def new_files(self, files):
+        """
+        Keep the files that were not loaded yet, or changed since.
+        Keyword arguments:
+        * files -- list of (path, size, modification time)
+        Output:
+        * files -- the new or changed ones
+        """
+        return [(path, size, mtime) for path, size, mtime in files if self.loaded.get(path) != (size, mtime)]
+
+    def record(self, files):
+        """
+        Record files as loaded, once the tables built from them are written.
+        Keyword arguments:
+        * files -- list of (path, size, modification time)
+        """
+        raise NotImplementedError
@@ -0,0 +1,106 @@
+import argparse
+from bisect import bisect_left, bisect_right
+from py4j.java_gateway import JavaObject
+from etl import config, create_spark_session, TABLES, table_layout
+
+
+def footer_statistics(spark, path):
+    """
+    Read the row group statistics of every parquet file of a table from
+        the file footers, through the parquet-hadoop classes Spark ships
+        with, so it works on s3a:// and on a local directory alike.
+    Keyword arguments:
+    * spark -- spark session
+    * path  -- directory of the table
+    Output:
+    * stats -- dict of column -> list of (min, max) per row group, None
+               for a row group without min/max statistics on the column
+    * files -- number of parquet files read
+    """
+    jvm = spark._jvm
+    conf = spark._jsc.hadoopConfiguration()
+    table = jvm.org.apache.hadoop.fs.Path(path)
+    fs = table.getFileSystem(conf)
+
+    stats, files = {}, 0
+    listing = fs.listFiles(table, True)
+    while listing.hasNext():
+        file_path = listing.next().getPath()
+        # _compaction and _temporary directories are not part of the table
+        relative = file_path.toString().split('/' + table.getName() + '/', 1)[-1]
+        if not file_path.getName().endswith('.parquet') or relative.startswith('_') or '/_' in relative:
+            continue
+        files += 1
+
+        reader = jvm.org.apache.parquet.hadoop.ParquetFileReader.open(
+            jvm.org.apache.parquet.hadoop.util.HadoopInputFile.fromPath(file_path, conf))
+        try:
+            for block in reader.getFooter().getBlocks():
+                for chunk in block.getColumns():
+                    column = chunk.getPath().toDotString()
+                    statistics = chunk.getStatistics()
+                    if statistics is None or not statistics.hasNonNullValue():
+                        stats.setdefault(column, []).append(None)
+                    else:
+                        stats.setdefault(column, []).append((plain(statistics.genericGetMin()),
+                                                             plain(statistics.genericGetMax())))
+        finally:
+            reader.close()
+    return stats, files
+
+
+def plain(value):
+    """
+    Convert a statistic read through py4j to a comparable python value;
+        strings come back as parquet Binary objects.
+    """
+    return value.toStringUsingUTF8() if isinstance(value, JavaObject) else value
+
+
+def coverage(ranges):
+    """
+    Summarize how useful the statistics of a column are to skip row groups.
+    Keyword arguments:
+    * ranges -- (min, max) of each row group, None without statistics
+    Output:
+    * with_stats -- share of row groups with min/max statistics
+    * point_scan -- average share of the row groups an equality predicate
+                    on one of the column's values has to read; 1 / row
+                    groups when the ranges do not overlap, 1.0 when every
+                    range overlaps every other one
+    """
+    known = [r for r in ranges if r is not None]
+    if not ranges or not known:
+        return 0.0, 1.0
+
+    mins = sorted(r[0] for r in known)
+    maxs = sorted(r[1] for r in known)
+    unknown = len(ranges) - len(known)
+    # row groups whose range contains the value, plus those that cannot be skipped for lack of statistics
+    read = [bisect_right(mins, r[0]) - bisect_left(maxs, r[0]) + unknown for r in known]
+    return len(known) / len(ranges), sum(read) / len(read) / len(ranges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the row group statistics coverage of the data lake tables.')
+    parser.add_argument('--output-data', default=config.get('AWS', 'OUTPUT_DATA'),
+                        help='root of the parquet tables')
+    parser.add_argument('--tables', nargs='+', choices=TABLES, default=TABLES)
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    for table in args.tables:
+        stats, files = footer_statistics(spark, args.output_data + table)
+        sort_columns = table_layout(table)['sort']
+        row_groups = max((len(ranges) for ranges in stats.values()), default=0)
+        print("====={}: {} files, {} row groups, sorted by {}=====".format(
+            table, files, row_groups, ", ".join(sort_columns) or "nothing"))
+        print("{:<20} {:>12} {:>12}".format("column", "with stats", "point scan"))
+        for column, ranges in sorted(stats.items(), key=lambda item: (item[0] not in sort_columns, item[0])):
+            with_stats, point_scan = coverage(ranges)
+            print("{:<20} {:>11.0%} {:>11.1%}".format(column, with_stats, point_scan))
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,39 @@
+import os
+import sys
 import configparser
 import psycopg2
 from sql_queries import copy_table_queries, insert_table_queries,test_queries
+from sql_queries import copy_table_names, insert_table_names
 import pandas as pd
 
+# the stage instrumentation is shared with the other pipelines and lives at the root of the repository
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from etl_metrics import Metrics
+
+METRICS = Metrics.from_env('redshift_etl')
+
 
 """
 Load/Copy data from storage
 """
 def load_staging_tables(cur, conn):
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+    for table, query in zip(copy_table_names, copy_table_queries):
+        with METRICS.stage('copy.' + table) as stage:
+            cur.execute(query)
+            conn.commit()
+            # Redshift's COPY does not report a rowcount, the session keeps it
+            cur.execute("SELECT pg_last_copy_count()")
+            stage.add(rows_out = cur.fetchone()[0])
 
 """
 Insert data into Fact/Dimention tables
 """
 def insert_tables(cur, conn):
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+    for table, query in zip(insert_table_names, insert_table_queries):
+        with METRICS.stage('insert.' + table) as stage:
+            cur.execute(query)
+            stage.add(rows_out = cur.rowcount)
+            conn.commit()
 
 """
 Test data warehouse tables for data records
@@ -49,6 +64,7 @@ def main():
     test_tables(conn)
 
     conn.close()
+    METRICS.emit()
 
 
 if __name__ == "__main__":
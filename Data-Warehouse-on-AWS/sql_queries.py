@@ -1,5 +1,11 @@
+import os
+import sys
 import configparser
 
+# the songplay_id expression is shared with the other pipelines and lives at the root of the repository
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from songplay_key import REDSHIFT_SQL as SONGPLAY_ID_SQL
+
 
 # CONFIG
 config = configparser.ConfigParser()
@@ -55,7 +61,7 @@ staging_songs_table_create = ("""
 
 songplay_table_create = ("""
                         CREATE TABLE IF NOT EXISTS songplays (
-                        songplay_id INT IDENTITY(1,1) PRIMARY KEY, 
+                        songplay_id BIGINT PRIMARY KEY, 
                         start_time TIMESTAMP NOT NULL, 
                         user_id INT NOT NULL, 
                         level VARCHAR, 
@@ -123,8 +129,11 @@ staging_songs_copy = ("""
 
 # FINAL TABLES
 
+# songplay_id is derived from the event's natural key, plays already in songplays are not inserted again;
+# songs sharing a title, artist name and duration are matched to the one with the lowest song_id, so a play is one row
 songplay_table_insert = ("""
                         INSERT INTO songplays(
+                        songplay_id,
                         start_time,
                         user_id,
                         level,
@@ -134,20 +143,31 @@ songplay_table_insert = ("""
                         location,
                         user_agent) 
 
-                        SELECT DISTINCT TIMESTAMP 'epoch' + e.ts/1000 * interval '1 second' AS start_time, 
-                        e.userId AS user_id,  
-                        e.level,  
-                        s.song_id,  
-                        s.artist_id,  
-                        e.sessionId AS session_id,  
-                        s.artist_location AS location,  
-                        e.userAgent AS user_agent 
-
-                        FROM staging_songs s 
-                        RIGHT JOIN staging_events e 
-                        ON s.title = e.song  AND s.artist_name = e.artist AND s.duration = e.length 
-                        WHERE page = 'NextSong'
-                        """)
+                        SELECT DISTINCT plays.*
+                        FROM (
+                            SELECT {songplay_id} AS songplay_id,
+                            TIMESTAMP 'epoch' + e.ts/1000 * interval '1 second' AS start_time, 
+                            e.userId AS user_id,  
+                            e.level,  
+                            s.song_id,  
+                            s.artist_id,  
+                            e.sessionId AS session_id,  
+                            s.artist_location AS location,  
+                            e.userAgent AS user_agent 
+
+                            FROM (
+                                SELECT song_id, title, artist_id, artist_name, artist_location, duration,
+                                ROW_NUMBER() OVER (PARTITION BY title, artist_name, duration ORDER BY song_id) AS match
+                                FROM staging_songs
+                            ) s 
+                            RIGHT JOIN staging_events e 
+                            ON s.title = e.song  AND s.artist_name = e.artist AND s.duration = e.length AND s.match = 1
+                            WHERE page = 'NextSong'
+                        ) plays
+                        LEFT JOIN songplays p ON p.songplay_id = plays.songplay_id
+                        WHERE p.songplay_id IS NULL
+                        """).format(songplay_id=SONGPLAY_ID_SQL.format(user_id='e.userId', session_id='e.sessionId',
+                                                                       item_in_session='e.itemInSession', ts='e.ts'))
 
 user_table_insert = ("""
                     INSERT INTO users (
@@ -238,5 +258,7 @@ time_table_test      = "SELECT * FROM time LIMIT 5"
 create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
+copy_table_names = ['staging_events', 'staging_songs']
 insert_table_queries = [ user_table_insert, song_table_insert,songplay_table_insert, artist_table_insert, time_table_insert]
+insert_table_names = ['users', 'songs', 'songplays', 'artists', 'time']
 test_queries = [songplays_table_test, users_table_test, songs_table_test, artists_table_test, time_table_test]
@@ -1,13 +1,14 @@
-CREATE TABLE public.artists (
+CREATE TABLE public.artist (
 	artistid varchar(256) NOT NULL,
 	name varchar(256),
 	location varchar(256),
 	lattitude numeric(18,0),
-	longitude numeric(18,0)
+	longitude numeric(18,0),
+	CONSTRAINT artist_pkey PRIMARY KEY (artistid)
 );
 
-CREATE TABLE public.songplays (
-	playid varchar(32) NOT NULL,
+CREATE TABLE public.songplay (
+	playid int8 NOT NULL,
 	start_time timestamp NOT NULL,
 	userid int4 NOT NULL,
 	"level" varchar(256),
@@ -16,16 +17,16 @@ CREATE TABLE public.songplays (
 	sessionid int4,
 	location varchar(256),
 	user_agent varchar(256),
-	CONSTRAINT songplays_pkey PRIMARY KEY (playid)
+	CONSTRAINT songplay_pkey PRIMARY KEY (playid)
 );
 
-CREATE TABLE public.songs (
+CREATE TABLE public.song (
 	songid varchar(256) NOT NULL,
 	title varchar(256),
 	artistid varchar(256),
 	"year" int4,
 	duration numeric(18,0),
-	CONSTRAINT songs_pkey PRIMARY KEY (songid)
+	CONSTRAINT song_pkey PRIMARY KEY (songid)
 );
 
 CREATE TABLE public.staging_events (
@@ -49,17 +50,14 @@ CREATE TABLE public.staging_events (
 	userid int4
 );
 
-CREATE TABLE public.staging_songs (
-	num_songs int4,
-	artist_id varchar(256),
-	artist_name varchar(256),
-	artist_latitude numeric(18,0),
-	artist_longitude numeric(18,0),
-	artist_location varchar(256),
-	song_id varchar(256),
-	title varchar(256),
-	duration numeric(18,0),
-	"year" int4
+CREATE TABLE public.staging_plays (
+	start_time timestamp NOT NULL,
+	ts int8 NOT NULL,
+	userid int4,
+	firstname varchar(256),
+	lastname varchar(256),
+	gender varchar(256),
+	"level" varchar(256)
 );
 
 CREATE TABLE public.staging_songs (
@@ -84,7 +82,13 @@ CREATE TABLE public.users (
 	CONSTRAINT users_pkey PRIMARY KEY (userid)
 );
 
-
-
-
-
+CREATE TABLE public."time" (
+	start_time timestamp NOT NULL,
+	"hour" int4,
+	"day" int4,
+	week int4,
+	"month" int4,
+	"year" int4,
+	weekday int4,
+	CONSTRAINT time_pkey PRIMARY KEY (start_time)
+);
@@ -3,7 +3,7 @@ import os
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
-                                LoadDimensionOperator, DataQualityOperator)
+                                LoadDimensionsOperator, DataQualityOperator)
 from helpers import SqlQueries
 
 # AWS_KEY = os.environ.get('AWS_KEY')
@@ -34,7 +34,11 @@ stage_events_to_redshift = StageToRedshiftOperator(
     provide_context=False,
     dag=dag,
     table = "staging_events",
-    s3_path = "s3://udacity-dend/log_data",
+    s3_path = "s3://udacity-dend",
+    # only the log file of the run's day is staged, not the whole of log_data
+    s3_key = "log_data/{{ execution_date.strftime('%Y/%m') }}/{{ ds }}-events",
+    # the listed files of the slice are copied through a manifest, written to a bucket of ours
+    manifest_path = "s3://{{ var.value.manifest_bucket }}/manifests",
     redshift_conn_id="redshift",
     aws_conn_id="aws_credentials",
     region="us-west-2",
@@ -59,50 +63,41 @@ load_songplays_table = LoadFactOperator(
     redshift_conn_id="redshift",
     table="songplay",
     sql="songplay_table_insert",
-    append_only=False
+    mode="merge",
+    key=["playid"]
 )
 
-load_user_dimension_table = LoadDimensionOperator(
-    task_id='Load_user_dim_table',
+# the four dimension tables are loaded concurrently by one task, over at most four connections
+load_dimension_tables = LoadDimensionsOperator(
+    task_id='Load_dimension_tables',
     dag=dag,
     redshift_conn_id="redshift",
-    table="users",
-    sql="user_table_insert",
-    append_only=False
-)
-
-load_song_dimension_table = LoadDimensionOperator(
-    task_id='Load_song_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    table="song",
-    sql="song_table_insert",
-    append_only=False
-)
-
-load_artist_dimension_table = LoadDimensionOperator(
-    task_id='Load_artist_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    table="artist",
-    sql="artist_table_insert",
-    append_only=False
-)
-
-load_time_dimension_table = LoadDimensionOperator(
-    task_id='Load_time_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    table="time",
-    sql="time_table_insert",
-    append_only=False
+    max_connections=4,
+    # the plays of staging_events are scanned once, for the users and time tables
+    prepare=["staging_plays_load"],
+    dimensions=[
+        {"table": "users", "sql": "user_table_insert", "mode": "merge", "key": ["userid"]},
+        {"table": "song", "sql": "song_table_insert", "mode": "merge", "key": ["songid"]},
+        {"table": "artist", "sql": "artist_table_insert", "mode": "merge", "key": ["artistid"]},
+        # the time query leaves out the start times already loaded, so its rows are only appended
+        {"table": "time", "sql": "time_table_insert", "mode": "append"}
+    ]
 )
 
 run_quality_checks = DataQualityOperator(
     task_id='Run_data_quality_checks',
     dag=dag,
     redshift_conn_id="redshift",
-    tables=["songplay", "users", "song", "artist", "time"]
+    # one aggregate query per table; songid and artistid are null for the plays of songs missing from song_data
+    checks={
+        "songplay": {"max_null_rate": {"start_time": 0, "userid": 0}, "unique": "playid",
+                     "references": {"userid": "users.userid", "songid": "song.songid",
+                                    "artistid": "artist.artistid", "start_time": "time.start_time"}},
+        "users": {"max_null_rate": {"userid": 0}, "unique": "userid"},
+        "song": {"max_null_rate": {"songid": 0}, "unique": "songid", "references": {"artistid": "artist.artistid"}},
+        "artist": {"max_null_rate": {"artistid": 0}, "unique": "artistid"},
+        "time": {"max_null_rate": {"start_time": 0}, "unique": "start_time"}
+    }
 )
 
 end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
@@ -110,8 +105,5 @@ end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
 # Task dependencies
 start_operator >> stage_events_to_redshift >> load_songplays_table
 start_operator >> stage_songs_to_redshift >> load_songplays_table
-load_songplays_table >> load_user_dimension_table >> run_quality_checks
-load_songplays_table >> load_song_dimension_table >> run_quality_checks
-load_songplays_table >> load_artist_dimension_table >> run_quality_checks
-load_songplays_table >> load_time_dimension_table >> run_quality_checks
+load_songplays_table >> load_dimension_tables >> run_quality_checks
 run_quality_checks >> end_operator
\ No newline at end of file
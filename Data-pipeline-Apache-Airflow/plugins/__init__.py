@@ -12,6 +12,7 @@ class UdacityPlugin(AirflowPlugin):
         operators.StageToRedshiftOperator,
         operators.LoadFactOperator,
         operators.LoadDimensionOperator,
+        operators.LoadDimensionsOperator,
         operators.DataQualityOperator
     ]
     helpers = [
@@ -1,7 +1,24 @@
 class SqlQueries:
+    # how LoadFactOperator and LoadDimensionOperator load a table from its query, see load_statements
+    load_modes = ("append", "delete-load", "merge")
+
+    # start time of an event, in whole seconds, shared by the songplay and time queries so that their keys match
+    start_time = "TIMESTAMP 'epoch' + ts/1000 * interval '1 second'"
+
+    # playid is derived from the natural key of the event like in the other pipelines: a copy of
+    # songplay_key.REDSHIFT_SQL at the root of the repository, which the plugins are deployed without, over the
+    # columns of staging_events (tests/test_postgres_standin.py checks that they match)
+    songplay_id = ("STRTOL(SUBSTRING(MD5("
+                   "CAST(CAST(events.userid AS BIGINT) AS VARCHAR) || '|' || "
+                   "CAST(CAST(events.sessionid AS BIGINT) AS VARCHAR) || '|' || "
+                   "CAST(CAST(events.iteminsession AS BIGINT) AS VARCHAR) || '|' || "
+                   "CAST(CAST(events.ts AS BIGINT) AS VARCHAR)), 1, 15), 16)")
+
+    # an event staged twice and songs sharing a title, artist name and duration are matched once, so a play is a
+    # single row with its playid
     songplay_table_insert = ("""
         SELECT
-                md5(events.sessionid || events.start_time) songplay_id,
+                {songplay_id} songplay_id,
                 events.start_time, 
                 events.userid, 
                 events.level, 
@@ -10,19 +27,40 @@ class SqlQueries:
                 events.sessionid, 
                 events.location, 
                 events.useragent
-                FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, *
+                FROM (SELECT DISTINCT {start_time} AS start_time, *
             FROM staging_events
             WHERE page='NextSong') events
-            LEFT JOIN staging_songs songs
+            LEFT JOIN (SELECT song_id, title, artist_id, artist_name, duration
+                FROM (SELECT song_id, title, artist_id, artist_name, duration,
+                             ROW_NUMBER() OVER (PARTITION BY title, artist_name, duration ORDER BY song_id) AS row_in_key
+                    FROM staging_songs) matches
+                WHERE row_in_key = 1) songs
             ON events.song = songs.title
                 AND events.artist = songs.artist_name
                 AND events.length = songs.duration
-    """)
+    """).format(songplay_id=songplay_id, start_time=start_time)
 
-    user_table_insert = ("""
-        SELECT distinct userid, firstname, lastname, gender, level
+    # the distinct plays of staging_events with their start time, scanned once for the users and time tables rather
+    # than once by each of their queries; a table rather than a temporary one, so that the connections loading the
+    # tables concurrently all see it (see LoadDimensionsOperator's prepare)
+    staging_plays_load = [
+        "DELETE FROM staging_plays",
+        """
+        INSERT INTO staging_plays (start_time, ts, userid, firstname, lastname, gender, level)
+        SELECT DISTINCT {start_time}, ts, userid, firstname, lastname, gender, level
         FROM staging_events
-        WHERE page='NextSong'
+        WHERE page='NextSong' AND ts IS NOT NULL
+        """.format(start_time=start_time)
+    ]
+
+    # one row per user, with the level of its latest play, so that a merge on userid gets a single row
+    user_table_insert = ("""
+        SELECT userid, firstname, lastname, gender, level
+        FROM (SELECT userid, firstname, lastname, gender, level,
+                     ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS row_in_key
+            FROM staging_plays
+            WHERE userid IS NOT NULL) users
+        WHERE row_in_key = 1
     """)
 
     song_table_insert = ("""
@@ -30,13 +68,94 @@ class SqlQueries:
         FROM staging_songs
     """)
 
+    # songs of the same artist may spell its name or location differently, one row per artist_id is kept
     artist_table_insert = ("""
-        SELECT distinct artist_id, artist_name, artist_location, artist_latitude, artist_longitude
-        FROM staging_songs
+        SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+        FROM (SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+                     ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name, artist_location) AS row_in_key
+            FROM staging_songs
+            WHERE artist_id IS NOT NULL) artists
+        WHERE row_in_key = 1
     """)
 
+    # the distinct start times of the staged plays only, less those already in the time table, so it is loaded in
+    # append mode and a run costs the size of its slice rather than of songplay; dow is Redshift's and Postgres'
     time_table_insert = ("""
-        SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
-               extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
-        FROM songplays
-    """)
\ No newline at end of file
+        SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time),
+               extract(month from start_time), extract(year from start_time), extract(dow from start_time)
+        FROM (SELECT DISTINCT start_time
+            FROM staging_plays) times
+        WHERE NOT EXISTS (SELECT 1 FROM time WHERE time.start_time = times.start_time)
+    """)
+
+    @staticmethod
+    def load_statements(table, select, mode="delete-load", key=()):
+        """
+        Statements loading the rows of a query into a table, all run in one transaction:
+        * append      -- inserts the rows
+        * delete-load -- deletes every row of the table and inserts the rows
+        * merge       -- loads the rows into a temporary table, deletes the rows of the table with the same key and
+                         inserts the new ones, so only the rows of the keys the query returns are rewritten
+
+        Keyword arguments:
+        * table  -- table to load
+        * select -- query of the rows, with the columns of the table in order
+        * mode   -- one of load_modes
+        * key    -- columns of the table's natural key, for merge
+        """
+        if mode not in SqlQueries.load_modes:
+            raise ValueError("Load mode must be one of {}".format(", ".join(SqlQueries.load_modes)))
+        if mode == "append":
+            return ["INSERT INTO {} {}".format(table, select)]
+        if mode == "delete-load":
+            return ["DELETE FROM {}".format(table),
+                    "INSERT INTO {} {}".format(table, select)]
+
+        if not key:
+            raise ValueError("A merge into {} needs the columns of its key".format(table))
+        stage = "{}_merge".format(table)
+        return ["CREATE TEMP TABLE {} (LIKE {})".format(stage, table),
+                "INSERT INTO {} {}".format(stage, select),
+                "DELETE FROM {table} USING {stage} WHERE {match}".format(
+                    table=table, stage=stage,
+                    match=" AND ".join("{0}.{2} = {1}.{2}".format(table, stage, column) for column in key)),
+                "INSERT INTO {} SELECT * FROM {}".format(table, stage),
+                "DROP TABLE {}".format(stage)]
+
+    @staticmethod
+    def quality_check_query(table, spec):
+        """
+        One aggregate query running every data quality check of a table in a single scan, with the dimension keys
+        its columns reference joined in.
+        Returns the query and its checks, one per column of its single row, in order, as dicts of
+        * check  -- row_count, null_rate (the number of null values, divided by the row count by the caller),
+                    duplicates (non-null values also found in another row) or orphans (non-null values not found in
+                    the referenced table)
+        * column -- column checked, None for row_count
+
+        Keyword arguments:
+        * table -- table to check
+        * spec  -- dict of the checks: min_rows, max_null_rate (dict column -> highest share of null values),
+                   unique (column of the primary key) and references (dict column -> 'table.column' it must be found in)
+        """
+        checks = [{"check": "row_count", "column": None}]
+        columns = ["COUNT(*)"]
+        for column in spec.get("max_null_rate", {}):
+            checks.append({"check": "null_rate", "column": column})
+            columns.append("SUM(CASE WHEN checked.{0} IS NULL THEN 1 ELSE 0 END)".format(column))
+        if spec.get("unique"):
+            checks.append({"check": "duplicates", "column": spec["unique"]})
+            columns.append("COUNT(checked.{0}) - COUNT(DISTINCT checked.{0})".format(spec["unique"]))
+
+        joins = []
+        for i, (column, reference) in enumerate(spec.get("references", {}).items()):
+            ref_table, ref_column = reference.split(".")
+            # distinct keys, so a duplicated dimension key does not multiply the rows of the checked table
+            joins.append("LEFT JOIN (SELECT DISTINCT {1} FROM {0}) ref{2} ON checked.{3} = ref{2}.{1}".format(
+                ref_table, ref_column, i, column))
+            checks.append({"check": "orphans", "column": column})
+            columns.append("SUM(CASE WHEN checked.{0} IS NOT NULL AND ref{1}.{2} IS NULL THEN 1 ELSE 0 END)".format(
+                column, i, ref_column))
+
+        query = "SELECT {} FROM {} checked {}".format(", ".join(columns), table, " ".join(joins))
+        return query.strip(), checks
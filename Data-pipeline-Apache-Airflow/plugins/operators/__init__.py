@@ -1,11 +1,13 @@
 from operators.stage_redshift import StageToRedshiftOperator
 from operators.load_fact import LoadFactOperator
 from operators.load_dimension import LoadDimensionOperator
+from operators.load_dimensions import LoadDimensionsOperator
 from operators.data_quality import DataQualityOperator
 
 __all__ = [
     'StageToRedshiftOperator',
     'LoadFactOperator',
     'LoadDimensionOperator',
+    'LoadDimensionsOperator',
     'DataQualityOperator'
 ]
@@ -1,8 +1,23 @@
+import time
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers import SqlQueries
 
 class DataQualityOperator(BaseOperator):
+    """
+    Runs declarative data quality checks, with one aggregate query per table over a single connection, see
+    SqlQueries.quality_check_query.
+
+    checks is a dict of table -> dict of its checks:
+    * min_rows      -- least number of rows, 1 by default
+    * max_null_rate -- dict of column -> highest share of its values that may be null
+    * unique        -- primary key column, which must not have duplicate values
+    * references    -- dict of column -> 'table.column' every non-null value must be found in
+    tables lists tables checked for min_rows only. Every check is run before the task fails on the ones that did
+    not pass; the result, value, limit and query duration of each check are logged and returned, so they are
+    pushed to XCom.
+    """
 
     ui_color = '#89DA59'
 
@@ -10,22 +25,70 @@ class DataQualityOperator(BaseOperator):
     def __init__(self,
                  redshift_conn_id = "",
                  tables = [],
+                 checks = {},
                  *args, **kwargs):
 
         super(DataQualityOperator, self).__init__(*args, **kwargs)
-        
+
         self.redshift_conn_id = redshift_conn_id
         self.tables = tables
-        
+        self.checks = checks
+
     def execute(self, context):
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)    
-        for table in self.tables:
-            records = redshift.get_records("SELECT COUNT(*) FROM {}".format(table))        
-            if len(records) < 1 or len(records[0]) < 1:
-                self.log.error("{} returned no results".format(table))
-                raise ValueError("Data quality check failed. {} returned no results".format(table))
-            num_records = records[0][0]
-            if num_records == 0:
-                self.log.error("No records present in destination table {}".format(table))
-                raise ValueError("No records present in destination {}".format(table))
-            self.log.info("Data quality on table {} check passed with {} records".format(table, num_records))
\ No newline at end of file
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        specs = dict((table, {}) for table in self.tables)
+        specs.update(self.checks)
+
+        results = []
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            for table, spec in specs.items():
+                query, checks = SqlQueries.quality_check_query(table, spec)
+                start = time.time()
+                cursor.execute(query)
+                row = cursor.fetchone()
+                seconds = round(time.time() - start, 3)
+                results.extend(self.evaluate(table, spec, checks, row, seconds))
+            cursor.close()
+        finally:
+            conn.close()
+
+        for result in results:
+            log = self.log.info if result["passed"] else self.log.error
+            log("{} {} {}: {} (limit {}) in {:.2f}s, {}".format(
+                result["table"], result["check"], result["column"] or "", result["value"], result["limit"],
+                result["seconds"], "passed" if result["passed"] else "FAILED"))
+
+        failed = [result for result in results if not result["passed"]]
+        if failed:
+            raise ValueError("Data quality check failed. {}".format(", ".join(
+                "{} {} {}".format(result["table"], result["check"], result["column"] or "").strip()
+                for result in failed)))
+        return results
+
+    @staticmethod
+    def evaluate(table, spec, checks, row, seconds):
+        """
+        Compares the values the quality query of a table returned with the limits of its spec.
+        Returns one result per check, with the query duration each of them shares.
+        """
+        row_count = row[0] if row else 0
+        results = []
+        for check, value in zip(checks, row or [None] * len(checks)):
+            value = int(value or 0)
+            if check["check"] == "row_count":
+                limit = spec.get("min_rows", 1)
+                passed = value >= limit
+            elif check["check"] == "null_rate":
+                # a null rate rather than a count, so the limit holds whatever the size of the table
+                value = round(value / row_count, 4) if row_count else 0
+                limit = spec["max_null_rate"][check["column"]]
+                passed = value <= limit
+            else:
+                limit = 0
+                passed = value <= limit
+            results.append({"table": table, "check": check["check"],
+                            "column": check["column"], "value": value, "limit": limit, "passed": passed,
+                            "seconds": seconds})
+        return results
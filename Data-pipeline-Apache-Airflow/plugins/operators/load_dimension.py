@@ -1,8 +1,14 @@
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers import SqlQueries
 
 class LoadDimensionOperator(BaseOperator):
+    """
+    Loads a dimension table from the SqlQueries query named sql, in one transaction. mode is 'append',
+    'delete-load' (the default, 'append' with append_only=True) or 'merge', which rewrites only the rows whose key
+    columns match a row of the query, see SqlQueries.load_statements.
+    """
 
     ui_color = '#80BD9E'
 
@@ -12,6 +18,8 @@ class LoadDimensionOperator(BaseOperator):
                  table = "",
                  sql = "",  
                  append_only = False,
+                 mode = None,
+                 key = (),
                  *args, **kwargs):
 
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
@@ -20,12 +28,11 @@ class LoadDimensionOperator(BaseOperator):
         self.table = table
         self.sql = sql
         self.append_only = append_only
+        self.mode = mode or ("append" if append_only else "delete-load")
+        self.key = key
 
     def execute(self, context):
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        if not self.append_only:
-            self.log.info("Delete {} dimension table".format(self.table))
-            redshift.run("DELETE FROM {}".format(self.table))        
-        self.log.info("Insert data from fact table into {} dimension table".format(self.table))
-        formatted_sql = getattr(SqlQueries,self.sql).format(self.table)
-        redshift.run(formatted_sql)
+        self.log.info("Load ({}) data from staging tables into {} dimension table".format(self.mode, self.table))
+        statements = SqlQueries.load_statements(self.table, getattr(SqlQueries, self.sql), self.mode, self.key)
+        redshift.run(statements)
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from helpers import SqlQueries
+
+class LoadDimensionsOperator(BaseOperator):
+    """
+    Loads several dimension tables concurrently, over at most max_connections connections opened once for the task
+    and reused from one table to the next, instead of one task and one connection per table.
+
+    dimensions is a list of dicts with the arguments of LoadDimensionOperator: table, sql (name of the SqlQueries
+    query), mode and key. Each table is loaded in its own transaction, see SqlQueries.load_statements. prepare names
+    SqlQueries lists of statements run and committed first, on one of the same connections, e.g. staging_plays_load,
+    which the users and time queries read from. The duration and row count of every statement are logged and
+    returned, so they are pushed to XCom.
+    """
+
+    ui_color = '#80BD9E'
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id = "",
+                 dimensions = (),
+                 max_connections = 4,
+                 prepare = (),
+                 *args, **kwargs):
+
+        super(LoadDimensionsOperator, self).__init__(*args, **kwargs)
+
+        self.redshift_conn_id = redshift_conn_id
+        self.dimensions = dimensions
+        self.max_connections = max(1, max_connections)
+        self.prepare = prepare
+
+    def execute(self, context):
+        # each worker thread opens one connection on its first table and keeps it for the next ones; a hook keeps
+        # the last connection it opened in an attribute, so every thread has its own hook
+        local, connections = threading.local(), []
+
+        def connection():
+            if not hasattr(local, "conn"):
+                local.conn = PostgresHook(postgres_conn_id=self.redshift_conn_id).get_conn()
+                connections.append(local.conn)
+            return local.conn
+
+        def prepare(name):
+            return self.run(connection(), name, getattr(SqlQueries, name))
+
+        def load(dimension):
+            return self.load(connection(), dimension)
+
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.max_connections, len(self.dimensions))) as pool:
+                timings = [pool.submit(prepare, name).result() for name in self.prepare]
+                timings += list(pool.map(load, self.dimensions))
+        finally:
+            for conn in connections:
+                conn.close()
+        self.log.info("Loaded {} dimension tables over {} connections in {:.2f}s".format(
+            len(self.dimensions), len(connections), time.time() - start))
+        return timings
+
+    def load(self, conn, dimension):
+        """
+        Runs the statements loading one dimension table in one transaction, see run.
+        """
+        table = dimension["table"]
+        mode = dimension.get("mode") or "delete-load"
+        statements = SqlQueries.load_statements(table, getattr(SqlQueries, dimension["sql"]), mode,
+                                                dimension.get("key", ()))
+        self.log.info("Load ({}) data from staging tables into {} dimension table".format(mode, table))
+        return self.run(conn, table, statements)
+
+    def run(self, conn, table, statements):
+        """
+        Runs statements in one transaction, timing each of them.
+        Returns the table and the statement, duration in seconds and row count of each of them.
+        """
+        timings = []
+        try:
+            cursor = conn.cursor()
+            for statement in statements:
+                start = time.time()
+                cursor.execute(statement)
+                timings.append({"statement": " ".join(statement.split()),
+                                "seconds": round(time.time() - start, 3),
+                                "rows": cursor.rowcount})
+                self.log.info("{}: {:.2f}s, {} rows: {}".format(
+                    table, timings[-1]["seconds"], cursor.rowcount, timings[-1]["statement"][:80]))
+            cursor.close()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return {"table": table, "statements": timings}
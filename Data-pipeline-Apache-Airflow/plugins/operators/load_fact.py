@@ -1,8 +1,14 @@
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers import SqlQueries
 
 class LoadFactOperator(BaseOperator):
+    """
+    Loads a fact table from the SqlQueries query named sql, in one transaction. mode is 'append', 'delete-load'
+    (the default, 'append' with append_only=True) or 'merge', which rewrites only the rows whose key columns match
+    a row of the query, see SqlQueries.load_statements.
+    """
 
     ui_color = '#F98866'
 
@@ -12,6 +18,8 @@ class LoadFactOperator(BaseOperator):
                  table = "",
                  sql = "",        
                  append_only = False,
+                 mode = None,
+                 key = (),
                  *args, **kwargs):
                     
         super(LoadFactOperator, self).__init__(*args, **kwargs)
@@ -20,13 +28,12 @@ class LoadFactOperator(BaseOperator):
         self.table = table
         self.sql = sql
         self.append_only = append_only
+        self.mode = mode or ("append" if append_only else "delete-load")
+        self.key = key
 
 
     def execute(self, context):
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        if not self.append_only:
-            self.log.info("Delete {} fact table".format(self.table))
-            redshift.run("DELETE FROM {}".format(self.table))         
-        self.log.info("Insert data from staging tables into {} fact table".format(self.table))
-        formatted_sql = getattr(SqlQueries,self.sql).format(self.table)
-        redshift.run(formatted_sql)
+        self.log.info("Load ({}) data from staging tables into {} fact table".format(self.mode, self.table))
+        statements = SqlQueries.load_statements(self.table, getattr(SqlQueries, self.sql), self.mode, self.key)
+        redshift.run(statements)
@@ -1,24 +1,35 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from airflow.contrib.hooks.aws_hook import AwsHook
+from airflow.hooks.S3_hook import S3Hook
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
 class StageToRedshiftOperator(BaseOperator):
-    ui_color = '#358140'
-    
-    copy_sql_date = """
-        COPY {} FROM '{}/{}/{}/'
-        ACCESS_KEY_ID '{}'
-        SECRET_ACCESS_KEY '{}'
-        REGION '{}'
-        {} 'auto';
     """
+    Replaces the rows of a Redshift staging table with JSON files from S3.
+
+    s3_key and manifest_path are templated, so that a run loads only the slice of its execution date, e.g.
+    s3_key="log_data/{{ execution_date.strftime('%Y/%m') }}/{{ ds }}-events" for the day's log file, instead of the
+    whole s3_path. The keys of the slice are listed first, and a slice without files leaves the staging table empty
+    rather than failing the COPY. Without manifest_path, everything under s3_path/s3_key is copied with one COPY.
+    With it, the keys of the slice are written to manifest files under manifest_path and copied with COPY ... MANIFEST,
+    so that only the listed files are loaded; shards above 1 splits them round-robin into that many manifests,
+    copied concurrently, each over its own connection. A single COPY already spreads its files over every slice of
+    the cluster, and COPYs into the same table take its write lock one after another, so shards only pays off
+    when a manifest would be too large; the DAG keeps one.
+    """
+    ui_color = '#358140'
+    template_fields = ("s3_key", "manifest_path")
 
     copy_sql = """
         COPY {} FROM '{}'
         ACCESS_KEY_ID '{}'
         SECRET_ACCESS_KEY '{}'
         REGION '{}'
-        {} 'auto';
+        {} 'auto'
+        {};
     """
 
     @apply_defaults
@@ -27,6 +38,9 @@ class StageToRedshiftOperator(BaseOperator):
                  aws_conn_id="",
                  table = "",
                  s3_path = "",
+                 s3_key = "",
+                 manifest_path = "",
+                 shards = 1,
                  region= "us-west-2",
                  data_format = "",
                  *args, **kwargs):
@@ -37,43 +51,86 @@ class StageToRedshiftOperator(BaseOperator):
         self.aws_conn_id = aws_conn_id
         self.table = table
         self.s3_path = s3_path
+        self.s3_key = s3_key
+        self.manifest_path = manifest_path
+        self.shards = max(1, shards)
         self.region = region
         self.data_format = data_format
-        self.execution_date = kwargs.get('execution_date')
 
     def execute(self, context):
         aws = AwsHook(self.aws_conn_id)
         credentials = aws.get_credentials()
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        self.log.info("Deleting data from destination Redshift table")
-        redshift.run("DELETE FROM {}".format(self.table))
-        self.log.info("Copying data from S3 to Redshift")
-        # Backfill a specific date
-        if self.execution_date:
-            formatted_sql = StageToRedshiftOperator.copy_sql_time.format(
-                self.table, 
-                self.s3_path, 
-                self.execution_date.strftime("%Y"),
-                self.execution_date.strftime("%d"),
+        source = "{}/{}".format(self.s3_path.rstrip('/'), self.s3_key) if self.s3_key else self.s3_path
+
+        # TRUNCATE frees the staging table's blocks at once, where DELETE leaves them to a vacuum
+        self.log.info("Clearing Redshift staging table {}".format(self.table))
+        redshift.run("TRUNCATE {}".format(self.table))
+
+        keys = self.list_keys(source)
+        if not keys:
+            # a prefix COPY fails when no object matches, a run without files leaves the staging table empty
+            self.log.info("No files under {}, {} left empty".format(source, self.table))
+            return
+
+        if not self.manifest_path:
+            self.log.info("Copying {} from S3 to Redshift".format(source))
+            redshift.run(StageToRedshiftOperator.copy_sql.format(
+                self.table,
+                source,
                 credentials.access_key,
-                credentials.secret_key, 
+                credentials.secret_key,
                 self.region,
                 self.data_format,
-                self.execution_date
-            )
-        else:
-            formatted_sql = StageToRedshiftOperator.copy_sql.format(
-                self.table, 
-                self.s3_path, 
+                ""
+            ))
+            return
+
+        # the manifests of a run are kept apart from those of other runs and earlier tries of the same run
+        run = "{}-{}".format(context["ts_nodash"], context["ti"].try_number)
+        manifests = self.write_manifests(source, keys, run)
+
+        def copy(manifest):
+            self.log.info("Copying the files of {} from S3 to Redshift".format(manifest))
+            PostgresHook(postgres_conn_id=self.redshift_conn_id).run(StageToRedshiftOperator.copy_sql.format(
+                self.table,
+                manifest,
                 credentials.access_key,
-                credentials.secret_key, 
+                credentials.secret_key,
                 self.region,
                 self.data_format,
-                self.execution_date
-            )
-        redshift.run(formatted_sql)
-
+                "MANIFEST"
+            ))
 
+        with ThreadPoolExecutor(max_workers=len(manifests)) as pool:
+            list(pool.map(copy, manifests))
 
+    def list_keys(self, source):
+        """
+        Lists the keys of the files under source, an s3:// path, sorted.
+        """
+        bucket, prefix = S3Hook.parse_s3_url(source)
+        keys = S3Hook(aws_conn_id=self.aws_conn_id).list_keys(bucket_name=bucket, prefix=prefix) or []
+        keys = sorted(key for key in keys if not key.endswith('/'))
+        self.log.info("{} files under {}".format(len(keys), source))
+        return keys
 
+    def write_manifests(self, source, keys, run):
+        """
+        Writes the keys of the files under source to manifest files under manifest_path/<table>/<run>/, at most one
+        per shard, so that concurrent runs and backfills do not overwrite each other's manifests.
+        Returns the s3:// paths of the manifests.
+        """
+        s3 = S3Hook(aws_conn_id=self.aws_conn_id)
+        bucket, _ = S3Hook.parse_s3_url(source)
 
+        manifest_bucket, manifest_prefix = S3Hook.parse_s3_url(self.manifest_path)
+        manifests = []
+        for shard in range(min(self.shards, len(keys))):
+            entries = [{"url": "s3://{}/{}".format(bucket, key), "mandatory": True}
+                       for key in keys[shard::self.shards]]
+            manifest_key = "{}/{}/{}/{:04d}.manifest".format(manifest_prefix.rstrip('/'), self.table, run, shard)
+            s3.load_string(json.dumps({"entries": entries}), key=manifest_key, bucket_name=manifest_bucket,
+                           replace=True)
+            manifests.append("s3://{}/{}".format(manifest_bucket, manifest_key))
+        return manifests
@@ -0,0 +1,6 @@
+-- Redshift functions the SqlQueries statements use, for the local Postgres stand-in of docker-compose.yml
+
+-- STRTOL(string, base) for the base 16 of the playid expression; Postgres reads hex through bit strings
+CREATE OR REPLACE FUNCTION strtol(num text, base int4) RETURNS int8 AS $$
+	SELECT CASE WHEN base = 16 THEN ('x' || lpad(num, 16, '0'))::bit(64)::int8 END
+$$ LANGUAGE sql IMMUTABLE;
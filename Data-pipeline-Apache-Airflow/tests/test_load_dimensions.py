@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("airflow")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "plugins"))
+
+from operators import load_dimensions
+from operators.load_dimensions import LoadDimensionsOperator
+
+DIMENSIONS = [
+    {"table": "users", "sql": "user_table_insert", "mode": "merge", "key": ["userid"]},
+    {"table": "song", "sql": "song_table_insert", "mode": "merge", "key": ["songid"]},
+    {"table": "artist", "sql": "artist_table_insert", "mode": "merge", "key": ["artistid"]},
+    {"table": "time", "sql": "time_table_insert", "mode": "append"},
+]
+
+
+class StubHook(object):
+    """
+    PostgresHook opening a new mock connection on every get_conn. Each connection records the statements run on it;
+    the first statement of every table waits for the other tables, so that the loads run at the same time.
+    """
+    connections = []
+    barrier = None
+    fail_table = None
+
+    def __init__(self, postgres_conn_id=None):
+        pass
+
+    def get_conn(self):
+        conn = mock.MagicMock()
+        conn.statements = []
+
+        def execute(statement):
+            if not conn.statements:
+                StubHook.barrier.wait(timeout=5)
+            conn.statements.append(statement)
+            if StubHook.fail_table and statement.startswith("INSERT INTO {} ".format(StubHook.fail_table)):
+                raise RuntimeError("load of {} failed".format(StubHook.fail_table))
+
+        conn.cursor.return_value.execute.side_effect = execute
+        StubHook.connections.append(conn)
+        return conn
+
+
+@pytest.fixture
+def stub_hook():
+    StubHook.connections = []
+    StubHook.barrier = threading.Barrier(len(DIMENSIONS))
+    StubHook.fail_table = None
+    with mock.patch.object(load_dimensions, "PostgresHook", StubHook):
+        yield StubHook
+
+
+def loaded_tables(conn):
+    return [statement.split()[2] for statement in conn.statements if statement.startswith("INSERT INTO ")]
+
+
+def test_each_table_is_loaded_on_its_own_connection(stub_hook):
+    operator = LoadDimensionsOperator(task_id="load", redshift_conn_id="redshift", dimensions=DIMENSIONS,
+                                      max_connections=4)
+    timings = operator.execute({})
+
+    assert [timing["table"] for timing in timings] == ["users", "song", "artist", "time"]
+    assert len(stub_hook.connections) == 4
+    tables = [loaded_tables(conn) for conn in stub_hook.connections]
+    # a merge inserts into its temporary table, then into the table
+    assert sorted(tables) == sorted([["users_merge", "users"], ["song_merge", "song"], ["artist_merge", "artist"],
+                                     ["time"]])
+    for conn in stub_hook.connections:
+        conn.commit.assert_called_once_with()
+        conn.rollback.assert_not_called()
+        conn.close.assert_called_once_with()
+
+
+def test_a_failed_load_fails_the_task(stub_hook):
+    stub_hook.fail_table = "artist"
+    operator = LoadDimensionsOperator(task_id="load", redshift_conn_id="redshift", dimensions=DIMENSIONS,
+                                      max_connections=4)
+    with pytest.raises(RuntimeError, match="load of artist failed"):
+        operator.execute({})
+
+    failed = [conn for conn in stub_hook.connections if "artist" in loaded_tables(conn)]
+    assert len(failed) == 1
+    failed[0].rollback.assert_called_once_with()
+    failed[0].commit.assert_not_called()
+    for conn in stub_hook.connections:
+        conn.close.assert_called_once_with()
@@ -0,0 +1,183 @@
+import glob
+import json
+import os
+import sys
+import uuid
+from unittest import mock
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+from psycopg2.extensions import make_dsn
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, "plugins"))
+sys.path.insert(0, os.path.join(ROOT, os.pardir))
+
+from helpers import SqlQueries
+import songplay_key
+
+# the sample log files of the repository
+SAMPLE_LOGS = os.path.join(ROOT, os.pardir, "data-modeling", "project1-data_modeling-Postgres", "data", "log_data")
+
+# the Postgres of docker-compose.yml; STANDIN_DSN points the tests at another server
+DSN = os.environ.get("STANDIN_DSN", "host=localhost port=5439 dbname=sparkify user=sparkify password=sparkify")
+
+DIMENSIONS = [
+    {"table": "users", "sql": "user_table_insert", "mode": "merge", "key": ["userid"]},
+    {"table": "song", "sql": "song_table_insert", "mode": "merge", "key": ["songid"]},
+    {"table": "artist", "sql": "artist_table_insert", "mode": "merge", "key": ["artistid"]},
+    {"table": "time", "sql": "time_table_insert", "mode": "append"},
+]
+
+SONGS = [
+    # song_id, title, artist_id, artist_name, duration
+    ("SOA", "Song A", "ARA", "Artist A", 200),
+    ("SOB", "Song B", "ARB", "Artist B", 180),
+]
+
+EVENTS = [
+    # userid, firstname, level, sessionid, iteminsession, ts, page, song, artist, length
+    (1, "Ann", "free", 10, 0, 1541105830796, "NextSong", "Song A", "Artist A", 200),
+    (1, "Ann", "free", 10, 1, 1541106106796, "NextSong", "Song B", "Artist B", 180),
+    # the same play staged twice, by an overlapping slice
+    (1, "Ann", "free", 10, 1, 1541106106796, "NextSong", "Song B", "Artist B", 180),
+    # a later play of the same user, after an upgrade
+    (1, "Ann", "paid", 11, 0, 1541107053796, "NextSong", "Unknown", "Nobody", 100),
+    # a play in the same second as another one
+    (2, "Bob", "free", 20, 0, 1541105830000, "NextSong", "Song A", "Artist A", 200),
+    (3, "Cid", "free", 30, 0, 1541108000000, "Home", None, None, None),
+]
+
+
+@pytest.fixture
+def standin():
+    """
+    Connection to, and DSN of, a database of its own on the stand-in, with the Redshift functions and the tables of
+    create_tables.sql; skips the test when the stand-in is not running.
+    """
+    try:
+        server = psycopg2.connect(DSN, connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip("Postgres stand-in not reachable: {}".format(e))
+    server.autocommit = True
+    database = "standin_{}".format(uuid.uuid4().hex[:12])
+    server.cursor().execute("CREATE DATABASE {}".format(database))
+    dsn = make_dsn(DSN, dbname=database)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            for script in ("postgres_compat.sql", "create_tables.sql"):
+                with open(os.path.join(ROOT, script)) as f:
+                    cursor.execute(f.read())
+            cursor.executemany("""
+                INSERT INTO staging_songs (song_id, title, artist_id, artist_name, duration, year, num_songs)
+                VALUES (%s, %s, %s, %s, %s, 2000, 1)""", SONGS)
+            cursor.executemany("""
+                INSERT INTO staging_events (userid, firstname, lastname, gender, level, sessionid, iteminsession, ts,
+                                            page, song, artist, length, location, useragent)
+                VALUES (%s, %s, 'Doe', 'F', %s, %s, %s, %s, %s, %s, %s, %s, 'Here', 'Agent')""", EVENTS)
+        conn.commit()
+        yield conn, dsn
+    finally:
+        conn.close()
+        server.cursor().execute("DROP DATABASE {}".format(database))
+        server.close()
+
+
+def run(conn, statements):
+    with conn.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+    conn.commit()
+
+
+def rows(conn, query):
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        return cursor.fetchall()
+
+
+def load_all(conn):
+    run(conn, SqlQueries.load_statements("songplay", SqlQueries.songplay_table_insert, "merge", ["playid"]))
+    run(conn, SqlQueries.staging_plays_load)
+    for dimension in DIMENSIONS:
+        run(conn, SqlQueries.load_statements(dimension["table"], getattr(SqlQueries, dimension["sql"]),
+                                             dimension["mode"], dimension.get("key", ())))
+
+
+def counts(conn):
+    return {table: rows(conn, "SELECT COUNT(*) FROM {}".format(table))[0][0]
+            for table in ("songplay", "users", "song", "artist", "time", "staging_plays")}
+
+
+def test_load_statements_on_the_standin(standin):
+    standin, _ = standin
+    load_all(standin)
+
+    # the duplicated play is staged once; two plays share a start time
+    assert counts(standin) == {"songplay": 4, "users": 2, "song": 2, "artist": 2, "time": 3, "staging_plays": 4}
+    assert rows(standin, "SELECT level FROM users WHERE userid = 1") == [("paid",)]
+    assert rows(standin, "SELECT COUNT(*) FROM songplay WHERE songid IS NULL") == [(1,)]
+    assert rows(standin, "SELECT MIN(playid) >= 0 FROM songplay") == [(True,)]
+
+    # a rerun over the same slice loads no row twice
+    load_all(standin)
+    assert counts(standin)["songplay"] == 4
+    assert counts(standin)["time"] == 3
+
+    # quality checks of the DAG pass on the loaded tables
+    query, checks = SqlQueries.quality_check_query("songplay", {
+        "unique": "playid", "references": {"userid": "users.userid", "start_time": "time.start_time"}})
+    values = rows(standin, query)[0]
+    assert dict(zip([check["check"] + str(check["column"]) for check in checks], values)) == {
+        "row_countNone": 4, "duplicatesplayid": 0, "orphansuserid": 0, "orphansstart_time": 0}
+
+
+def test_load_dimensions_operator_on_the_standin(standin):
+    pytest.importorskip("airflow")
+    from operators import load_dimensions
+    from operators.load_dimensions import LoadDimensionsOperator
+    standin, dsn = standin
+
+    class StandinHook(object):
+        def __init__(self, postgres_conn_id=None):
+            pass
+
+        def get_conn(self):
+            return psycopg2.connect(dsn)
+
+    run(standin, SqlQueries.load_statements("songplay", SqlQueries.songplay_table_insert, "merge", ["playid"]))
+    operator = LoadDimensionsOperator(task_id="load", redshift_conn_id="redshift", dimensions=DIMENSIONS,
+                                      max_connections=4, prepare=["staging_plays_load"])
+    with mock.patch.object(load_dimensions, "PostgresHook", StandinHook):
+        timings = operator.execute({})
+
+    assert [timing["table"] for timing in timings] == ["staging_plays_load", "users", "song", "artist", "time"]
+    assert timings[0]["statements"][1]["rows"] == 4
+    assert counts(standin) == {"songplay": 4, "users": 2, "song": 2, "artist": 2, "time": 3, "staging_plays": 4}
+
+
+def test_songplay_id_is_the_shared_expression():
+    assert SqlQueries.songplay_id == songplay_key.REDSHIFT_SQL.format(
+        user_id="events.userid", session_id="events.sessionid", item_in_session="events.iteminsession",
+        ts="events.ts")
+
+
+def test_songplay_id_matches_songplay_key_on_the_sample_events(standin):
+    standin, _ = standin
+    events = []
+    for path in sorted(glob.glob(os.path.join(SAMPLE_LOGS, "*", "*", "*.json"))):
+        with open(path) as f:
+            events += [json.loads(line) for line in f if line.strip()]
+    assert events
+    with standin.cursor() as cursor:
+        cursor.executemany("INSERT INTO staging_events (userid, sessionid, iteminsession, ts) VALUES (%s, %s, %s, %s)",
+                           [(event["userId"] or None, event["sessionId"], event["itemInSession"], event["ts"])
+                            for event in events])
+
+    computed = rows(standin, "SELECT userid, sessionid, iteminsession, ts, {} FROM staging_events events".format(
+        SqlQueries.songplay_id))
+    assert len(computed) == len(events) + len(EVENTS)
+    for user_id, session_id, item_in_session, ts, playid in computed:
+        assert playid == songplay_key.songplay_id(user_id, session_id, item_in_session, ts)
@@ -0,0 +1,199 @@
+"""
+Generates a synthetic Sparkify dataset with the same layout and schema as the
+song_data and log_data samples: one JSON song per file under
+song_data/<A>/<B>/<C>/, and one JSON-lines events file per day under
+log_data/<year>/<month>/. Song popularity follows a Zipf-like distribution
+so that busy songs, users and hours look like real traffic.
+"""
+import os
+import json
+import random
+import string
+import argparse
+from datetime import datetime, timedelta, timezone
+
+PAGES = ['Home', 'Login', 'Logout', 'Settings', 'Help', 'About', 'Downgrade', 'Upgrade']
+USER_AGENTS = [
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"',
+]
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'New York-Newark-Jersey City, NY-NJ-PA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Atlanta-Sandy Springs-Roswell, GA', 'Portland-South Portland, ME']
+
+
+def random_id(rng, prefix, length=16):
+    """
+    Returns an id shaped like the Million Song Dataset ones, e.g. SOMZWCG12A8C13C480.
+    """
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def random_name(rng, words=2):
+    """
+    Returns a random title-cased name of a few words.
+    """
+    return ' '.join(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))).title()
+                    for _ in range(words))
+
+
+def zipf_weights(n, skew):
+    """
+    Cumulative weights of a Zipf-like distribution over n items, skew 0 is uniform.
+    """
+    cum_weights, total = [], 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** skew
+        cum_weights.append(total)
+    return cum_weights
+
+
+def generate_songs(rng, out, num_songs, num_artists):
+    """
+    Writes num_songs song files under out/song_data and returns the catalog.
+
+    Keyword arguments:
+    * rng         -- random.Random instance
+    * out         -- output directory of the dataset
+    * num_songs   -- number of song files
+    * num_artists -- number of distinct artists
+    Output:
+    * songs       -- list of the generated song records
+    """
+    artists = [{'artist_id': random_id(rng, 'AR'),
+                'artist_name': random_name(rng, rng.randint(1, 3)),
+                'artist_location': rng.choice(LOCATIONS + ['']),
+                'artist_latitude': rng.choice([None, round(rng.uniform(-60, 60), 5)]),
+                'artist_longitude': rng.choice([None, round(rng.uniform(-150, 150), 5)])}
+               for _ in range(num_artists)]
+
+    songs = []
+    for _ in range(num_songs):
+        track_id = random_id(rng, 'TRA', 15)
+        song = dict(num_songs=1, **rng.choice(artists))
+        song.update(song_id=random_id(rng, 'SO'),
+                    title=random_name(rng, rng.randint(1, 4)),
+                    duration=round(rng.uniform(90, 480), 5),
+                    year=rng.choice([0, rng.randint(1960, 2018)]))
+
+        directory = os.path.join(out, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+        songs.append(song)
+
+    return songs
+
+
+def generate_logs(rng, out, songs, num_users, start_date, days, events_per_day, skew, miss_rate,
+                  ts_resolution=1):
+    """
+    Writes one events file per day under out/log_data.
+
+    Keyword arguments:
+    * rng            -- random.Random instance
+    * out            -- output directory of the dataset
+    * songs          -- catalog returned by generate_songs
+    * num_users      -- number of distinct users
+    * start_date     -- first day of events
+    * days           -- number of days of events
+    * events_per_day -- number of events per day
+    * skew           -- Zipf exponent of song and user popularity
+    * miss_rate      -- share of plays of songs missing from the catalog
+    * ts_resolution  -- granularity of the event timestamps, in milliseconds
+    Output:
+    * counts         -- number of events and of NextSong events written
+    """
+    users = [{'userId': str(user_id),
+              'firstName': random_name(rng, 1),
+              'lastName': random_name(rng, 1),
+              'gender': rng.choice(['M', 'F']),
+              'level': rng.choice(['free', 'paid']),
+              'location': rng.choice(LOCATIONS),
+              'userAgent': rng.choice(USER_AGENTS),
+              'registration': float(rng.randint(1530000000000, 1540000000000))}
+             for user_id in range(1, num_users + 1)]
+    song_weights = zipf_weights(len(songs), skew)
+    user_weights = zipf_weights(num_users, skew)
+
+    events, plays, session_id = 0, 0, 0
+    for day in range(days):
+        date = start_date + timedelta(days=day)
+        day_start = int(date.replace(tzinfo=timezone.utc).timestamp() * 1000)
+        directory = os.path.join(out, 'log_data', date.strftime('%Y'), date.strftime('%m'))
+        os.makedirs(directory, exist_ok=True)
+
+        # the busiest hours get most of the traffic; ts is in milliseconds like the sample logs, a coarser
+        # resolution makes events of different users share timestamps
+        timestamps = sorted(day_start + int(rng.triangular(0, 86400000, 64800000)) // ts_resolution * ts_resolution
+                            for _ in range(events_per_day))
+
+        sessions = {}
+        with open(os.path.join(directory, date.strftime('%Y-%m-%d') + '-events.json'), 'w') as f:
+            for ts in timestamps:
+                user = rng.choices(users, cum_weights=user_weights)[0]
+                if user['userId'] not in sessions or rng.random() < 0.02:
+                    session_id += 1
+                    sessions[user['userId']] = [session_id, 0]
+                session = sessions[user['userId']]
+
+                event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'],
+                         'gender': user['gender'], 'itemInSession': session[1], 'lastName': user['lastName'],
+                         'length': None, 'level': user['level'], 'location': user['location'], 'method': 'GET',
+                         'page': rng.choice(PAGES), 'registration': user['registration'], 'sessionId': session[0],
+                         'song': None, 'status': 200, 'ts': ts, 'userAgent': user['userAgent'],
+                         'userId': user['userId']}
+
+                if rng.random() < 0.8:
+                    song = rng.choices(songs, cum_weights=song_weights)[0]
+                    event.update(artist=song['artist_name'], song=song['title'], length=song['duration'],
+                                 page='NextSong', method='PUT')
+                    if rng.random() < miss_rate:
+                        event['song'] = random_name(rng, rng.randint(1, 4))
+                    plays += 1
+
+                session[1] += 1
+                f.write(json.dumps(event) + '\n')
+                events += 1
+
+    return {'events': events, 'plays': plays}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Sparkify song_data and log_data set.')
+    parser.add_argument('--out', required=True, help='output directory, song_data and log_data are created in it')
+    parser.add_argument('--songs', type=int, default=10000, help='number of song files (default: 10000)')
+    parser.add_argument('--artists', type=int, default=None, help='number of artists (default: songs / 4)')
+    parser.add_argument('--users', type=int, default=1000, help='number of users (default: 1000)')
+    parser.add_argument('--days', type=int, default=30, help='number of daily log files (default: 30)')
+    parser.add_argument('--events-per-day', type=int, default=10000, help='events per daily file (default: 10000)')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of song and user popularity, 0 for uniform (default: 1.0)')
+    parser.add_argument('--miss-rate', type=float, default=0.05,
+                        help='share of plays of songs missing from the catalog (default: 0.05)')
+    parser.add_argument('--ts-resolution-ms', type=int, default=1,
+                        help='granularity of the event timestamps in milliseconds, as in the sample logs (default: 1)')
+    parser.add_argument('--start-date', default='2018-11-01', help='first day of events (default: 2018-11-01)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    num_artists = args.artists or max(1, args.songs // 4)
+
+    print('=====Generating {} songs by {} artists====='.format(args.songs, num_artists))
+    songs = generate_songs(rng, args.out, args.songs, num_artists)
+
+    print('=====Generating {} days of {} events====='.format(args.days, args.events_per_day))
+    counts = generate_logs(rng, args.out, songs, args.users, datetime.strptime(args.start_date, '%Y-%m-%d'),
+                           args.days, args.events_per_day, args.skew, args.miss_rate, args.ts_resolution_ms)
+
+    # the benchmark reads the record counts back to report rows/sec
+    meta = dict(vars(args), artists=num_artists, song_records=len(songs), **counts)
+    with open(os.path.join(args.out, 'dataset.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print('=====Dataset written to {}====='.format(args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Times each stage of the Postgres etl.py and of the data-lake etl.py, on Spark
+(in local mode) and on its DuckDB engine, over a dataset made by
+generate_data.py, and reports rows/sec and peak RSS per stage. The data-lake
+log stages also report the rows written to each table. Every run is appended
+to a JSON history so that a run can be compared with the previous one over the
+same dataset.
+
+Each pipeline runs in its own child process, with the pipeline's directory as
+working directory, because both are flat script directories with clashing
+module names (etl, sql_queries) and read their config relative to the cwd.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from functools import partial
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+PIPELINE_DIRS = {
+    'postgres': os.path.join(ROOT, 'data-modeling', 'project1-data_modeling-Postgres'),
+    'spark': os.path.join(ROOT, 'Data-Lake-on-AWS'),
+    'duckdb': os.path.join(ROOT, 'Data-Lake-on-AWS'),
+}
+HISTORY = os.path.join(HERE, 'history.json')
+
+sys.path.insert(0, ROOT)
+from etl_metrics import PeakRSS
+
+
+def run_stage(results, name, rows, func):
+    """
+    Runs one stage, timing it and sampling its peak memory.
+
+    Keyword arguments:
+    * results -- list the stage's result is appended to
+    * name    -- name of the stage
+    * rows    -- number of input records the stage processes
+    * func    -- callable running the stage
+    Output:
+    * value   -- whatever func returned
+    """
+    print('=====Running {}====='.format(name))
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+
+    results.append({'stage': name,
+                    'seconds': round(seconds, 3),
+                    'rows': rows,
+                    'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+                    'peak_rss_mb': round(rss.peak / 2 ** 20, 1)})
+    print('{}: {:.2f}s, {} rows/sec, peak RSS {} MB'.format(name, seconds, results[-1]['rows_per_sec'],
+                                                           results[-1]['peak_rss_mb']))
+    return value
+
+
+def bench_postgres(data, meta, args):
+    """
+    Recreates sparkifydb and runs the song and log stages of the Postgres etl.py over the dataset.
+    """
+    import create_tables
+    import etl
+
+    results = []
+
+    def reset():
+        cur, conn = create_tables.create_database()
+        create_tables.drop_tables(cur, conn)
+        create_tables.create_tables(cur, conn)
+        return cur, conn
+
+    cur, conn = run_stage(results, 'postgres.create_tables', 0, reset)
+    etl.create_staging_tables(cur)
+
+    run_stage(results, 'postgres.song_data', meta['song_records'],
+              partial(etl.process_data, cur, conn, os.path.join(data, 'song_data'),
+                      partial(etl.process_song_batch, threads=args.threads),
+                      batch_size=args.batch_size, per_batch=True))
+
+    song_index = run_stage(results, 'postgres.song_index', meta['song_records'],
+                           partial(etl.SongIndex.from_database, cur))
+
+    log_func = etl.process_log_file_bulk if args.load_mode == 'bulk' else etl.process_log_file
+    run_stage(results, 'postgres.log_data', meta['events'],
+              partial(etl.process_data, cur, conn, os.path.join(data, 'log_data'),
+                      partial(log_func, song_index=song_index, time_dimension=etl.TimeDimension()),
+                      batch_size=args.batch_size))
+
+    conn.close()
+    return results
+
+
+def bench_spark(data, meta, args):
+    """
+    Runs process_song_data and process_log_data of the data-lake etl.py in Spark local mode,
+    writing the parquet tables to a temporary directory.
+    """
+    from pyspark.sql import SparkSession
+    import etl
+
+    results = []
+    spark = run_stage(results, 'spark.session', 0,
+                      SparkSession.builder.master(args.spark_master).appName('sparkify-benchmark').getOrCreate)
+
+    input_data = os.path.abspath(data) + '/'
+    with tempfile.TemporaryDirectory() as output_data:
+        output_data += '/'
+        run_stage(results, 'spark.song_data', meta['song_records'],
+                  partial(etl.process_song_data, spark, input_data, output_data, song_data='song_data/*/*/*/*.json'))
+        run_stage(results, 'spark.log_data', meta['events'],
+                  partial(etl.process_log_data, spark, input_data, output_data, log_data='log_data/*/*/*.json'))
+        results[-1]['tables'] = {table: spark.read.parquet(output_data + table).count()
+                                 for table in ('users_table', 'time_table', 'songplays_table')}
+        print('tables written: {}'.format(results[-1]['tables']))
+
+    spark.stop()
+    return results
+
+
+def bench_duckdb(data, meta, args):
+    """
+    Runs process_song_data and process_log_data of the data-lake's DuckDB engine in process,
+    writing the parquet tables to a temporary directory.
+    """
+    import duckdb_engine
+
+    results = []
+    input_data = os.path.abspath(data) + '/'
+    with tempfile.TemporaryDirectory() as output_data:
+        output_data += '/'
+        con = run_stage(results, 'duckdb.connect', 0, partial(duckdb_engine.connect, input_data, output_data))
+        run_stage(results, 'duckdb.song_data', meta['song_records'],
+                  partial(duckdb_engine.process_song_data, con, input_data, output_data,
+                          song_data='song_data/*/*/*/*.json'))
+        users, time, songplays = run_stage(results, 'duckdb.log_data', meta['events'],
+                                           partial(duckdb_engine.process_log_data, con, input_data, output_data,
+                                                   log_data='log_data/*/*/*.json'))
+        results[-1]['tables'] = {'users_table': users, 'time_table': time, 'songplays_table': songplays}
+        print('tables written: {}'.format(results[-1]['tables']))
+        con.close()
+
+    return results
+
+
+def run_child(pipeline, args):
+    """
+    Entry point of the child process of a pipeline: runs its stages and writes the results as JSON.
+    """
+    sys.path.insert(0, PIPELINE_DIRS[pipeline])
+    with open(os.path.join(args.data, 'dataset.json')) as f:
+        meta = json.load(f)
+
+    bench = {'postgres': bench_postgres, 'spark': bench_spark, 'duckdb': bench_duckdb}[pipeline]
+    results = bench(os.path.abspath(args.data), meta, args)
+
+    with open(args.child_output, 'w') as f:
+        json.dump(results, f)
+
+
+def git_commit():
+    """
+    Returns the commit the benchmark runs on, None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(run, history):
+    """
+    Prints the change of every stage against the latest previous run over the same dataset, and of the rows
+    it wrote to each table when both runs report them.
+    """
+    previous = [past for past in history if past['dataset'] == run['dataset']]
+    if not previous:
+        print('No previous run over this dataset to compare with')
+        return
+
+    before = {stage['stage']: stage for stage in previous[-1]['stages']}
+    print('Compared with run of {} ({}):'.format(previous[-1]['timestamp'], previous[-1]['commit']))
+    for stage in run['stages']:
+        old = before.get(stage['stage'])
+        if old and old['seconds']:
+            print('  {:<24} {:>8.2f}s -> {:>8.2f}s ({:+.1%}), peak RSS {} -> {} MB'.format(
+                stage['stage'], old['seconds'], stage['seconds'], stage['seconds'] / old['seconds'] - 1,
+                old['peak_rss_mb'], stage['peak_rss_mb']))
+            for table, rows in sorted(stage.get('tables', {}).items()):
+                if table in old.get('tables', {}):
+                    print('    {:<22} {:>9} rows -> {:>9} rows'.format(table, old['tables'][table], rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Postgres and Spark ETL pipelines.')
+    parser.add_argument('--data', required=True, help='dataset directory written by generate_data.py')
+    parser.add_argument('--pipelines', nargs='+', choices=sorted(PIPELINE_DIRS), default=sorted(PIPELINE_DIRS))
+    parser.add_argument('--load-mode', choices=['bulk', 'row'], default='bulk', help='Postgres log load mode')
+    parser.add_argument('--batch-size', type=int, default=100, help='Postgres files per transaction')
+    parser.add_argument('--threads', type=int, default=8, help='Postgres song file reader threads')
+    parser.add_argument('--spark-master', default='local[*]', help='Spark master (default: local[*])')
+    parser.add_argument('--history', default=HISTORY, help='JSON history file (default: benchmark/history.json)')
+    parser.add_argument('--child', choices=sorted(PIPELINE_DIRS), help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args.child, args)
+
+    with open(os.path.join(args.data, 'dataset.json')) as f:
+        dataset = json.load(f)
+    dataset.pop('out', None)
+
+    stages = []
+    for pipeline in args.pipelines:
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            command = [sys.executable, os.path.abspath(__file__), '--data', os.path.abspath(args.data),
+                       '--load-mode', args.load_mode, '--batch-size', str(args.batch_size),
+                       '--threads', str(args.threads), '--spark-master', args.spark_master,
+                       '--child', pipeline, '--child-output', output.name]
+            subprocess.run(command, cwd=PIPELINE_DIRS[pipeline], check=True)
+            stages.extend(json.load(output))
+
+    run = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+           'commit': git_commit(),
+           'dataset': dataset,
+           'options': {'load_mode': args.load_mode, 'batch_size': args.batch_size, 'threads': args.threads,
+                       'spark_master': args.spark_master},
+           'stages': stages}
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+
+    compare(run, history)
+
+    history.append(run)
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
+    print('=====Results appended to {}====='.format(args.history))
+
+
+if __name__ == "__main__":
+    main()
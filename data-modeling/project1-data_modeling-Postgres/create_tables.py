@@ -1,3 +1,4 @@
+import argparse
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
 
@@ -27,6 +28,17 @@ def create_database():
     return cur, conn
 
 
+def connect_database():
+    """
+    - Connects to the existing sparkifydb, keeping its data
+    - Returns the connection and cursor to sparkifydb
+    """
+    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    cur = conn.cursor()
+
+    return cur, conn
+
+
 def drop_tables(cur, conn):
     """
     Drops each table using the queries in `drop_table_queries` list.
@@ -57,10 +69,22 @@ def main():
     - Creates all tables needed. 
     
     - Finally, closes the connection. 
+
+    With --incremental the database and its tables are kept and only missing
+    tables are created, so that etl.py can load new files on top of the
+    previous runs recorded in the ingestion manifest.
     """
-    cur, conn = create_database()
-    
-    drop_tables(cur, conn)
+    parser = argparse.ArgumentParser(description='Create the sparkifydb tables.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep the existing database and data, only create missing tables')
+    args = parser.parse_args()
+
+    if args.incremental:
+        cur, conn = connect_database()
+    else:
+        cur, conn = create_database()
+        drop_tables(cur, conn)
+
     create_tables(cur, conn)
 
     conn.close()
@@ -1,120 +1,623 @@
 import os
+import io
+import sys
 import glob
+import json
+import hashlib
+import argparse
+import multiprocessing
+import multiprocessing.util
 import psycopg2
+import psycopg2.errors
 import pandas as pd
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from sql_queries import *
+from song_index import SongIndex
+from time_dimension import TimeDimension
+from manifest import IngestManifest, record_file, record_files
 
-def process_song_file(cur, filepath):
+# the stage instrumentation is shared with the other pipelines and lives at the root of the repository
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from etl_metrics import Metrics
+from songplay_key import songplay_id, songplay_ids
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+# columns of the log events the tables are built from, and their types
+LOG_DTYPES = {'ts': 'int64', 'userId': 'Int64', 'firstName': 'object', 'lastName': 'object',
+              'gender': 'object', 'level': 'object', 'song': 'object', 'artist': 'object',
+              'length': 'float64', 'sessionId': 'Int64', 'itemInSession': 'Int64', 'location': 'object',
+              'userAgent': 'object'}
+
+# fields of the song files the songs and artists tables are built from
+SONG_COLUMNS = ['song_id', 'title', 'artist_id', 'year', 'duration',
+                'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']
+
+# number of threads reading song files of a batch
+SONG_READ_THREADS = 8
+
+# number of log lines parsed, transformed and loaded at a time
+LOG_CHUNKSIZE = 50000
+
+# times a worker retries a batch whose transaction the server aborted to break a deadlock
+DEADLOCK_RETRIES = 3
+
+# per-stage timing, row counts, bytes and memory, emitted at the end of the run (see etl_metrics)
+METRICS = Metrics.from_env('postgres_etl')
+
+def read_song_file(filepath):
+    """
+    Reads the records of a song file together with what the ingestion manifest needs to know about it,
+    hashing the bytes that were read instead of reading the file a second time.
+
+    Parameters:
+            filepath (str): Filepath of the song file
+
+    Returns:
+            (records, manifest_row): Parsed JSON records, and the (path, size, mtime, content_hash, max_ts) row
+    """
+    with open(filepath, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        content = f.read()
+
+    records = [json.loads(line) for line in content.splitlines() if line.strip()]
+    return records, (filepath, stat.st_size, stat.st_mtime, hashlib.sha256(content).hexdigest(), None)
+
+
+def process_song_batch(cur, batch, threads=SONG_READ_THREADS):
     """
-    Reads songs log file row by row, selects needed fields and inserts them into song and artist tables.
-        
+    Loads a batch of song files at once: the files are read on a pool of threads, combined into one columnar
+    DataFrame, songs and artists are deduplicated in memory and each table is written with a single COPY into
+    its staging table and one merge. The files are recorded in the ingestion manifest in the same transaction.
+    The staging tables must have been created on the connection with create_staging_tables.
+
     Parameters:
             cur (psycopg2.cursor()): Cursor of the sparkifydb database
+            batch (list): (filepath, since_ts) pairs of the song files
+            threads (int): Number of threads reading files
+    """
+    with METRICS.stage('song.read') as stage:
+        with ThreadPoolExecutor(threads) as pool:
+            files = list(pool.map(read_song_file, [filepath for filepath, since_ts in batch]))
+        stage.add(rows_in = len(files), bytes_read = sum(manifest_row[1] for records, manifest_row in files))
+
+        df = pd.DataFrame.from_records([record for records, manifest_row in files for record in records],
+                                       columns = SONG_COLUMNS)
+        stage.add(rows_out = len(df))
+
+    with METRICS.stage('song.transform', rows_in = len(df)) as stage:
+        df['year'] = pd.to_numeric(df['year'], errors = 'coerce').astype('Int64')
+
+        songs_df = df.loc[df['song_id'].notna(), ['song_id', 'title', 'artist_id', 'year', 'duration']] \
+            .drop_duplicates(subset = 'song_id')
+        artists_df = df.loc[df['artist_id'].notna(),
+                            ['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']] \
+            .drop_duplicates(subset = 'artist_id')
+        stage.add(rows_out = len(songs_df) + len(artists_df))
+
+    cur.execute(staging_songs_truncate)
+
+    with METRICS.stage('song.write.songs', rows_in = len(songs_df)) as stage:
+        stage.add(bytes_written = copy_df(cur, songs_df, staging_songs_copy))
+        cur.execute(song_table_merge)
+        stage.add(rows_out = cur.rowcount)
+
+    with METRICS.stage('song.write.artists', rows_in = len(artists_df)) as stage:
+        stage.add(bytes_written = copy_df(cur, artists_df, staging_artists_copy))
+        cur.execute(artist_table_merge)
+        stage.add(rows_out = cur.rowcount)
+
+    record_files(cur, [manifest_row for records, manifest_row in files])
+
+
+def read_log_chunks(filepath, since_ts=None, chunksize=LOG_CHUNKSIZE):
+    """
+    Streams a user activity log file in chunks of at most chunksize lines, keeping only the NextSong events
+    and the columns the tables are built from, cast to explicit dtypes. Memory stays bounded by the chunk
+    size however large the file is.
+
+    Parameters:
             filepath (str): Filepath of the file to be analyzed
+            since_ts (int): Only keep events after this ts, which were already loaded from the file
+            chunksize (int): Number of lines parsed at a time
+
+    Yields:
+            df (pandas.DataFrame): NextSong events of one chunk of the file
     """
-    # open song file
-    df = pd.read_json(filepath, lines = True)
+    # values are kept as parsed and cast once the chunk has been filtered
+    with pd.read_json(filepath, lines = True, chunksize = chunksize, dtype = False, convert_dates = False) as reader:
+        chunks = iter(reader)
+        bytes_read = os.path.getsize(filepath)
+
+        while True:
+            with METRICS.stage('log.read', bytes_read = bytes_read) as stage:
+                bytes_read = None
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+
+                # filter by NextSong action
+                df = chunk.loc[chunk['page'] == 'NextSong'].reindex(columns = list(LOG_DTYPES))
+                stage.add(rows_in = len(chunk))
+                del chunk
 
-    # insert song record
-    song_data = df[['song_id', 'title', 'artist_id', 'year', 'duration']].values[0].tolist()
-    cur.execute(song_table_insert, song_data)
+                # user ids are strings in the logs
+                for column in ('ts', 'userId', 'sessionId', 'itemInSession'):
+                    df[column] = pd.to_numeric(df[column], errors = 'coerce')
+                df = df.loc[df['ts'].notna()].astype(LOG_DTYPES)
 
-    # insert artist record
-    artist_data = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values[0].tolist()
-    cur.execute(artist_table_insert, artist_data)
+                if since_ts is not None:
+                    df = df.loc[df['ts'] > since_ts]
+                stage.add(rows_out = len(df))
 
+            if len(df):
+                yield df
 
-def process_log_file(cur, filepath):
+
+def max_ts(df):
+    """
+    Returns the latest event ts of a log DataFrame, None when it has no events.
+    """
+    return int(df['ts'].max()) if len(df) else None
+
+
+def process_log_file(cur, filepath, song_index=None, time_dimension=None, since_ts=None,
+                     chunksize=LOG_CHUNKSIZE):
     
     """
-     Reads user activity log file row by row, filters by NexSong, selects needed fields, transforms them and inserts
-     them into time, user and songplay tables.
+     Reads user activity log file chunk by chunk, filters by NexSong, selects needed fields, transforms them and
+     inserts them row by row into time, user and songplay tables.
     
     Parameters:
                 cur (psycopg2.cursor()): Cursor of the sparkifydb database
                 filepath (str): Filepath of the file to be analyzed
+                song_index (SongIndex): Resolves song and artist ids in memory; when None, song_select
+                                        is queried once per event
+                time_dimension (TimeDimension): Timestamps already written during the run, only new ones
+                                                are inserted
+                since_ts (int): Only load events after this ts, which were already loaded from the file
+                chunksize (int): Number of log lines read and loaded at a time
+
+    Returns:
+                max_ts (int): Latest event ts loaded, None when the file had no new events
     """
 
-    # open log file
-    df = pd.read_json(filepath, lines = True)
+    if time_dimension is None:
+        time_dimension = TimeDimension()
 
-    # filter by NextSong action
-    df = df.loc[df['page'] == 'NextSong']
+    loaded_ts = None
+    for df in read_log_chunks(filepath, since_ts, chunksize):
+        process_log_chunk(cur, df, song_index, time_dimension)
+        loaded_ts = max_ts(df) if loaded_ts is None else max(loaded_ts, max_ts(df))
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit = 'ms')
+    return loaded_ts
 
-    # insert time data records
-    time_data = [t.dt.time, t.dt.hour, t.dt.day, t.dt.weekofyear, t.dt.month, t.dt.year, t.dt.weekday]
-    column_labels = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
-    time_df = pd.DataFrame(dict(list(zip(column_labels, time_data))))
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+def process_log_chunk(cur, df, song_index, time_dimension):
+    """
+    Inserts the time, user and songplay rows of a chunk of NextSong events, one row at a time.
+
+    Parameters:
+                cur (psycopg2.cursor()): Cursor of the sparkifydb database
+                df (pandas.DataFrame): NextSong events, as yielded by read_log_chunks
+                song_index (SongIndex): Resolves song and artist ids in memory, or None
+                time_dimension (TimeDimension): Timestamps already written during the run
+    """
+    with METRICS.stage('log.transform', rows_in = len(df)) as stage:
+        time_df = time_dimension.new_rows(df['ts'])
+
+        if song_index is not None:
+            ids = song_index.resolve(df)
+
+        # psycopg2 needs plain python values, with None for missing ones
+        df = df.astype(object).where(df.notna(), None)
+        stage.add(rows_out = len(df))
 
-    # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    # insert time data records
+    with METRICS.stage('log.write.time', rows_in = len(time_df), rows_out = len(time_df)):
+        for i, row in time_df.iterrows():
+            cur.execute(time_table_insert, list(row))
+
+    # load user table, in user_id order so that concurrent workers lock the rows they share in the same order;
+    # the sort is stable, the latest event of a user is still upserted last
+    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']].sort_values('userId', kind='mergesort')
 
     # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    with METRICS.stage('log.write.users', rows_in = len(user_df), rows_out = len(user_df)):
+        for i, row in user_df.iterrows():
+            cur.execute(user_table_insert, row)
+
+    with METRICS.stage('log.write.songplays', rows_in = len(df), rows_out = len(df)):
+        insert_songplays(cur, df, ids if song_index is not None else None)
 
+
+def insert_songplays(cur, df, ids=None):
+    """
+    Inserts the songplay rows of a chunk of events one at a time.
+
+    Parameters:
+                cur (psycopg2.cursor()): Cursor of the sparkifydb database
+                df (pandas.DataFrame): NextSong events with plain python values
+                ids (pandas.DataFrame): song_id and artist_id resolved by a SongIndex; when None, song_select
+                                        is queried once per event
+    """
     # insert songplay records
     for index, row in df.iterrows():
 
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-
-        if results:
-            songid, artistid = results
+        # get songid and artistid from the song index or from song and artist tables
+        if ids is not None:
+            songid, artistid = ids.at[index, 'song_id'], ids.at[index, 'artist_id']
         else:
-            songid, artistid = None, None
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
 
         # insert songplay record
-        songplay_data = [row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent]
+        songplay_data = [songplay_id(row.userId, row.sessionId, row.itemInSession, row.ts),
+                         row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent]
         cur.execute(songplay_table_insert, songplay_data)
 
 
-def process_data(cur, conn, filepath, func):
-    
+def copy_df(cur, df, copy_sql):
     """
-    Walks through all files nested under filepath, and processes all logs found.
-    
+    Streams a DataFrame into a table through COPY FROM STDIN, in a single round trip.
+
+    Parameters:
+            cur (psycopg2.cursor()): Cursor of the sparkifydb database
+            df (pandas.DataFrame): Rows to be copied, with columns in the order of the COPY column list
+            copy_sql (str): COPY ... FROM STDIN WITH (FORMAT csv) statement
+
+    Returns:
+            size (int): Number of characters sent
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index = False, header = False)
+    size = buffer.tell()
+    buffer.seek(0)
+    cur.copy_expert(copy_sql, buffer)
+    return size
+
+
+def create_staging_tables(cur):
+    """
+    Creates the session-local staging tables, used by the song batches in every load mode and by the log files
+    in the bulk load mode.
+
+    Parameters:
+            cur (psycopg2.cursor()): Cursor of the sparkifydb database
+    """
+    for query in staging_table_queries:
+        cur.execute(query)
+
+
+def process_log_file_bulk(cur, filepath, song_index=None, time_dimension=None, since_ts=None,
+                          chunksize=LOG_CHUNKSIZE):
+    """
+    Bulk variant of process_log_file: streams the NextSong events of a log file chunk by chunk, copies each
+    chunk's events and time rows into the staging tables and merges them into the time, user and songplay
+    tables with one statement per table. The staging tables must have been created on the connection with
+    create_staging_tables.
+
+    Parameters:
+            cur (psycopg2.cursor()): Cursor of the sparkifydb database
+            filepath (str): Filepath of the file to be analyzed
+            song_index (SongIndex): Resolves song and artist ids; built from the database when None
+            time_dimension (TimeDimension): Timestamps already written during the run, only new ones are copied
+            since_ts (int): Only load events after this ts, which were already loaded from the file
+            chunksize (int): Number of log lines read and loaded at a time
+
+    Returns:
+            max_ts (int): Latest event ts loaded, None when the file had no new events
+    """
+    if time_dimension is None:
+        time_dimension = TimeDimension()
+
+    if song_index is None:
+        song_index = SongIndex.from_database(cur)
+
+    loaded_ts = None
+    for df in read_log_chunks(filepath, since_ts, chunksize):
+        with METRICS.stage('log.transform', rows_in = len(df)) as stage:
+            ids = song_index.resolve(df)
+
+            events_df = df[['ts', 'userId', 'firstName', 'lastName', 'gender', 'level']].copy()
+            events_df.insert(0, 'songplay_id', songplay_ids(df))
+            events_df['song_id'] = ids['song_id']
+            events_df['artist_id'] = ids['artist_id']
+            events_df[['sessionId', 'location', 'userAgent']] = df[['sessionId', 'location', 'userAgent']]
+
+            time_df = time_dimension.new_rows(df['ts'])
+            stage.add(rows_out = len(events_df))
+
+        with METRICS.stage('log.write.staging', rows_in = len(events_df) + len(time_df)) as stage:
+            cur.execute(staging_truncate)
+            stage.add(bytes_written = copy_df(cur, events_df, staging_events_copy))
+            stage.add(bytes_written = copy_df(cur, time_df, staging_time_copy))
+
+        for table, query in zip(merge_table_names, merge_table_queries):
+            with METRICS.stage('log.write.' + table) as stage:
+                cur.execute(query)
+                stage.add(rows_out = cur.rowcount)
+
+        loaded_ts = max_ts(df) if loaded_ts is None else max(loaded_ts, max_ts(df))
+
+    return loaded_ts
+
+
+def get_files(filepath):
+    """
+    Walks through all directories nested under filepath and lists the JSON files found, in sorted order so that
+    every run (and every split of the work across processes) sees the files in the same order.
+
     Parameters:
-       cur (psycopg2.cursor()): Cursor of the sparkifydb database
-       conn (psycopg2.connect()): Connectio to the sparkifycdb database
        filepath (str): Filepath parent of the logs to be analyzed
-       func (python function): Function to be used to process each log
+
+    Returns:
+       all_files (list): Absolute filepaths of the JSON files
     """
-    # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
 
+    return sorted(all_files)
+
+
+def get_tasks(cur, filepath, manifest=None):
+    """
+    Lists the files under filepath that a run has to process.
+
+    Parameters:
+       cur (psycopg2.cursor()): Cursor of the sparkifydb database
+       filepath (str): Filepath parent of the logs to be analyzed
+       manifest (IngestManifest): Files loaded by previous runs; when None every file is processed
+
+    Returns:
+       tasks (list): (filepath, since_ts) pairs, see IngestManifest.plan
+    """
+    # get all files matching extension from directory
+    all_files = get_files(filepath)
+
     # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    if manifest is None:
+        return [(datafile, None) for datafile in all_files]
+
+    tasks = manifest.plan(cur, all_files)
+    print('{} new or changed files, {} already loaded'.format(len(tasks), len(all_files) - len(tasks)))
+    return tasks
+
+
+def process_file(cur, func, datafile, since_ts=None):
+    """
+    Processes one file and records it in the ingestion manifest, in the caller's transaction.
+
+    Parameters:
+       cur (psycopg2.cursor()): Cursor of the sparkifydb database
+       func (python function): Function to be used to process the file
+       datafile (str): Filepath of the file
+       since_ts (int): High-water mark of a changed log file, passed on to func
+    """
+    if since_ts is not None:
+        loaded_ts = func(cur, datafile, since_ts=since_ts)
+    else:
+        loaded_ts = func(cur, datafile)
+
+    # keep the previous mark of a changed file that brought no new events
+    record_file(cur, datafile, loaded_ts if loaded_ts is not None else since_ts)
+
+
+def process_batch(cur, func, batch, per_batch=False):
+    """
+    Processes a batch of files, file by file through process_file or all at once.
+
+    Parameters:
+       cur (psycopg2.cursor()): Cursor of the sparkifydb database
+       func (python function): Function to be used to process each file, or the whole batch when per_batch
+       batch (list): (filepath, since_ts) pairs
+       per_batch (bool): func takes the whole batch and records its files in the manifest itself
+    """
+    if per_batch:
+        func(cur, batch)
+    else:
+        for datafile, since_ts in batch:
+            process_file(cur, func, datafile, since_ts)
+
+
+def process_data(cur, conn, filepath, func, batch_size=1, manifest=None, per_batch=False):
+    
+    """
+    Walks through all files nested under filepath, and processes all logs found.
+    
+    Parameters:
+       cur (psycopg2.cursor()): Cursor of the sparkifydb database
+       conn (psycopg2.connect()): Connectio to the sparkifycdb database
+       filepath (str): Filepath parent of the logs to be analyzed
+       func (python function): Function to be used to process each log
+       batch_size (int): Number of files committed together in one transaction
+       manifest (IngestManifest): Files loaded by previous runs, which are skipped unless they changed
+       per_batch (bool): func processes a whole batch of files at once, see process_batch
+    """
+    tasks = get_tasks(cur, filepath, manifest)
+    conn.commit()
+    num_files = len(tasks)
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    # iterate over batches of files and process
+    for i in range(0, num_files, batch_size):
+        process_batch(cur, func, tasks[i:i + batch_size], per_batch)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+        print('{}/{} files processed.'.format(min(i + batch_size, num_files), num_files))
+
+
+# state of a process_data_parallel worker: its own connection, cursor and file function
+_worker = {}
+
+
+def _init_worker(dsn, func, per_batch, func_kwargs):
+    """
+    Pool initializer: opens the worker's connection and creates its staging tables.
+    The keyword arguments of func (song index, time dimension) are shipped once per worker here rather than
+    with every batch.
+    """
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    create_staging_tables(cur)
+    conn.commit()
+    multiprocessing.util.Finalize(conn, conn.close, exitpriority=10)
+
+    # a forked worker starts from a copy of the parent's stages, it only reports its own
+    METRICS.stages = {}
+    multiprocessing.util.Finalize(METRICS, METRICS.emit, exitpriority=10)
+
+    if func_kwargs:
+        func = partial(func, **func_kwargs)
+
+    _worker.update(conn=conn, cur=cur, func=func, per_batch=per_batch, song_index=func_kwargs.get('song_index'),
+                   time_dimension=func_kwargs.get('time_dimension'))
+
+
+def _process_batch(batch):
+    """
+    Processes a batch of files on the worker's connection and commits them in one transaction. A batch the server
+    aborted to break a deadlock with another worker is rolled back and run again, up to DEADLOCK_RETRIES times.
+
+    Returns:
+       (files, hits, misses): Number of files processed and the song lookups of the batch
+    """
+    song_index, time_dimension = _worker['song_index'], _worker['time_dimension']
+    for attempt in range(DEADLOCK_RETRIES + 1):
+        hits, misses = (song_index.hits, song_index.misses) if song_index is not None else (0, 0)
+        seen = time_dimension.seen if time_dimension is not None else None
+        try:
+            process_batch(_worker['cur'], _worker['func'], batch, _worker['per_batch'])
+            _worker['conn'].commit()
+            break
+        except psycopg2.errors.DeadlockDetected:
+            # the batch's rows were rolled back, so are the time keys it marked as written
+            _worker['conn'].rollback()
+            if time_dimension is not None:
+                time_dimension.seen = seen
+            if attempt == DEADLOCK_RETRIES:
+                raise
+            print('Deadlock on a batch of {} files, retrying'.format(len(batch)))
+
+    if song_index is not None:
+        hits, misses = song_index.hits - hits, song_index.misses - misses
+    return len(batch), hits, misses
+
+
+def process_data_parallel(dsn, filepath, func, workers=None, batch_size=100, manifest=None, per_batch=False,
+                          **func_kwargs):
+    """
+    Parallel variant of process_data: spreads batches of files over a pool of processes, each with its own
+    connection to the database, and commits each batch in one transaction.
+
+    Files are sorted and cut into the same batches whatever the number of workers; all inserts are
+    either idempotent or order independent, and user levels are reconciled afterwards with
+    user_level_reconcile, so the loaded tables do not depend on how the work is split.
+
+    Parameters:
+       dsn (str): Connection string of the sparkifydb database
+       filepath (str): Filepath parent of the logs to be analyzed
+       func (python function): Function to be used to process each log, must be picklable
+       workers (int): Number of worker processes, defaults to the number of cores
+       batch_size (int): Number of files committed together in one transaction
+       manifest (IngestManifest): Files loaded by previous runs, which are skipped unless they changed
+       per_batch (bool): func processes a whole batch of files at once, see process_batch
+       func_kwargs: Keyword arguments of func, copied to every worker; the hit/miss counts of a song_index
+                    are summed over the workers and the time_dimension of each worker dedupes its own files
+    """
+    conn = psycopg2.connect(dsn)
+    tasks = get_tasks(conn.cursor(), filepath, manifest)
+    conn.commit()
+    conn.close()
+
+    num_files = len(tasks)
+    batches = [tasks[i:i + batch_size] for i in range(0, num_files, batch_size)]
+
+    song_index = func_kwargs.get('song_index')
+
+    processed = 0
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(dsn, func, per_batch, func_kwargs)) as pool:
+        for files, hits, misses in pool.imap_unordered(_process_batch, batches):
+            processed += files
+            if song_index is not None:
+                song_index.hits += hits
+                song_index.misses += misses
+            print('{}/{} files processed.'.format(processed, num_files))
 
 
 def main():
     
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description='Load song_data and log_data into the sparkifydb database.')
+    parser.add_argument('--load-mode', choices=['bulk', 'row'], default='bulk',
+                        help='bulk: COPY log files into staging tables and merge them (default); '
+                             'row: insert log records one row at a time')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each with its own connection (default: 1, no pool)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='number of files committed in one transaction (default: 100)')
+    parser.add_argument('--threads', type=int, default=SONG_READ_THREADS,
+                        help='number of threads reading the song files of a batch (default: {})'.format(SONG_READ_THREADS))
+    parser.add_argument('--chunk-size', type=int, default=LOG_CHUNKSIZE,
+                        help='number of log lines read and loaded at a time (default: {})'.format(LOG_CHUNKSIZE))
+    parser.add_argument('--full-reload', action='store_true',
+                        help='process every file, including those the ingestion manifest already has')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    # only new or changed files are processed, unless a full reload is asked for
+    manifest = None if args.full_reload else IngestManifest.from_database(cur)
+    if manifest is not None:
+        print('{} files in the manifest, log high-water mark ts={}'.format(len(manifest), manifest.watermark))
+
+    # song batches are COPYed through the staging tables in both load modes
+    create_staging_tables(cur)
+    log_func = process_log_file_bulk if args.load_mode == 'bulk' else process_log_file
+
+    # song files are tiny, they are read and written a whole batch at a time
+    if args.workers > 1:
+        process_data_parallel(DSN, 'data/song_data', process_song_batch, args.workers, args.batch_size, manifest,
+                              per_batch=True, threads=args.threads)
+    else:
+        process_data(cur, conn, filepath='data/song_data', func=partial(process_song_batch, threads=args.threads),
+                     batch_size=args.batch_size, manifest=manifest, per_batch=True)
+
+    # resolve song and artist ids of the events in memory instead of one song_select per play
+    song_index = SongIndex.from_database(cur)
+    print('{} songs indexed for lookup'.format(len(song_index)))
+
+    # time rows are deduplicated over the whole run before they are sent to the server
+    time_dimension = TimeDimension.from_database(cur)
+
+    if args.workers > 1:
+        process_data_parallel(DSN, 'data/log_data', log_func, args.workers, args.batch_size, manifest,
+                              song_index=song_index, time_dimension=time_dimension, chunksize=args.chunk_size)
+
+        # batches commit in any order, so the level of a user is settled from its latest songplay
+        cur.execute(user_level_reconcile)
+        conn.commit()
+    else:
+        process_data(cur, conn, filepath='data/log_data',
+                     func=partial(log_func, song_index=song_index, time_dimension=time_dimension,
+                                  chunksize=args.chunk_size),
+                     batch_size=args.batch_size, manifest=manifest)
+
+    stats = song_index.stats()
+    print('song lookup: {} hits, {} misses ({:.1%} matched)'.format(stats['hits'], stats['misses'], stats['hit_rate']))
 
     conn.close()
+    METRICS.emit()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
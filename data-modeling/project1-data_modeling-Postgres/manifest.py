@@ -0,0 +1,121 @@
+import os
+import hashlib
+from psycopg2.extras import execute_values
+from sql_queries import manifest_select, manifest_upsert, manifest_upsert_values
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+    """
+    Computes the sha256 of a file's content, reading it in chunks.
+
+    Parameters:
+            filepath (str): Filepath of the file
+            chunk_size (int): Number of bytes read at a time
+
+    Returns:
+            digest (str): Hex digest of the content
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record_file(cur, filepath, max_ts, digest=None):
+    """
+    Records a processed file in the ingestion manifest. Meant to run in the transaction that loaded the file,
+    so that a file is either loaded and recorded or neither.
+
+    Parameters:
+            cur (psycopg2.cursor()): Cursor of the sparkifydb database
+            filepath (str): Filepath of the processed file
+            max_ts (int): Latest event ts loaded from the file, None for song files
+            digest (str): sha256 of the file, computed when None
+    """
+    stat = os.stat(filepath)
+    if digest is None:
+        digest = file_digest(filepath)
+    cur.execute(manifest_upsert, (filepath, stat.st_size, stat.st_mtime, digest, max_ts))
+
+
+def record_files(cur, rows):
+    """
+    Records many processed files in the ingestion manifest with a single statement.
+
+    Parameters:
+            cur (psycopg2.cursor()): Cursor of the sparkifydb database
+            rows (list): (path, size, mtime, content_hash, max_ts) of each file
+    """
+    if rows:
+        execute_values(cur, manifest_upsert_values, rows, page_size = len(rows))
+
+
+class IngestManifest:
+    """
+    Files loaded by previous runs, with their size, mtime, content hash and the latest event ts loaded from them.
+    Decides which files a run still has to process: new files, and files whose content changed since they were
+    loaded, from which only events past the file's previous high-water mark are taken.
+    """
+
+    def __init__(self, entries=None):
+        """
+        Parameters:
+                entries (dict): filepath -> (size, mtime, content_hash, max_ts)
+        """
+        self.entries = entries or {}
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        Reads the manifest from the ingest_manifest table.
+
+        Parameters:
+                cur (psycopg2.cursor()): Cursor of the sparkifydb database
+        """
+        cur.execute(manifest_select)
+        return cls({row[0]: tuple(row[1:]) for row in cur.fetchall()})
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def watermark(self):
+        """
+        Latest event ts loaded by any previous run, None before the first log file.
+        """
+        return max((entry[3] for entry in self.entries.values() if entry[3] is not None), default=None)
+
+    def plan(self, cur, all_files):
+        """
+        Returns the files that still have to be processed. A file whose size and mtime are unchanged is skipped
+        without being read; a file whose metadata changed but whose content hash did not is skipped too, and
+        its new metadata is recorded.
+
+        Parameters:
+                cur (psycopg2.cursor()): Cursor of the sparkifydb database
+                all_files (list): Filepaths found in the input directory
+
+        Returns:
+                tasks (list): (filepath, since_ts) pairs; since_ts is the previous high-water mark of a changed
+                              file and None for a new one
+        """
+        tasks = []
+        for filepath in all_files:
+            entry = self.entries.get(filepath)
+            if entry is None:
+                tasks.append((filepath, None))
+                continue
+
+            size, mtime, content_hash, max_ts = entry
+            stat = os.stat(filepath)
+            if stat.st_size == size and stat.st_mtime == mtime:
+                continue
+
+            digest = file_digest(filepath)
+            if digest == content_hash:
+                record_file(cur, filepath, max_ts, digest)
+            else:
+                tasks.append((filepath, max_ts))
+
+        return tasks
@@ -0,0 +1,82 @@
+import pandas as pd
+from sql_queries import song_index_select
+
+KEY_COLUMNS = ['title', 'artist_name', 'duration']
+
+
+class SongIndex:
+    """
+    In-memory lookup of song_id and artist_id keyed on (title, artist name, duration), the same key the
+    song_select query filters on. Resolves a whole log DataFrame with one merge instead of one query per play,
+    and keeps running hit/miss counts of the plays it resolved.
+    """
+
+    def __init__(self, songs_df):
+        """
+        Parameters:
+                songs_df (pandas.DataFrame): Columns title, artist_name, duration, song_id and artist_id
+        """
+        # keep the first match of a key, as song_select's fetchone does
+        self.songs_df = songs_df[KEY_COLUMNS + ['song_id', 'artist_id']] \
+            .drop_duplicates(subset = KEY_COLUMNS) \
+            .reset_index(drop = True)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        Builds the index from the songs and artists tables.
+
+        Parameters:
+                cur (psycopg2.cursor()): Cursor of the sparkifydb database
+        """
+        cur.execute(song_index_select)
+        return cls(pd.DataFrame(cur.fetchall(), columns = KEY_COLUMNS + ['song_id', 'artist_id']))
+
+    @classmethod
+    def from_song_files(cls, filepaths):
+        """
+        Builds the index straight from song_data files, without a database round trip.
+
+        Parameters:
+                filepaths (list): Filepaths of the song files
+        """
+        frames = [pd.read_json(filepath, lines = True) for filepath in filepaths]
+        if not frames:
+            return cls(pd.DataFrame(columns = KEY_COLUMNS + ['song_id', 'artist_id']))
+        return cls(pd.concat(frames, ignore_index = True))
+
+    def __len__(self):
+        return len(self.songs_df)
+
+    def resolve(self, df):
+        """
+        Looks up song_id and artist_id for every event of a log DataFrame.
+
+        Parameters:
+                df (pandas.DataFrame): Events with song, artist and length columns
+
+        Returns:
+                ids (pandas.DataFrame): song_id and artist_id aligned with df's index, None where no song matches
+        """
+        keys = pd.DataFrame({'title': df['song'].values,
+                             'artist_name': df['artist'].values,
+                             'duration': df['length'].astype(float).values})
+        ids = keys.merge(self.songs_df, how = 'left', on = KEY_COLUMNS)[['song_id', 'artist_id']]
+        ids.index = df.index
+
+        matched = int(ids['song_id'].notna().sum())
+        self.hits += matched
+        self.misses += len(ids) - matched
+
+        return ids.astype(object).where(ids.notna(), None)
+
+    def stats(self):
+        """
+        Returns the hit/miss counts of every resolve call so far.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
@@ -4,12 +4,15 @@ user_table_drop     = "DROP table IF EXISTS users"
 song_table_drop     = "DROP table IF EXISTS songs"
 artist_table_drop   = "DROP table IF EXISTS artists"
 time_table_drop     = "DROP table IF EXISTS time"
+manifest_table_drop = "DROP table IF EXISTS ingest_manifest"
 
 # CREATE TABLES
 
+# songplay_id is derived from the natural key of the event (see songplay_key.py at the root of the repository),
+# so reloading a file does not add the same plays again
 songplay_table_create = ("""
                         CREATE TABLE IF NOT EXISTS songplays(
-                        songplay_id SERIAL PRIMARY KEY,
+                        songplay_id bigint PRIMARY KEY,
                         start_time bigint NOT NULL,
                         user_id int NOT NULL, 
                         level varchar, 
@@ -49,7 +52,7 @@ artist_table_create = ("""
                         """)
 
 time_table_create = ("""CREATE TABLE IF NOT EXISTS time (
-                    start_time time NOT NULL PRIMARY KEY,
+                    start_time timestamp NOT NULL PRIMARY KEY,
                     hour int,
                     day int,
                     week int,
@@ -58,15 +61,25 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time (
                     weekday varchar)
                     """)
 
+# files loaded by previous runs, so that a rerun only processes new or changed files
+manifest_table_create = ("""
+                        CREATE TABLE IF NOT EXISTS ingest_manifest (
+                        path varchar NOT NULL PRIMARY KEY,
+                        size bigint NOT NULL,
+                        mtime float NOT NULL,
+                        content_hash varchar NOT NULL,
+                        max_ts bigint,
+                        loaded_at timestamp NOT NULL DEFAULT now())
+                        """)
 
 
 # INSERT RECORDS
 
-# Insert data using the COPY command to bulk insert log files instead of using INSERT on one row at a time
+# Row-by-row inserts, used by the 'row' load mode; the 'bulk' mode uses the COPY based merges below
 songplay_table_insert = ("""
                         INSERT INTO songplays 
-                        (start_time, user_id, level, song_id, artist_id,session_id, location, user_agent) 
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s) 
+                        (songplay_id, start_time, user_id, level, song_id, artist_id,session_id, location, user_agent) 
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) 
                         ON CONFLICT (songplay_id) DO NOTHING                    
                         """)
 
@@ -76,25 +89,153 @@ user_table_insert = ("""
                     ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level
                     """)
 
-song_table_insert = ("""
-                     INSERT INTO songs (song_id, title, artist_id, year, duration)
-                     VALUES (%s, %s, %s, %s, %s)
-                     ON CONFLICT (song_id) DO NOTHING
-                     """)
-
-artist_table_insert = ("""
-                    INSERT INTO artists (artist_id, name, location, lattitude, longitude)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON CONFLICT (artist_id) DO NOTHING
-                    """)
-
-
 time_table_insert = ("""
                     INSERT INTO time (start_time, hour, day, week, month, year, weekday)
                     VALUES (%s, %s, %s, %s, %s, %s, %s)
                     ON CONFLICT (start_time) DO NOTHING
                     """)
 
+# BULK LOAD
+# Log files are streamed into session-local staging tables with COPY FROM STDIN and then
+# merged into the star schema with one set-based statement per table.
+
+staging_events_create = ("""
+                        CREATE TEMP TABLE IF NOT EXISTS staging_events (
+                        songplay_id bigint,
+                        ts bigint,
+                        user_id int,
+                        first_name varchar,
+                        last_name varchar,
+                        gender varchar,
+                        level varchar,
+                        song_id varchar,
+                        artist_id varchar,
+                        session_id int,
+                        location varchar,
+                        user_agent varchar)
+                        """)
+
+staging_time_create = ("""
+                      CREATE TEMP TABLE IF NOT EXISTS staging_time (
+                      start_time timestamp,
+                      hour int,
+                      day int,
+                      week int,
+                      month int,
+                      year int,
+                      weekday varchar)
+                      """)
+
+staging_songs_create = ("""
+                       CREATE TEMP TABLE IF NOT EXISTS staging_songs (
+                       song_id varchar,
+                       title varchar,
+                       artist_id varchar,
+                       year int,
+                       duration float)
+                       """)
+
+staging_artists_create = ("""
+                         CREATE TEMP TABLE IF NOT EXISTS staging_artists (
+                         artist_id varchar,
+                         name varchar,
+                         location varchar,
+                         lattitude float,
+                         longitude float)
+                         """)
+
+staging_truncate = "TRUNCATE staging_events, staging_time"
+staging_songs_truncate = "TRUNCATE staging_songs, staging_artists"
+
+staging_events_copy = ("""
+                      COPY staging_events (songplay_id, ts, user_id, first_name, last_name, gender, level, song_id,
+                                           artist_id, session_id, location, user_agent)
+                      FROM STDIN WITH (FORMAT csv)
+                      """)
+
+staging_time_copy = ("""
+                    COPY staging_time (start_time, hour, day, week, month, year, weekday)
+                    FROM STDIN WITH (FORMAT csv)
+                    """)
+
+staging_songs_copy = ("""
+                     COPY staging_songs (song_id, title, artist_id, year, duration)
+                     FROM STDIN WITH (FORMAT csv)
+                     """)
+
+staging_artists_copy = ("""
+                       COPY staging_artists (artist_id, name, location, lattitude, longitude)
+                       FROM STDIN WITH (FORMAT csv)
+                       """)
+
+song_table_merge = ("""
+                   INSERT INTO songs (song_id, title, artist_id, year, duration)
+                   SELECT song_id, title, artist_id, year, duration
+                   FROM staging_songs
+                   ON CONFLICT (song_id) DO NOTHING
+                   """)
+
+artist_table_merge = ("""
+                     INSERT INTO artists (artist_id, name, location, lattitude, longitude)
+                     SELECT artist_id, name, location, lattitude, longitude
+                     FROM staging_artists
+                     ON CONFLICT (artist_id) DO NOTHING
+                     """)
+
+songplay_table_merge = ("""
+                       INSERT INTO songplays
+                       (songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+                       SELECT songplay_id, ts, user_id, level, song_id, artist_id, session_id, location, user_agent
+                       FROM staging_events
+                       ON CONFLICT (songplay_id) DO NOTHING
+                       """)
+
+# the latest event of each user decides its level, as the row-by-row upsert does
+user_table_merge = ("""
+                   INSERT INTO users (user_id, first_name, last_name, gender, level)
+                   SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level
+                   FROM staging_events
+                   WHERE user_id IS NOT NULL
+                   ORDER BY user_id, ts DESC
+                   ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level
+                   """)
+
+time_table_merge = ("""
+                   INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+                   SELECT start_time, hour, day, week, month, year, weekday
+                   FROM staging_time
+                   ON CONFLICT (start_time) DO NOTHING
+                   """)
+
+# the level of each user taken from its latest songplay, independent of the order files were merged in
+user_level_reconcile = ("""
+                       UPDATE users
+                       SET level = latest.level
+                       FROM (SELECT DISTINCT ON (user_id) user_id, level
+                             FROM songplays
+                             ORDER BY user_id, start_time DESC, level) latest
+                       WHERE users.user_id = latest.user_id
+                       AND users.level IS DISTINCT FROM latest.level
+                       """)
+
+# INGESTION MANIFEST
+manifest_select = "SELECT path, size, mtime, content_hash, max_ts FROM ingest_manifest"
+
+manifest_upsert = ("""
+                  INSERT INTO ingest_manifest (path, size, mtime, content_hash, max_ts)
+                  VALUES (%s, %s, %s, %s, %s)
+                  ON CONFLICT (path) DO UPDATE SET size=EXCLUDED.size, mtime=EXCLUDED.mtime,
+                  content_hash=EXCLUDED.content_hash, max_ts=EXCLUDED.max_ts, loaded_at=now()
+                  """)
+
+# same upsert for many files in one statement, with psycopg2.extras.execute_values
+manifest_upsert_values = ("""
+                         INSERT INTO ingest_manifest (path, size, mtime, content_hash, max_ts)
+                         VALUES %s
+                         ON CONFLICT (path) DO UPDATE SET size=EXCLUDED.size, mtime=EXCLUDED.mtime,
+                         content_hash=EXCLUDED.content_hash, max_ts=EXCLUDED.max_ts, loaded_at=now()
+                         """)
+
 # FIND SONGS
 #song ID and artist ID based on the title, artist name, and duration of a song.
 song_select = ("""SELECT songs.song_id,
@@ -104,6 +245,19 @@ song_select = ("""SELECT songs.song_id,
                 WHERE songs.title = (%s) AND artists.name = (%s) AND songs.duration = (%s)
                 """)
 
+# whole song catalog for the in-memory SongIndex, keyed like song_select
+song_index_select = ("""SELECT songs.title,
+                     artists.name,
+                     songs.duration,
+                     songs.song_id,
+                     artists.artist_id
+                     FROM songs
+                     JOIN artists ON songs.artist_id = artists.artist_id
+                     """)
+
+# timestamps already in the time table, in milliseconds like the ts of the events
+time_keys_select = "SELECT round(extract(epoch FROM start_time) * 1000)::bigint FROM time"
+
 # ANALYSIS TABLES
 songplays_table = "SELECT * FROM songplays LIMIT 5"
 users_table     = "SELECT * FROM users LIMIT 5"
@@ -113,6 +267,9 @@ time_table      = "SELECT * FROM time LIMIT 5"
 
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries   = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-analysis_queries     = [songplays_table, users_table, songs_table, artists_table, time_table]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create]
+drop_table_queries   = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop]
+analysis_queries     = [songplays_table, users_table, songs_table, artists_table, time_table]
+staging_table_queries = [staging_events_create, staging_time_create, staging_songs_create, staging_artists_create]
+merge_table_queries  = [time_table_merge, user_table_merge, songplay_table_merge]
+merge_table_names    = ['time', 'users', 'songplays']
\ No newline at end of file
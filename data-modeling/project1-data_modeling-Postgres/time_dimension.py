@@ -0,0 +1,64 @@
+import pandas as pd
+from sql_queries import time_keys_select
+
+COLUMN_LABELS = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+
+
+def time_rows(ts):
+    """
+    Breaks event timestamps down into the columns of the time table, with vectorized operations.
+
+    Parameters:
+            ts (pandas.Series): Event timestamps in milliseconds since the epoch
+
+    Returns:
+            time_df (pandas.DataFrame): One row per timestamp with the time table columns
+    """
+    t = pd.to_datetime(pd.Series(ts, dtype = 'int64'), unit = 'ms')
+
+    time_data = [t, t.dt.hour, t.dt.day, t.dt.isocalendar().week.astype('int64'), t.dt.month, t.dt.year,
+                 t.dt.weekday]
+    return pd.DataFrame(dict(list(zip(COLUMN_LABELS, time_data))))
+
+
+class TimeDimension:
+    """
+    Keeps the timestamps already written to the time table during a run, so that each file only produces
+    time rows for keys that were never seen before. Busy hours repeat the same timestamps across many events
+    and files; they are dropped in memory before any row is sent to the server.
+    """
+
+    def __init__(self, seen=None):
+        """
+        Parameters:
+                seen (iterable): Timestamps in milliseconds that are already in the time table
+        """
+        self.seen = pd.Index([] if seen is None else seen, dtype = 'int64').unique()
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        Starts from the timestamps already stored in the time table.
+
+        Parameters:
+                cur (psycopg2.cursor()): Cursor of the sparkifydb database
+        """
+        cur.execute(time_keys_select)
+        return cls([row[0] for row in cur.fetchall()])
+
+    def __len__(self):
+        return len(self.seen)
+
+    def new_rows(self, ts):
+        """
+        Returns the time rows of the timestamps that were not seen yet, and marks them as seen.
+
+        Parameters:
+                ts (pandas.Series): Event timestamps in milliseconds since the epoch
+
+        Returns:
+                time_df (pandas.DataFrame): One row per new timestamp with the time table columns
+        """
+        new_keys = pd.Index(ts.dropna().astype('int64').unique()).difference(self.seen)
+        self.seen = self.seen.append(new_keys)
+        return time_rows(new_keys.values)
@@ -0,0 +1,244 @@
+"""
+Per-stage instrumentation shared by the ETL entry points (Postgres etl.py,
+Data-Warehouse-on-AWS/etl.py and Data-Lake-on-AWS/etl.py).
+
+Every stage (read, transform, write of a table...) is wrapped in
+`metrics.stage(name)`, which records its wall time and peak memory; the code
+inside the stage adds the rows in/out and bytes read/written it knows about.
+Calls of the same stage are aggregated over the run and emitted at the end as
+JSON lines or in the Prometheus text exposition format.
+
+Emission is configured with environment variables, so that none of the
+entry points needs new arguments:
+
+* ETL_METRICS_PATH       -- file the metrics are appended to, '-' for stdout;
+                            metrics are not emitted when unset
+* ETL_METRICS_FORMAT     -- 'jsonl' (default) or 'prometheus'
+* ETL_METRICS_COUNT_ROWS -- '1' to count the rows of lazily evaluated
+                            (Spark) tables, which costs an extra job per table
+"""
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+COUNTERS = ['rows_in', 'rows_out', 'bytes_read', 'bytes_written']
+
+
+def tree_rss(pid):
+    """
+    Returns the resident memory in bytes of a process and all its descendants, read from /proc.
+    Spark's JVM runs as a child of the Python driver, so it is counted too.
+    """
+    rss, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open('/proc/{}/status'.format(current)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir('/proc/{}/task'.format(current)):
+                with open('/proc/{}/task/{}/children'.format(current, task)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return rss
+
+
+class PeakRSS:
+    """
+    Samples the resident memory of this process tree in a background thread while a block runs.
+    Where /proc is not available it falls back to the process-lifetime peak from getrusage.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, tree_rss(os.getpid()))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if self.peak == 0:
+            import resource
+            # ru_maxrss is in kilobytes on Linux
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageRecord:
+    """
+    Aggregated measurements of one stage over all its calls in the run.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.peak_rss_bytes = 0
+        for counter in COUNTERS:
+            setattr(self, counter, None)
+
+    def add(self, **counters):
+        """
+        Adds to the stage's rows_in, rows_out, bytes_read and bytes_written. None values are ignored, and a
+        counter nobody added to is reported as unknown rather than 0.
+        """
+        for counter, value in counters.items():
+            if counter not in COUNTERS:
+                raise ValueError('Unknown stage counter {}'.format(counter))
+            if value is not None:
+                setattr(self, counter, (getattr(self, counter) or 0) + value)
+
+    def as_dict(self):
+        return dict({'stage': self.name,
+                     'calls': self.calls,
+                     'wall_seconds': round(self.wall_seconds, 6),
+                     'peak_rss_bytes': self.peak_rss_bytes},
+                    **{counter: getattr(self, counter) for counter in COUNTERS})
+
+
+class Metrics:
+    """
+    Records the stages of one ETL job. A single background thread samples the process tree's memory and
+    attributes it to every stage active at that moment, so nested stages each get their own peak.
+    """
+
+    def __init__(self, job, path=None, fmt='jsonl', count_rows=False, sample_interval=0.05):
+        """
+        Keyword arguments:
+        * job             -- name of the ETL job the stages belong to
+        * path            -- file the metrics are appended to, '-' for stdout, None to not emit them
+        * fmt             -- 'jsonl' or 'prometheus'
+        * count_rows      -- whether lazily evaluated tables should be counted
+        * sample_interval -- seconds between two memory samples
+        """
+        if fmt not in ('jsonl', 'prometheus'):
+            raise ValueError('Unknown metrics format {}'.format(fmt))
+
+        self.job = job
+        self.path = path
+        self.fmt = fmt
+        self.count_rows = count_rows
+        self.sample_interval = sample_interval
+        self.stages = {}
+        self._active = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    @classmethod
+    def from_env(cls, job):
+        """
+        Builds the job's metrics from the ETL_METRICS_* environment variables.
+        """
+        return cls(job,
+                   path=os.environ.get('ETL_METRICS_PATH') or None,
+                   fmt=os.environ.get('ETL_METRICS_FORMAT', 'jsonl'),
+                   count_rows=os.environ.get('ETL_METRICS_COUNT_ROWS') == '1')
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _sample(self):
+        pid = os.getpid()
+        while True:
+            time.sleep(self.sample_interval)
+            with self._lock:
+                active = list(self._active)
+            if active:
+                rss = tree_rss(pid)
+                for record in active:
+                    record.peak_rss_bytes = max(record.peak_rss_bytes, rss)
+
+    @contextmanager
+    def stage(self, name, **counters):
+        """
+        Times a stage and tracks its peak memory; yields its StageRecord so the block can add to its counters.
+
+        Keyword arguments:
+        * name     -- name of the stage, e.g. 'log.write.songplays'
+        * counters -- initial rows_in, rows_out, bytes_read or bytes_written of this call
+        """
+        record = self.stages.get(name)
+        if record is None:
+            record = self.stages.setdefault(name, StageRecord(name))
+        record.add(**counters)
+
+        if self.enabled and (self._sampler is None or self._sampler.pid != os.getpid()):
+            # also restarts the sampler in a forked worker process, where the thread does not exist
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.pid = os.getpid()
+            self._sampler.start()
+
+        with self._lock:
+            self._active.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.wall_seconds += time.perf_counter() - start
+            record.calls += 1
+            with self._lock:
+                self._active.remove(record)
+            if self.enabled:
+                record.peak_rss_bytes = max(record.peak_rss_bytes, tree_rss(os.getpid()))
+
+    def count(self, df):
+        """
+        Returns the row count of a lazily evaluated (Spark) DataFrame when row counting is on, None otherwise.
+        """
+        return df.count() if self.count_rows else None
+
+    def render(self):
+        """
+        Renders the aggregated stages in the configured format.
+        """
+        labels = {'job': self.job, 'host': socket.gethostname(), 'pid': os.getpid()}
+
+        if self.fmt == 'jsonl':
+            timestamp = time.time()
+            return ''.join(json.dumps(dict(labels, timestamp=timestamp, **record.as_dict())) + '\n'
+                           for record in self.stages.values())
+
+        lines = []
+        for metric in ['calls', 'wall_seconds', 'peak_rss_bytes'] + COUNTERS:
+            name = 'etl_stage_' + metric
+            lines.append('# TYPE {} gauge'.format(name))
+            for record in self.stages.values():
+                value = getattr(record, metric)
+                if value is None:
+                    continue
+                label_text = ','.join('{}="{}"'.format(key, label) for key, label in
+                                      sorted(dict(labels, stage=record.name).items()))
+                lines.append('{}{{{}}} {}'.format(name, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+    def emit(self):
+        """
+        Writes the aggregated stages to the configured path, once at the end of the run (or of a worker).
+        """
+        if not self.enabled or not self.stages:
+            return
+
+        text = self.render()
+        if self.path == '-':
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        else:
+            with open(self.path, 'a') as f:
+                f.write(text)
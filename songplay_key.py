@@ -0,0 +1,75 @@
+"""
+Deterministic songplay_id shared by the Postgres, Redshift, Spark and Airflow
+pipelines.
+
+A song play is identified by the natural key of its event: userId, sessionId,
+itemInSession and ts. Its songplay_id is derived from that key only, so it
+does not depend on partitioning, load order or reruns, and every pipeline
+computes the same id for the same play:
+
+* the key is written as text, "<userId>|<sessionId>|<itemInSession>|<ts>",
+  with every field as a decimal integer
+* the id is the first 15 hex digits of the md5 of that text, read as an
+  integer
+
+15 hex digits (60 bits) keep the id a non-negative BIGINT in every engine,
+Redshift's STRTOL included. Two plays share an id with a probability of about
+n^2 / 2^61, i.e. 1 in 200 000 for 3 million plays, where md5(sessionid ||
+start_time) collided for every two events of a session in the same
+millisecond.
+
+Python code calls songplay_id or songplay_ids; SQL code formats SPARK_SQL,
+REDSHIFT_SQL or DUCKDB_SQL with the column names of the key.
+"""
+import hashlib
+
+ID_HEX_DIGITS = 15
+
+# the same id as a Spark SQL expression; userId is a string in the logs, every field is cast to an integer first
+SPARK_SQL = ("CAST(conv(substr(md5(concat("
+             "CAST(CAST({user_id} AS BIGINT) AS STRING), '|', "
+             "CAST(CAST({session_id} AS BIGINT) AS STRING), '|', "
+             "CAST(CAST({item_in_session} AS BIGINT) AS STRING), '|', "
+             "CAST(CAST({ts} AS BIGINT) AS STRING))), 1, 15), 16, 10) AS BIGINT)")
+
+# the same id as a Redshift SQL expression
+REDSHIFT_SQL = ("STRTOL(SUBSTRING(MD5("
+                "CAST(CAST({user_id} AS BIGINT) AS VARCHAR) || '|' || "
+                "CAST(CAST({session_id} AS BIGINT) AS VARCHAR) || '|' || "
+                "CAST(CAST({item_in_session} AS BIGINT) AS VARCHAR) || '|' || "
+                "CAST(CAST({ts} AS BIGINT) AS VARCHAR)), 1, 15), 16)")
+
+# the same id as a DuckDB SQL expression; TRY_CAST turns a userId of "" into NULL, as Spark's CAST does
+DUCKDB_SQL = ("CAST(('0x' || substr(md5("
+              "CAST(TRY_CAST({user_id} AS BIGINT) AS VARCHAR) || '|' || "
+              "CAST(TRY_CAST({session_id} AS BIGINT) AS VARCHAR) || '|' || "
+              "CAST(TRY_CAST({item_in_session} AS BIGINT) AS VARCHAR) || '|' || "
+              "CAST(TRY_CAST({ts} AS BIGINT) AS VARCHAR)), 1, 15)) AS BIGINT)")
+
+
+def songplay_id(user_id, session_id, item_in_session, ts):
+    """
+    Returns the songplay_id of an event, None when a field of its natural key is missing.
+
+    Keyword arguments:
+    * user_id         -- userId of the event, an integer or its decimal text
+    * session_id      -- sessionId of the event
+    * item_in_session -- itemInSession of the event
+    * ts              -- ts of the event, in milliseconds since the epoch
+    """
+    try:
+        key = '{}|{}|{}|{}'.format(int(user_id), int(session_id), int(item_in_session), int(ts))
+    except (TypeError, ValueError):
+        return None
+    return int(hashlib.md5(key.encode()).hexdigest()[:ID_HEX_DIGITS], 16)
+
+
+def songplay_ids(df, columns=('userId', 'sessionId', 'itemInSession', 'ts')):
+    """
+    Returns the songplay_id of every event of a pandas DataFrame of log events.
+
+    Keyword arguments:
+    * df      -- log events
+    * columns -- names of the userId, sessionId, itemInSession and ts columns
+    """
+    return [songplay_id(*key) for key in zip(*(df[column].tolist() for column in columns))]